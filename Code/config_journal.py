@@ -0,0 +1,352 @@
+"""
+Journaled Config Storage
+========================
+Keeps the layout editor's configuration as a JSON snapshot plus an
+append-only journal of changes. Mapping a key appends one short line instead
+of rewriting the whole snapshot. After compact_after entries the journal is
+folded back into the snapshot and removed.
+
+Loading reads the snapshot and replays the journal. A torn last line (power
+lost mid-write) is skipped; a bad line anywhere else is real corruption and
+is reported. Compaction writes the new snapshot to a temporary file and
+renames it into place before truncating the journal, so a crash at any
+point leaves either the old or the new snapshot, and replaying the journal
+over the new one changes nothing.
+
+Journal lines are small JSON lists:
+  ["set", layout, pos, keycode]   map a key (pos = row << 8 | col)
+  ["del", layout, pos]            unmap a key
+  ["new", layout]                 create an empty layout
+  ["drop", layout]                delete a layout
+  ["use", layout]                 change current_layout
+
+Run this file with CPython for a flash-wear/latency benchmark against a
+simulated filesystem.
+"""
+
+import json
+import os
+from keymap_store import KeymapStore, pack_position
+
+def layouts_from_json(config):
+    """Replace the saved layout data in config with KeymapStore objects"""
+    config["layouts"] = {name: KeymapStore.from_data(data)
+                         for name, data in config["layouts"].items()}
+    return config
+
+def config_to_json(config):
+    """Return a JSON-ready copy of config with layouts as flat lists"""
+    data = dict(config)
+    data["layouts"] = {name: store.to_list()
+                       for name, store in config["layouts"].items()}
+    return data
+
+def apply_entry(config, entry):
+    """Apply one journal entry to a config holding KeymapStore layouts"""
+    op = entry[0]
+    layouts = config["layouts"]
+    if op == "set":
+        store = layouts.setdefault(entry[1], KeymapStore())
+        store.set(entry[2] >> 8, entry[2] & 0xFF, entry[3])
+    elif op == "del":
+        if entry[1] in layouts:
+            layouts[entry[1]].remove(entry[2] >> 8, entry[2] & 0xFF)
+    elif op == "new":
+        layouts.setdefault(entry[1], KeymapStore())
+    elif op == "drop":
+        layouts.pop(entry[1], None)
+    elif op == "use":
+        config["current_layout"] = entry[1]
+
+class HostFS:
+    """Filesystem access through the normal open()/os calls"""
+    def open(self, path, mode='r'):
+        return open(path, mode)
+
+    def exists(self, path):
+        try:
+            os.stat(path)
+            return True
+        except OSError:
+            return False
+
+    def remove(self, path):
+        os.remove(path)
+
+    def rename(self, old, new):
+        try:
+            os.rename(old, new)
+        except OSError:
+            # FAT cannot rename over an existing file
+            os.remove(new)
+            os.rename(old, new)
+
+class ConfigJournal:
+    """Snapshot + append-only journal persistence for the editor config"""
+    def __init__(self, snapshot_path='/keyboard_config.json',
+                 journal_path='/keyboard_config.jnl', compact_after=64, fs=None):
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path
+        self.compact_after = compact_after
+        self.fs = fs or HostFS()
+        self.pending = []      # entries not yet written to flash
+        self.journal_len = 0   # entries already in the journal file
+        self.corrupt_lines = []  # journal line numbers that failed to parse
+
+    def load_default(self, default):
+        """Return a deep copy of default with KeymapStore layouts"""
+        self.pending = []
+        self.journal_len = 0
+        return layouts_from_json(json.loads(json.dumps(default)))
+
+    def load(self, default):
+        """Return the config from snapshot + journal, or a copy of default"""
+        tmp_path = self.snapshot_path + '.tmp'
+        if not self.fs.exists(self.snapshot_path) and self.fs.exists(tmp_path):
+            # Power lost between removing the old snapshot and the rename
+            self.fs.rename(tmp_path, self.snapshot_path)
+        try:
+            with self.fs.open(self.snapshot_path, 'r') as f:
+                config = layouts_from_json(json.load(f))
+        except (OSError, ValueError):
+            config = self.load_default(default)
+
+        self.journal_len = 0
+        self.corrupt_lines = []
+        if self.fs.exists(self.journal_path):
+            bad = None  # last line that failed to parse
+            with self.fs.open(self.journal_path, 'r') as f:
+                for number, line in enumerate(f, 1):
+                    if bad is not None:
+                        # Not the last line, so not a torn write
+                        self.corrupt_lines.append(bad)
+                        bad = None
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        bad = number
+                        continue
+                    apply_entry(config, entry)
+                    self.journal_len += 1
+            # A bad last line is a torn write and is silently dropped
+            if self.corrupt_lines:
+                print(f"Config journal corrupt at line(s) {self.corrupt_lines}, "
+                      f"those changes were skipped")
+        return config
+
+    def record(self, *entry):
+        """Queue a journal entry; call flush() to write it"""
+        self.pending.append(list(entry))
+
+    def set_key(self, config, layout, row, col, keycode):
+        """Map a key in config and journal the change"""
+        config["layouts"].setdefault(layout, KeymapStore()).set(row, col, keycode)
+        self.record("set", layout, pack_position(row, col), keycode)
+
+    def remove_key(self, config, layout, row, col):
+        """Unmap a key in config and journal the change"""
+        if layout in config["layouts"]:
+            config["layouts"][layout].remove(row, col)
+        self.record("del", layout, pack_position(row, col))
+
+    def needs_compaction(self):
+        return self.journal_len + len(self.pending) >= self.compact_after
+
+    def flush(self):
+        """Append pending entries to the journal in a single write"""
+        if not self.pending:
+            return 0
+        lines = "".join(json.dumps(entry) + "\n" for entry in self.pending)
+        with self.fs.open(self.journal_path, 'a') as f:
+            f.write(lines)
+        self.journal_len += len(self.pending)
+        self.pending = []
+        return len(lines)
+
+    def compact(self, config):
+        """Write config as the new snapshot and empty the journal"""
+        tmp_path = self.snapshot_path + '.tmp'
+        with self.fs.open(tmp_path, 'w') as f:
+            json.dump(config_to_json(config), f)
+        self.fs.rename(tmp_path, self.snapshot_path)
+        if self.fs.exists(self.journal_path):
+            with self.fs.open(self.journal_path, 'w'):
+                pass
+        self.pending = []
+        self.journal_len = 0
+
+    def save(self, config):
+        """Flush the journal, compacting it when it has grown too long.
+        Returns True if a new snapshot was written."""
+        if self.needs_compaction():
+            self.compact(config)
+            return True
+        self.flush()
+        return False
+
+# --- Simulated flash filesystem for benchmarking ---
+SECTOR_SIZE = 4096
+SECTOR_ERASE_MS = 45.0  # typical QSPI NOR 4 KB erase
+PAGE_SIZE = 256
+PAGE_PROGRAM_MS = 0.7
+METADATA_SECTORS = 1    # FAT/directory update per file close
+
+class SimulatedFile:
+    def __init__(self, fs, path, mode):
+        self.fs = fs
+        self.path = path
+        self.mode = mode
+        if 'w' in mode:
+            self.data = ""
+        else:
+            self.data = fs.files.get(path, "")
+        self.start = len(self.data) if 'a' in mode else 0
+        self.lines = iter(self.data.splitlines(True)) if 'r' in mode else None
+
+    def write(self, text):
+        self.data += text
+        return len(text)
+
+    def read(self):
+        return self.data
+
+    def __iter__(self):
+        return self.lines
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if 'r' in self.mode:
+            return
+        self.fs.files[self.path] = self.data
+        # Every sector touched from the first modified byte has to be rewritten
+        first = self.start // SECTOR_SIZE
+        last = max(len(self.data) - 1, self.start) // SECTOR_SIZE
+        sectors = last - first + 1 + METADATA_SECTORS
+        written = len(self.data) - self.start
+        self.fs.account(sectors, written)
+
+class SimulatedFS:
+    """In-memory filesystem that counts flash erases and write time"""
+    def __init__(self):
+        self.files = {}
+        self.sectors_erased = 0
+        self.bytes_written = 0
+        self.busy_ms = 0.0
+
+    def account(self, sectors, written):
+        self.sectors_erased += sectors
+        self.bytes_written += written
+        pages = sectors * SECTOR_SIZE // PAGE_SIZE
+        self.busy_ms += sectors * SECTOR_ERASE_MS + pages * PAGE_PROGRAM_MS
+
+    def open(self, path, mode='r'):
+        if 'r' in mode and path not in self.files:
+            raise OSError(2, "No such file")
+        return SimulatedFile(self, path, mode)
+
+    def exists(self, path):
+        return path in self.files
+
+    def remove(self, path):
+        del self.files[path]
+        self.account(METADATA_SECTORS, 0)
+
+    def rename(self, old, new):
+        self.files[new] = self.files.pop(old)
+        self.account(METADATA_SECTORS, 0)
+
+def legacy_save(fs, config):
+    """The editor's old save: indented "(r, c)" dict snapshot + KMK source file"""
+    data = dict(config)
+    data["layouts"] = {name: {f"({r}, {c})": keycode for r, c, keycode in store.items()}
+                       for name, store in config["layouts"].items()}
+    with fs.open("/keyboard_config.json", 'w') as f:
+        json.dump(data, f, indent=2)
+    write_kmk(fs, config)
+
+def write_kmk(fs, config):
+    """Stand-in for the editor's KMK keymap file, same size"""
+    rows, cols = config["layouts"][config["current_layout"]].size()
+    with fs.open("/kmk_keymap.py", 'w') as f:
+        f.write("from kmk.keys import KC\nKEYMAP = [\n")
+        for _ in range(rows):
+            f.write("    [" + ", ".join(["KC.NO"] * cols) + "],\n")
+        f.write("]\n")
+
+def benchmark(num_keys=96, compact_after=64):
+    """Compare the old full rewrite against the journal while mapping keys"""
+    # Two fully mapped 8x16 layouts plus the one being edited
+    default = {"row_pins": list(range(8)), "col_pins": list(range(8, 24)),
+               "current_layout": "default",
+               "layouts": {"default": [],
+                           "us_qwerty": [x for pos in range(8 * 16)
+                                         for x in ((pos // 16) << 8 | pos % 16, 4 + pos % 100)],
+                           "uk": [x for pos in range(8 * 16)
+                                  for x in ((pos // 16) << 8 | pos % 16, 4 + pos % 97)]}}
+
+    # Old behaviour: rewrite everything after every mapped key
+    fs = SimulatedFS()
+    config = ConfigJournal(fs=fs).load(default)
+    for i in range(num_keys):
+        config["layouts"]["default"].set(i // 16, i % 16, 4 + i % 100)
+        legacy_save(fs, config)
+    print(f"full rewrite: {fs.sectors_erased:5d} sectors erased, "
+          f"{fs.bytes_written:7d} bytes, {fs.busy_ms / num_keys:6.1f} ms per key")
+
+    # Journal: append one entry per key, compact every compact_after entries.
+    # The editor rebuilds the KMK file only after a compaction and on exit.
+    fs = SimulatedFS()
+    journal = ConfigJournal(fs=fs, compact_after=compact_after)
+    config = journal.load(default)
+    kmk = SimulatedFS()
+    rebuilds = 1  # on exit
+    for i in range(num_keys):
+        journal.set_key(config, "default", i // 16, i % 16, 4 + i % 100)
+        if journal.save(config):
+            write_kmk(kmk, config)
+            rebuilds += 1
+    write_kmk(kmk, config)
+    print(f"journal:      {fs.sectors_erased:5d} sectors erased, "
+          f"{fs.bytes_written:7d} bytes, {fs.busy_ms / num_keys:6.1f} ms per key")
+    print(f"  + KMK file: {fs.sectors_erased + kmk.sectors_erased:5d} sectors erased, "
+          f"{fs.bytes_written + kmk.bytes_written:7d} bytes, "
+          f"{(fs.busy_ms + kmk.busy_ms) / num_keys:6.1f} ms per key "
+          f"({rebuilds} rebuilds)")
+
+    # Replaying snapshot + journal must give the same layout
+    reloaded = ConfigJournal(fs=fs).load(default)
+    same = reloaded["layouts"]["default"].to_matrix() == config["layouts"]["default"].to_matrix()
+    print(f"replayed config matches: {same}")
+
+    # Power lost after the temporary snapshot was written: the old snapshot
+    # and journal are still intact
+    journal.set_key(config, "default", 9, 0, 40)
+    journal.flush()
+    def power_lost(old, new):
+        raise OSError(5, "power lost")
+    real_rename = fs.rename
+    fs.rename = power_lost
+    try:
+        journal.compact(config)
+    except OSError:
+        pass
+    fs.rename = real_rename
+    reloaded = ConfigJournal(fs=fs).load(default)
+    print(f"crash before rename keeps the new key: {reloaded['layouts']['default'].get(9, 0) == 40}")
+
+    # A bad line in the middle is reported, a torn last line is not
+    journal.compact(config)
+    fs.files[journal.journal_path] = ('["set", "default", 2560, 41]\n{"garbage\n'
+                                      '["set", "default", 2561, 42]\n["set", "def')
+    checker = ConfigJournal(fs=fs)
+    reloaded = checker.load(default)
+    print(f"corrupt lines reported: {checker.corrupt_lines}, "
+          f"entries replayed: {checker.journal_len}")
+
+if __name__ == "__main__":
+    benchmark()
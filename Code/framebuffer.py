@@ -0,0 +1,392 @@
+"""
+Framebuffers for the DPI Output
+===============================
+Compact frame storage for hdmi_pico.py. A frame used to be a list of 480
+lists of 640 ints, which needs megabytes and cannot fit in a Pico.
+
+Modes (see create_framebuffer()):
+  full    - 640x480, one RGB332 byte per pixel in a single 300 KB buffer
+            (Pico 2). Streamed straight from memory by scanline.py.
+  half    - 320x240 RGB332 (75 KB). Each line is sent twice from the DMA
+            line table and each pixel is held for two clocks by the RGB
+            program. Streamed straight from memory.
+  indexed - 320x240 with 4-bit palette indexes (37.5 KB) and a 16-colour
+            palette. One source byte is two pixels, and a 256-entry lookup
+            table turns it into two RGB332 bytes; pixels are doubled by the
+            RGB program as in half mode.
+  tile    - 80x60 cells of 8x8 tiles, 256 tiles of 4-bit pixels and a
+            16-colour palette (about 29 KB in all). Each tile row is kept
+            expanded to two words, so rendering a line copies two words
+            per cell.
+
+Modes with a frame attribute are streamed from memory. The others
+provide render_line(y, words, offset), which writes one output line into
+an array('I'). Expanding a line in Python takes longer than the line is on
+screen, so they are never expanded inside the pixel deadline: ExpandedFrame
+keeps a streamable RGB332 copy (the size of a half or full frame) and
+rebuilds it only when the drawing or the palette has changed. Pixel
+colours are RGB332 bytes; palette modes draw with palette indexes.
+DoubleBuffer pairs two framebuffers: drawing goes to the back buffer, and
+present() swaps the buffer indexes at the next vertical blank. Run this
+file with CPython to compare memory use and expansion speed, and to
+simulate tearing with one and two buffers.
+"""
+
+from array import array
+import time
+from scanline import byte_view
+
+try:
+    import framebuf
+except ImportError:
+    framebuf = None
+
+class Framebuffer:
+    """8-bit RGB332 pixels in one buffer that can be streamed directly"""
+    def __init__(self, width, height, line_repeat=1, pixel_repeat=1):
+        self.width = width
+        self.height = height
+        self.line_repeat = line_repeat    # scanlines per stored line
+        self.pixel_repeat = pixel_repeat  # clocks per pixel, done by the RGB program
+        self.words_per_line = width // 4
+        self.palette = None
+        self.frame = array('I', bytes(width * height))
+        self.pixels = byte_view(self.frame)
+        # MicroPython's framebuf draws in C when it is available
+        self.canvas = None
+        if framebuf is not None:
+            self.canvas = framebuf.FrameBuffer(self.pixels, width, height, framebuf.GS8)
+
+    def bytes_used(self):
+        return len(self.pixels)
+
+    def pixel(self, x, y, color):
+        self.pixels[y * self.width + x] = color
+
+    def fill_rect(self, x, y, w, h, color):
+        if self.canvas is not None:
+            self.canvas.fill_rect(x, y, w, h, color)
+            return
+        run = bytes((color,)) * w
+        start = y * self.width + x
+        for _ in range(h):
+            self.pixels[start:start + w] = run
+            start += self.width
+
+class Palette:
+    """16 RGB332 colours with a lookup table for expanding packed 4-bit pixels"""
+    def __init__(self, colors=None):
+        self.colors = bytearray(16)
+        self.pairs = array('H', [0] * 256)  # byte -> two output pixels
+        self.version = 0                    # bumped on every change
+        for i, color in enumerate(colors or ()):
+            self.colors[i] = color
+        self.update()
+
+    def set(self, index, color):
+        self.colors[index] = color
+        self.update()
+
+    def update(self):
+        colors = self.colors
+        for b in range(256):
+            low = colors[b & 15]
+            high = colors[b >> 4]
+            self.pairs[b] = low | (high << 8)
+        self.version += 1
+
+class IndexedFramebuffer:
+    """Half-resolution 4-bit indexed pixels, expanded per line through the palette"""
+    def __init__(self, width=320, height=240, palette=None):
+        self.width = width
+        self.height = height
+        self.line_repeat = 2
+        self.pixel_repeat = 2
+        self.words_per_line = width // 4
+        self.palette = palette or Palette()
+        self.frame = None
+        self.pixels = bytearray(width * height // 2)  # even x in the low nibble
+        self.version = 0  # bumped on every drawing change
+
+    def bytes_used(self):
+        return len(self.pixels) + len(self.palette.colors)
+
+    def pixel(self, x, y, index):
+        i = (y * self.width + x) >> 1
+        if x & 1:
+            self.pixels[i] = (self.pixels[i] & 0x0F) | (index << 4)
+        else:
+            self.pixels[i] = (self.pixels[i] & 0xF0) | index
+        self.version += 1
+
+    def fill_rect(self, x, y, w, h, index):
+        for row in range(y, y + h):
+            # Odd edges nibble by nibble, the middle a byte at a time
+            start = x
+            end = x + w
+            if start & 1:
+                self.pixel(start, row, index)
+                start += 1
+            if end & 1 and end > start:
+                end -= 1
+                self.pixel(end, row, index)
+            i = (row * self.width + start) >> 1
+            n = (end - start) >> 1
+            self.pixels[i:i + n] = bytes((index | (index << 4),)) * n
+        self.version += 1
+
+    def render_line(self, y, words, offset=0):
+        """Expand stored line y into words[offset:] (width // 4 words)"""
+        pairs = self.palette.pairs
+        pixels = self.pixels
+        i = y * (self.width >> 1)
+        for n in range(offset, offset + (self.width >> 2)):
+            words[n] = pairs[pixels[i]] | (pairs[pixels[i + 1]] << 16)
+            i += 2
+
+class TileFramebuffer:
+    """Grid of 8x8 tiles with 4-bit pixels and a shared palette"""
+    def __init__(self, cols=80, rows=60, tile_count=256, palette=None):
+        self.cols = cols
+        self.rows = rows
+        self.width = cols * 8
+        self.height = rows * 8
+        self.line_repeat = 1
+        self.pixel_repeat = 1
+        self.words_per_line = cols * 2
+        self.palette = palette or Palette()
+        self.frame = None
+        self.cells = bytearray(cols * rows)           # tile number per cell
+        self.tiles = bytearray(tile_count * 32)       # 8 rows of 4 bytes per tile
+        self.expanded = array('I', [0] * (tile_count * 16))  # 2 words per tile row
+        self.palette_version = self.palette.version
+        self.version = 0  # bumped on every drawing change
+
+        # Tiles 0-15 are solid blocks of each palette colour
+        for index in range(16):
+            self.tiles[index * 32:(index + 1) * 32] = bytes((index | (index << 4),)) * 32
+        self.expand_all()
+
+    def bytes_used(self):
+        return (len(self.cells) + len(self.tiles) + len(self.expanded) * 4 +
+                len(self.palette.colors))
+
+    def set_tile(self, tile, rows):
+        """Define a tile from 8 rows of 8 palette indexes"""
+        for ty, row in enumerate(rows):
+            for tx in range(0, 8, 2):
+                self.tiles[tile * 32 + ty * 4 + tx // 2] = row[tx] | (row[tx + 1] << 4)
+        self.expand_tile(tile)
+        self.version += 1
+
+    def expand_tile(self, tile):
+        pairs = self.palette.pairs
+        tiles = self.tiles
+        expanded = self.expanded
+        for ty in range(8):
+            i = tile * 32 + ty * 4
+            e = (tile * 8 + ty) * 2
+            expanded[e] = pairs[tiles[i]] | (pairs[tiles[i + 1]] << 16)
+            expanded[e + 1] = pairs[tiles[i + 2]] | (pairs[tiles[i + 3]] << 16)
+
+    def expand_all(self):
+        for tile in range(len(self.tiles) // 32):
+            self.expand_tile(tile)
+        self.palette_version = self.palette.version
+
+    def set_cell(self, col, row, tile):
+        self.cells[row * self.cols + col] = tile
+        self.version += 1
+
+    def fill_rect(self, x, y, w, h, index):
+        """Fill whole cells covering the pixel rectangle with solid tile index"""
+        for row in range(y >> 3, (y + h + 7) >> 3):
+            start = row * self.cols + (x >> 3)
+            n = ((x + w + 7) >> 3) - (x >> 3)
+            self.cells[start:start + n] = bytes((index,)) * n
+        self.version += 1
+
+    def render_line(self, y, words, offset=0):
+        """Write output line y (cols * 2 words) to words[offset:] from the
+        cell and tile tables"""
+        if self.palette_version != self.palette.version:
+            self.expand_all()
+        expanded = self.expanded
+        cells = self.cells
+        base = (y >> 3) * self.cols
+        ty2 = (y & 7) * 2
+        n = offset
+        for c in range(self.cols):
+            e = cells[base + c] * 16 + ty2
+            words[n] = expanded[e]
+            words[n + 1] = expanded[e + 1]
+            n += 2
+
+class ExpandedFrame:
+    """Streamable RGB332 copy of an indexed or tile framebuffer, rebuilt
+    outside the pixel deadline whenever the source has changed"""
+    def __init__(self, source):
+        self.source = source
+        self.target = Framebuffer(source.width, source.height,
+                                  source.line_repeat, source.pixel_repeat)
+        self.version = None
+        self.rebuilds = 0
+
+    def refresh(self):
+        """Expand the whole source if it changed; returns True if it did"""
+        source = self.source
+        version = (source.version, source.palette.version)
+        if version == self.version:
+            return False
+        frame = self.target.frame
+        step = source.words_per_line
+        for y in range(source.height):
+            source.render_line(y, frame, y * step)
+        self.version = version
+        self.rebuilds += 1
+        return True
+
+class DoubleBuffer:
+    """Front and back framebuffers; present() swaps them at the next vblank"""
+    def __init__(self, front, back):
+        self.buffers = [front, back]
+        self.front = 0        # index of the buffer being scanned out
+        self.pending = False  # swap requested by present()
+        self.frames = 0
+        self.swaps = 0
+
+    def shown(self):
+        return self.buffers[self.front]
+
+    def back(self):
+        """The buffer to draw into"""
+        return self.buffers[1 - self.front]
+
+    def present(self, wait=True):
+        """Show the back buffer from the next frame on. With wait, return
+        once the swap has happened and the new back buffer is free to draw."""
+        self.pending = True
+        while wait and self.pending:
+            pass  # the vsync IRQ handler runs between bytecodes
+
+    def vblank(self):
+        """Call during vertical blanking, only when the returned buffer is about
+        to be scanned out; returns the front index"""
+        self.frames += 1
+        if self.pending:
+            # Only the index changes: no pixels are copied
+            self.front = 1 - self.front
+            self.pending = False
+            self.swaps += 1
+        return self.front
+
+def create_framebuffer(mode, width=640, height=480):
+    """Return a framebuffer for one of the modes described above"""
+    if mode == 'full':
+        return Framebuffer(width, height)
+    if mode == 'half':
+        return Framebuffer(width // 2, height // 2, line_repeat=2, pixel_repeat=2)
+    if mode == 'indexed':
+        return IndexedFramebuffer(width // 2, height // 2)
+    if mode == 'tile':
+        return TileFramebuffer(width // 8, height // 8)
+    raise ValueError(f"Unknown display mode: {mode}")
+
+def frame_bytes(mode, width=640, height=480):
+    """Bytes create_framebuffer(mode, width, height) needs, plus the
+    expanded copy that palette and tile modes are streamed from"""
+    if mode == 'full':
+        return width * height
+    if mode == 'half':
+        return width * height // 4
+    if mode == 'indexed':
+        return width * height // 8 + 16 + width * height // 4
+    if mode == 'tile':
+        return (width // 8) * (height // 8) + 256 * 32 + 256 * 16 * 4 + 16 + width * height
+    raise ValueError(f"Unknown display mode: {mode}")
+
+def streamed_framebuffer(mode, width=640, height=480):
+    """Return (framebuffer to draw into, framebuffer to stream, ExpandedFrame
+    or None); palette and tile modes stream an expanded copy"""
+    fb = create_framebuffer(mode, width, height)
+    if fb.frame is not None:
+        return fb, fb, None
+    expanded = ExpandedFrame(fb)
+    return fb, expanded.target, expanded
+
+def benchmark(width=640, height=480):
+    """Memory per mode and line expansion speed for the on-the-fly modes"""
+    import tracemalloc
+    tracemalloc.start()
+    old = [[0xFF] * width for _ in range(height)]
+    old_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del old
+    print(f"  {'list of lists':14} {old_bytes:9d} bytes under CPython, "
+          f"{width * height * 4} bytes of 32-bit list slots on the Pico")
+
+    line_time = 1 / (60 * 525)  # one 640x480@60 scanline
+    for mode in ('full', 'half', 'indexed', 'tile'):
+        fb = create_framebuffer(mode, width, height)
+        if fb.palette is not None:
+            for i in range(7):
+                fb.palette.set(i, (0xFF, 0xFC, 0xF3, 0xF0, 0xCF, 0xCC, 0x33)[i])
+        fb.fill_rect(0, 0, fb.width // 2, fb.height, 3)
+        line = f"  {mode:14} {fb.bytes_used():9d} bytes"
+        if fb.frame is None:
+            words = array('I', [0] * fb.words_per_line)
+            lines = 0
+            start = time.perf_counter()
+            while time.perf_counter() - start < 0.2:
+                fb.render_line(lines % fb.height, words)
+                lines += 1
+            per_line = (time.perf_counter() - start) / lines
+            expanded = ExpandedFrame(fb)
+            start = time.perf_counter()
+            expanded.refresh()
+            rebuild = time.perf_counter() - start
+            line += (f" + {expanded.target.bytes_used()} expanded; per line "
+                     f"{per_line * 1e6:.1f} us = {per_line / (fb.line_repeat * line_time) * 100:.0f}% "
+                     f"of its scanline time under CPython (MicroPython is many times slower), so it is expanded once "
+                     f"per change instead ({rebuild * 1000:.0f} ms) and streamed")
+        print(line)
+
+def simulate_tearing(frames=120, height=240, draw_speed=0.7):
+    """Scan out frames while redrawing in a new colour each time, and count
+    frames that show parts of two drawings, with one buffer and with two"""
+    for double in (False, True):
+        first = Framebuffer(4, height)
+        display = DoubleBuffer(first, Framebuffer(4, height)) if double else None
+        torn = 0
+        color = 1
+        done = 0.0        # lines of the current drawing finished
+        waiting = False   # presented, back buffer still on screen
+        for _ in range(frames):
+            shown = display.shown() if double else first
+            colors = set()
+            for y in range(height):
+                # The drawer runs concurrently with scan-out
+                if not waiting:
+                    target = display.back() if double else first
+                    start = int(done)
+                    done += draw_speed
+                    if int(done) > start:
+                        target.fill_rect(0, start, 4, min(int(done), height) - start, color)
+                    if done >= height:
+                        color += 1
+                        done = 0.0
+                        if double:
+                            display.present(wait=False)
+                            waiting = True
+                colors.add(shown.pixels[y * shown.width])
+            if len(colors) > 1:
+                torn += 1
+            if double:
+                display.vblank()
+                waiting = display.pending
+        print(f"  {'double' if double else 'single'} buffer: {torn}/{frames} frames torn, "
+              f"{color - 1} drawings completed")
+
+if __name__ == "__main__":
+    benchmark()
+    simulate_tearing()
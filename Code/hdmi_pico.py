@@ -1,30 +1,78 @@
 """
 Raspberry Pi Pico DPI to HDMI Adapter
-Note: This implementation provides VGA-level output (640x480) through DPI signals
-that can be converted to HDMI with an external adapter board.
+Note: This implementation provides VGA-level output (640x480 and the other
+modes in video_timing.py) through DPI signals that can be converted to HDMI
+with an external adapter board.
+One sync state machine makes HSYNC and VSYNC and starts the RGB state machine
+on every visible line (see video_pio.py). Frames are only started from the
+IRQ the sync program raises at the start of vertical blanking, so line 0 of
+the frame always lands on the first visible line. With DOUBLE_BUFFER, drawing
+goes to a back buffer and present() swaps it in at that IRQ.
 """
 from machine import Pin, PWM
+import machine
 import array
+import os
 import time
 import rp2
+from scanline import make_feeder
+from framebuffer import create_framebuffer, streamed_framebuffer, frame_bytes, DoubleBuffer
+from text_console import TextConsole
+from video_timing import MODES, HEAP_BYTES, solve_clock, check_mode
+import video_pio
 
-# Configuration for 640x480 @ 60Hz
-WIDTH = 640
-HEIGHT = 480
-H_SYNC_PULSE = 96
-H_FRONT_PORCH = 16
-H_BACK_PORCH = 48
-V_SYNC_PULSE = 2
-V_FRONT_PORCH = 10
-V_BACK_PORCH = 33
+# Video mode from video_timing.py: '640x480', '800x600', '720x400' or
+# '320x240' (640x480 timing with doubled pixels)
+VIDEO_MODE = '320x240'
+MODE = MODES[VIDEO_MODE]
+WIDTH = MODE.width
+HEIGHT = MODE.height
+H_SYNC_PULSE = MODE.h_sync
+H_FRONT_PORCH = MODE.h_front
+H_BACK_PORCH = MODE.h_back
+V_SYNC_PULSE = MODE.v_sync
+V_FRONT_PORCH = MODE.v_front
+V_BACK_PORCH = MODE.v_back
 
 # Total line and frame timing
 H_TOTAL = WIDTH + H_SYNC_PULSE + H_FRONT_PORCH + H_BACK_PORCH
 V_TOTAL = HEIGHT + V_SYNC_PULSE + V_FRONT_PORCH + V_BACK_PORCH
 
-# Pixel clock is 25.175 MHz for VGA 640x480@60Hz
-# Since the PIO runs at up to 125MHz, we use a divider of 5 approx.
-CLOCK_DIV = 5
+# Pixels are sent four to a 32-bit word
+WORDS_PER_LINE = WIDTH // 4
+
+# Frame storage: 'full' (300 KB, Pico 2), 'half', 'indexed' or 'tile'
+# (see framebuffer.py), or 'text' for an 80x30 console drawn into a full frame.
+# 'half' and 'indexed' store every other pixel and line, so they go with the
+# doubled '320x240' video mode; the others with full-size modes.
+DISPLAY_MODE = 'half'
+HALF_MODES = ('half', 'indexed')
+if (DISPLAY_MODE in HALF_MODES) != (MODE.repeat == 2):
+    raise ValueError(f"DISPLAY_MODE '{DISPLAY_MODE}' does not suit {MODE.name}: use "
+                     f"{' or '.join(HALF_MODES) if MODE.repeat == 2 else 'full, tile or text'}")
+# Half resolution holds every pixel for two clocks in the RGB program
+PIXEL_REPEAT = 2 if DISPLAY_MODE in HALF_MODES else 1
+# Draw into a back buffer and swap at vblank; two half frames are 150 KB.
+# Only with DMA: without it the CPU sends every line and can only draw
+# during vertical blanking, which is far too short for a frame.
+DOUBLE_BUFFER = DISPLAY_MODE == 'half' and hasattr(rp2, 'DMA')
+# Everything the chosen storage allocates, checked against this chip's heap
+FRAME_BYTES = (frame_bytes('full' if DISPLAY_MODE == 'text' else DISPLAY_MODE, WIDTH, HEIGHT) *
+               (2 if DOUBLE_BUFFER else 1))
+CHIP = 'RP2350' if 'RP2350' in os.uname().machine else 'RP2040'
+
+# Pick the sys_clk whose integer division comes closest to the pixel clock.
+# The RGB program takes two cycles per pixel, so it runs at twice the pixel
+# clock (100.8 MHz / 2 for 640x480) and the sync program at the pixel clock.
+TIMING = solve_clock(MODE.pixel_clock, cycles_per_pixel=2)
+PROBLEMS = check_mode(MODE, TIMING, HEAP_BYTES[CHIP], FRAME_BYTES)
+if PROBLEMS:
+    # Fail before the clock changes or anything large is allocated
+    raise RuntimeError(f"{MODE.name} with DISPLAY_MODE '{DISPLAY_MODE}' on {CHIP}: "
+                       + "; ".join(PROBLEMS))
+machine.freq(TIMING.sys_clk)
+PIXEL_CLOCK = round(TIMING.pixel_clock)
+RGB_FREQ = round(TIMING.pio_freq)
 
 # Define GPIO pins
 # RGB pins - 8 bits total (3 red, 3 green, 2 blue)
@@ -43,149 +91,141 @@ hsync = Pin(HSYNC_PIN, Pin.OUT)
 vsync = Pin(VSYNC_PIN, Pin.OUT)
 pixel_clock = Pin(CLOCK_PIN, Pin.OUT)
 
-# Define PIO program for HSYNC
-@rp2.asm_pio(
-    set_init=rp2.PIO.OUT_LOW,
-    autopull=True,
-    pull_thresh=32,
-    out_shiftdir=rp2.PIO.SHIFT_RIGHT,
-)
-def hsync_program():
-    # Output high for visible area plus front porch
-    set(pins, 1)                           # HSYNC high during visible and front porch
-    mov(x, osr)                            # Load X with visible + front porch count
-    label("hsync_high")
-    jmp(x_dec, "hsync_high")               # Stay high for X cycles
-    
-    # Output low for sync pulse
-    set(pins, 0)                           # HSYNC low during sync pulse
-    mov(x, isr)                            # Load X with sync pulse count
-    label("hsync_low")
-    jmp(x_dec, "hsync_low")                # Stay low for X cycles
-    
-    # Output high for back porch
-    set(pins, 1)                           # HSYNC high during back porch
-    mov(x, osr)                            # Load X with back porch count
-    label("hsync_backporch")
-    jmp(x_dec, "hsync_backporch")          # Stay high for X cycles
-
-# Define PIO program for VSYNC
-@rp2.asm_pio(
-    set_init=rp2.PIO.OUT_LOW,
-    autopull=True,
-    pull_thresh=32,
+# Sync program: HSYNC on the SET pin, VSYNC on the OUT pin, both idle to start
+IDLE = (rp2.PIO.OUT_HIGH, rp2.PIO.OUT_LOW)
+sync_program = rp2.asm_pio(
+    set_init=IDLE[MODE.hsync_positive],
+    out_init=IDLE[MODE.vsync_positive],
     out_shiftdir=rp2.PIO.SHIFT_RIGHT,
-)
-def vsync_program():
-    # Output high for visible area plus front porch
-    set(pins, 1)                           # VSYNC high during visible and front porch
-    mov(x, osr)                            # Load X with visible + front porch count
-    label("vsync_high")
-    jmp(x_dec, "vsync_high")               # Stay high for X cycles
-    
-    # Output low for sync pulse
-    set(pins, 0)                           # VSYNC low during sync pulse
-    mov(x, isr)                            # Load X with sync pulse count
-    label("vsync_low")
-    jmp(x_dec, "vsync_low")                # Stay low for X cycles
-    
-    # Output high for back porch
-    set(pins, 1)                           # VSYNC high during back porch
-    mov(x, osr)                            # Load X with back porch count
-    label("vsync_backporch")
-    jmp(x_dec, "vsync_backporch")          # Stay high for X cycles
-
-# Define PIO program for RGB pixel data
-@rp2.asm_pio(
-    set_init=rp2.PIO.OUT_LOW,
+)(video_pio.sync_program(MODE))
+
+# RGB program: one line of pixels each time the sync program raises irq 4
+rgb_program = rp2.asm_pio(
+    out_init=(rp2.PIO.OUT_LOW,) * 8,
     autopull=True,
     pull_thresh=32,
     out_shiftdir=rp2.PIO.SHIFT_RIGHT,
     fifo_join=rp2.PIO.JOIN_TX,
-)
-def rgb_program():
-    # Output pixel data
-    out(pins, 8)                          # Output 8 bits of RGB data
+)(video_pio.rgb_program(PIXEL_REPEAT))
 
 # Initialize pixel clock
 pwm = PWM(pixel_clock)
-pwm.freq(25_175_000 // CLOCK_DIV)  # Set pixel clock frequency
+pwm.freq(PIXEL_CLOCK)             # Set pixel clock frequency
 pwm.duty_u16(32768)               # 50% duty cycle
 
-# Initialize state machines
-sm_hsync = rp2.StateMachine(0, hsync_program, freq=25_175_000, set_base=hsync)
-sm_vsync = rp2.StateMachine(1, vsync_program, freq=25_175_000 // H_TOTAL, set_base=vsync)
-sm_rgb = rp2.StateMachine(2, rgb_program, freq=25_175_000, out_base=red_pins[0])
+# Initialize state machines (same PIO block, so they share IRQ flags)
+SYNC_SM = 0
+RGB_SM = 1
+sm_sync = rp2.StateMachine(SYNC_SM, sync_program, freq=PIXEL_CLOCK,
+                           set_base=hsync, out_base=vsync)
+sm_rgb = rp2.StateMachine(RGB_SM, rgb_program, freq=RGB_FREQ, out_base=red_pins[0])
 
-# HSYNC timing (visible + front porch, sync pulse, back porch)
-hsync_visible_front = WIDTH + H_FRONT_PORCH - 1
-hsync_sync = H_SYNC_PULSE - 1
-hsync_back = H_BACK_PORCH - 1
+# Console shown in 'text' mode; other code can call console.write()
+console = TextConsole() if DISPLAY_MODE == 'text' else None
+# Front/back buffers when DOUBLE_BUFFER is set: draw into display.back(),
+# then display.present()
+display = None
 
-# VSYNC timing (visible + front porch, sync pulse, back porch)
-vsync_visible_front = HEIGHT + V_FRONT_PORCH - 1
-vsync_sync = V_SYNC_PULSE - 1
-vsync_back = V_BACK_PORCH - 1
+# Colour bars: white, yellow, cyan, green, magenta, red, blue
+BAR_COLORS = [0xFF, 0xFC, 0xF3, 0xF0, 0xCF, 0xCC, 0x33]
 
 # Create frame buffer (for test pattern)
-def create_test_pattern():
-    """Create a test pattern with color bars"""
-    buffer = []
-    for y in range(HEIGHT):
-        row = []
-        for x in range(WIDTH):
-            # Create color bars
-            if x < WIDTH // 7:
-                # White
-                color = 0xFF
-            elif x < 2 * WIDTH // 7:
-                # Yellow
-                color = 0xFC
-            elif x < 3 * WIDTH // 7:
-                # Cyan
-                color = 0xF3
-            elif x < 4 * WIDTH // 7:
-                # Green
-                color = 0xF0
-            elif x < 5 * WIDTH // 7:
-                # Magenta
-                color = 0xCF
-            elif x < 6 * WIDTH // 7:
-                # Red
-                color = 0xCC
-            else:
-                # Blue
-                color = 0x33
-            row.append(color)
-        buffer.append(row)
-    return buffer
+def create_test_pattern(fb):
+    """Draw colour bars into a framebuffer from framebuffer.py"""
+    for i, color in enumerate(BAR_COLORS):
+        if fb.palette is not None:
+            # Palette modes draw with indexes
+            fb.palette.set(i, color)
+            color = i
+        x0 = i * fb.width // len(BAR_COLORS)
+        x1 = (i + 1) * fb.width // len(BAR_COLORS)
+        fb.fill_rect(x0, 0, x1 - x0, fb.height, color)
+    return fb
+
+def animate_test_pattern(fb, frame):
+    """Colour bars with a black square moving across them"""
+    create_test_pattern(fb)
+    size = fb.height // 10
+    x = frame * 2 % (fb.width - size)
+    fb.fill_rect(x, (fb.height - size) // 2, size, size, 0x00)
 
 # Start state machines
 def start_display():
-    # Put timing values into TX FIFOs
-    sm_hsync.put(hsync_visible_front)
-    sm_hsync.put(hsync_sync)
-    sm_hsync.put(hsync_back)
+    global display
+    expanded = None
+    # Line counts and VSYNC pattern for the sync program, pixels per line for RGB
+    video_pio.load_sync(sm_sync, MODE)
+    video_pio.load_rgb(sm_rgb, WIDTH // PIXEL_REPEAT)
     
-    sm_vsync.put(vsync_visible_front)
-    sm_vsync.put(vsync_sync)
-    sm_vsync.put(vsync_back)
+    # Allocate and draw everything before the state machines start
+    if console is not None:
+        # Only text rows that changed are redrawn into the frame
+        fb = create_framebuffer('full', WIDTH, HEIGHT)
+        console.write("Pico DPI console\n")
+    elif DOUBLE_BUFFER:
+        display = DoubleBuffer(create_framebuffer(DISPLAY_MODE, WIDTH, HEIGHT),
+                               create_framebuffer(DISPLAY_MODE, WIDTH, HEIGHT))
+        fb = display.shown()
+        animate_test_pattern(fb, 0)
+    else:
+        # Palette and tile modes are expanded into a streamable frame once
+        # per change, never inside the pixel deadline
+        drawn, fb, expanded = streamed_framebuffer(DISPLAY_MODE, WIDTH, HEIGHT)
+        create_test_pattern(drawn)
+        if expanded is not None:
+            expanded.refresh()
     
-    # Start state machines
-    sm_hsync.active(1)
-    sm_vsync.active(1)
-    sm_rgb.active(1)
+    # Stream whole scanlines: chained DMA if available, else one put() per line
+    feeder = make_feeder(sm_rgb, RGB_SM, fb.words_per_line)
     
-    # Create test pattern
-    framebuffer = create_test_pattern()
+    def start_frame(table):
+        # Call in vertical blanking. The RGB machine takes line irqs even
+        # with no pixels queued, so it is put back to waiting for line 0
+        # first: after the first frame, a skipped one or a late start it
+        # would be stalled inside a line, and otherwise it is already there.
+        video_pio.rearm_rgb(sm_rgb, RGB_SM)
+        feeder.send(table)
     
-    # Send pixel data forever
+    if display is not None:
+        # One line table per buffer, built once; a swap only picks the other table
+        tables = [feeder.prepare(b.frame, b.height, b.line_repeat) for b in display.buffers]
+        
+        def on_blank(sm):
+            # Take a pending swap and start the next frame. If the last frame
+            # is still streaming the swap stays pending, so the drawer is
+            # never handed the buffer on screen.
+            if feeder.busy():
+                return
+            start_frame(tables[display.vblank()])
+        sm_sync.irq(on_blank)
+        
+        # Start both state machines on the same cycle; the first blanking
+        # IRQ starts frame 0
+        video_pio.start_together((SYNC_SM, RGB_SM))
+        
+        # Drawing runs while the DMA scans out the front buffer
+        frame = 0
+        while True:
+            frame += 1
+            animate_test_pattern(display.back(), frame)
+            display.present()
+    
+    lines = feeder.prepare(fb.frame, fb.height, fb.line_repeat)
+    
+    def on_blank(sm):
+        # Every frame starts here. Without DMA the handler put()s the whole
+        # frame, and the main loop only runs in vertical blanking.
+        if not feeder.busy():
+            start_frame(lines)
+    sm_sync.irq(on_blank)
+    video_pio.start_together((SYNC_SM, RGB_SM))
+    
+    # Redraw changed text rows or tiles while the frames stream
     while True:
-        for y in range(HEIGHT):
-            for x in range(WIDTH):
-                sm_rgb.put(framebuffer[y][x])
-            # Wait for HSYNC to complete before starting next line
-            time.sleep_us(10)
+        if console is not None:
+            console.update(fb)
+        elif expanded is not None:
+            expanded.refresh()
 
 # Hardware interface info
 def print_connection_instructions():
@@ -206,6 +246,8 @@ def print_connection_instructions():
     print(f"VSYNC: GPIO{VSYNC_PIN}")
     print(f"PCLK:  GPIO{CLOCK_PIN}")
     print()
+    print(f"Mode {MODE.name}: {TIMING}")
+    print()
     print("You'll need an adapter board like a DPI-to-HDMI converter.")
     print("Suitable options include:")
     print("  - Adafruit DPI TFT Kippah")
@@ -0,0 +1,233 @@
+"""
+Host-side Keymap Blob Compiler
+==============================
+Run this on your computer (CPython), not on the Pico.
+
+Reads the keyboard_config.json written by the layout editor and produces:
+  kmk_keymap.bin - every layout as rows*cols bytes of HID keycodes
+  kmk_keymap.py  - a tiny loader that reads the blob at boot
+
+Parsing and attribute-resolving a generated `KC.NAME` source file on every
+boot is slow on the Pico. The loader only has to read a few hundred bytes.
+It imports kmk.keys only when a KMK keymap is requested, and then resolves
+each distinct keycode once. Both the flat-list layouts of keymap_store.py and
+older "(r, c)" dict layouts are accepted, and a keyboard_config.jnl journal
+next to the config is replayed first.
+
+Usage:
+  python keymap_blob.py keyboard_config.json
+  python keymap_blob.py keyboard_config.json -o build/ --benchmark
+"""
+
+import argparse
+import json
+import os
+import struct
+import sys
+import time
+import tracemalloc
+from keymap_store import KeymapStore
+from config_journal import ConfigJournal, config_to_json
+
+BLOB_MAGIC = b'KMB1'
+# magic, rows, cols, layout count, index of the current layout
+HEADER_FORMAT = '<4sBBBB'
+
+# HID usage ID -> KMK key name, for every key the layout editor can assign
+HID_NAMES = {code: chr(ord('A') + code - 4) for code in range(4, 30)}
+HID_NAMES.update({code: f'N{(code - 29) % 10}' for code in range(30, 40)})
+HID_NAMES.update({code: f'F{code - 57}' for code in range(58, 70)})
+HID_NAMES.update({code: f'P{(code - 88) % 10}' for code in range(89, 99)})
+HID_NAMES.update({
+    40: 'ENT', 41: 'ESC', 42: 'BSPC', 43: 'TAB', 44: 'SPC', 45: 'MINS',
+    46: 'EQL', 47: 'LBRC', 48: 'RBRC', 49: 'BSLS', 50: 'NUHS', 51: 'SCLN',
+    52: 'QUOT', 53: 'GRV', 54: 'COMM', 55: 'DOT', 56: 'SLSH', 57: 'CAPS',
+    70: 'PSCR', 71: 'SLCK', 72: 'PAUS', 73: 'INS', 74: 'HOME', 75: 'PGUP',
+    76: 'DEL', 77: 'END', 78: 'PGDN', 79: 'RGHT', 80: 'LEFT', 81: 'DOWN',
+    82: 'UP', 83: 'NLCK', 84: 'PSLS', 85: 'PAST', 86: 'PMNS', 87: 'PPLS',
+    88: 'PENT', 99: 'PDOT', 100: 'NUBS', 101: 'APP',
+    135: 'INT1', 136: 'INT2', 137: 'INT3',
+    224: 'LCTL', 225: 'LSFT', 226: 'LALT', 227: 'LGUI',
+    228: 'RCTL', 229: 'RSFT', 230: 'RALT', 231: 'RGUI',
+})
+
+LOADER_TEMPLATE = '''# KMK Keymap Loader - Generated by keymap_blob.py
+# Reads {blob_name} at boot; kmk.keys is only imported by kmk_keymap()
+
+BLOB = '/{blob_name}'
+
+# KMK names of the keycodes used in the blob
+NAMES = {names}
+
+def load_keymap(path=BLOB):
+    """Return (rows, cols, current_layout, {{name: keycode bytes}})"""
+    with open(path, 'rb') as f:
+        return parse_blob(f.read())
+
+def parse_blob(data):
+    """Split blob bytes into the same tuple as load_keymap()"""
+    if data[:4] != b'KMB1':
+        raise ValueError('Not a keymap blob')
+    rows, cols, count, current = data[4], data[5], data[6], data[7]
+    size = rows * cols
+    layouts = {{}}
+    names = []
+    pos = 8
+    for _ in range(count):
+        length = data[pos]
+        name = data[pos + 1:pos + 1 + length].decode()
+        pos += 1 + length
+        layouts[name] = data[pos:pos + size]
+        names.append(name)
+        pos += size
+    return rows, cols, names[current], layouts
+
+def kmk_keymap(layout=None, path=BLOB):
+    """Build a one-layer KMK keymap, resolving each distinct keycode once"""
+    from kmk.keys import KC
+    rows, cols, current, layouts = load_keymap(path)
+    codes = layouts[layout or current]
+    keys = {{0: KC.NO}}
+    layer = []
+    for code in codes:
+        key = keys.get(code)
+        if key is None:
+            key = getattr(KC, NAMES.get(code, 'NO'))
+            keys[code] = key
+        layer.append(key)
+    return [layer]
+'''
+
+def load_layouts(config):
+    """Return {name: KeymapStore} for the saved layouts (list or legacy dict form)"""
+    return {name: KeymapStore.from_data(data)
+            for name, data in config['layouts'].items()}
+
+def matrix_size(config, layouts):
+    """Matrix dimensions from the configured pins, grown to fit any mapped key"""
+    rows = len(config.get('row_pins', []))
+    cols = len(config.get('col_pins', []))
+    for store in layouts.values():
+        store_rows, store_cols = store.size()
+        rows = max(rows, store_rows)
+        cols = max(cols, store_cols)
+    return rows, cols
+
+def build_blob(config):
+    """Pack all layouts of a config into the binary blob format"""
+    layouts = load_layouts(config)
+    rows, cols = matrix_size(config, layouts)
+    if rows > 255 or cols > 255:
+        raise ValueError(f"Matrix {rows}x{cols} is too large for the blob format")
+    names = list(layouts)
+    current = config.get('current_layout', names[0])
+    current_index = names.index(current) if current in names else 0
+
+    blob = bytearray(struct.pack(HEADER_FORMAT, BLOB_MAGIC, rows, cols,
+                                 len(names), current_index))
+    for name in names:
+        encoded = name.encode()
+        blob.append(len(encoded))
+        blob += encoded
+        codes = bytearray(rows * cols)
+        for r, c, keycode in layouts[name].items():
+            codes[r * cols + c] = keycode
+        blob += codes
+    return bytes(blob)
+
+def build_loader(config, blob_name):
+    """Generate the loader source with the name table for the codes in use"""
+    used = set()
+    for store in load_layouts(config).values():
+        used.update(keycode for _, _, keycode in store.items())
+    used = sorted(used & set(HID_NAMES))
+    names = '{' + ', '.join(f"{code}: '{HID_NAMES[code]}'" for code in used) + '}'
+    return LOADER_TEMPLATE.format(blob_name=blob_name, names=names)
+
+def build_source(config):
+    """Generate the equivalent KC.NAME source text (what the editor exports)"""
+    layouts = load_layouts(config)
+    rows, cols = matrix_size(config, layouts)
+    layout_name = config.get('current_layout', 'default')
+    matrix = [["KC.NO"] * cols for _ in range(rows)]
+    for r, c, keycode in layouts[layout_name].items():
+        matrix[r][c] = f"KC.{HID_NAMES.get(keycode, 'NO')}"
+    lines = ["from kmk.keys import KC", "KEYMAP = ["]
+    lines += [f"    [{', '.join(row)}]," for row in matrix]
+    lines.append("]")
+    return "\n".join(lines) + "\n"
+
+class LazyKC:
+    """Stand-in for kmk.keys.KC: resolves names on first attribute access"""
+    def __getattr__(self, name):
+        key = ('key', name)
+        setattr(self, name, key)
+        return key
+
+def measure(label, func, repeat=200):
+    tracemalloc.start()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    elapsed = (time.perf_counter() - start) / repeat
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"  {label:12} {elapsed * 1e6:8.1f} us per load, {peak:7d} bytes peak")
+
+def benchmark(config, blob, loader_source):
+    """Compare loading the KC.NAME source text against the binary blob"""
+    source = build_source(config)
+    print(f"Source keymap: {len(source)} bytes, blob: {len(blob)} bytes")
+
+    def load_source():
+        namespace = {}
+        code = compile(source.replace("from kmk.keys import KC\n", ""),
+                       'kmk_keymap.py', 'exec')
+        exec(code, {'KC': LazyKC()}, namespace)
+        return namespace['KEYMAP']
+
+    loader = {}
+    exec(loader_source, loader)
+    parse_blob = loader['parse_blob']
+
+    def load_blob():
+        return parse_blob(blob)
+
+    measure('source text', load_source)
+    measure('binary blob', load_blob)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('config', help='keyboard_config.json from the layout editor')
+    parser.add_argument('-o', '--output', default='.', help='output directory')
+    parser.add_argument('--name', default='kmk_keymap', help='base name of the output files')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='compare load time and memory against the source-text keymap')
+    args = parser.parse_args(argv)
+
+    # Snapshot plus any journal the editor has not compacted yet
+    with open(args.config) as f:
+        json.load(f)  # fail early on a missing or broken snapshot
+    journal_path = os.path.splitext(args.config)[0] + '.jnl'
+    config = config_to_json(ConfigJournal(args.config, journal_path).load({}))
+
+    blob = build_blob(config)
+    blob_name = args.name + '.bin'
+    loader = build_loader(config, blob_name)
+
+    os.makedirs(args.output, exist_ok=True)
+    with open(os.path.join(args.output, blob_name), 'wb') as f:
+        f.write(blob)
+    with open(os.path.join(args.output, args.name + '.py'), 'w') as f:
+        f.write(loader)
+
+    rows, cols = matrix_size(config, load_layouts(config))
+    print(f"Wrote {blob_name} ({len(blob)} bytes, {len(config['layouts'])} layouts, "
+          f"{rows}x{cols} matrix) and {args.name}.py")
+
+    if args.benchmark:
+        benchmark(config, blob, loader)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
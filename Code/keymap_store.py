@@ -0,0 +1,100 @@
+"""
+Keymap Store
+============
+Holds one keyboard layout with matrix positions packed into integers
+(row << 8 | col), so nothing has to eval() position strings after a JSON
+round-trip. The matrix size grows as keys are added, so exports do not have
+to search for it.
+
+Layouts are saved as a flat list [pos, keycode, pos, keycode, ...]. Older
+configs that use {"(r, c)": keycode} dicts are still accepted when loading.
+Pure Python: used by the layout editor on the Pico and by keymap_blob.py on
+the host.
+"""
+
+def pack_position(row, col):
+    return (row << 8) | col
+
+def unpack_position(pos):
+    return pos >> 8, pos & 0xFF
+
+def parse_position(pos):
+    """Parse a legacy "(r, c)" position string without eval()"""
+    r, c = pos.strip('()[] ').split(',')
+    return int(r), int(c)
+
+class KeymapStore:
+    """Maps packed matrix positions to keycodes for one layout"""
+    def __init__(self):
+        self.keys = {}
+        self.rows = 0
+        self.cols = 0
+        self.size_stale = False
+
+    @classmethod
+    def from_data(cls, data):
+        """Build a store from a saved list or a legacy position dict"""
+        store = cls()
+        if isinstance(data, dict):
+            for pos_str, keycode in data.items():
+                r, c = parse_position(pos_str)
+                store.set(r, c, keycode)
+        else:
+            for i in range(0, len(data), 2):
+                r, c = unpack_position(data[i])
+                store.set(r, c, data[i + 1])
+        return store
+
+    def __len__(self):
+        return len(self.keys)
+
+    def set(self, row, col, keycode):
+        self.keys[pack_position(row, col)] = keycode
+        if row >= self.rows:
+            self.rows = row + 1
+        if col >= self.cols:
+            self.cols = col + 1
+
+    def get(self, row, col, default=None):
+        return self.keys.get(pack_position(row, col), default)
+
+    def remove(self, row, col):
+        if self.keys.pop(pack_position(row, col), None) is not None:
+            # Only shrink the matrix size when someone asks for it
+            self.size_stale = True
+
+    def size(self):
+        """Return (rows, cols) covering every mapped key"""
+        if self.size_stale:
+            self.rows = 0
+            self.cols = 0
+            for pos in self.keys:
+                r, c = unpack_position(pos)
+                if r >= self.rows:
+                    self.rows = r + 1
+                if c >= self.cols:
+                    self.cols = c + 1
+            self.size_stale = False
+        return self.rows, self.cols
+
+    def items(self):
+        """Yield (row, col, keycode) for every mapped key"""
+        for pos, keycode in self.keys.items():
+            r, c = unpack_position(pos)
+            yield r, c, keycode
+
+    def to_matrix(self, empty=0):
+        """Return the layout as a list of rows, unmapped keys set to empty"""
+        rows, cols = self.size()
+        matrix = [[empty] * cols for _ in range(rows)]
+        for pos, keycode in self.keys.items():
+            matrix[pos >> 8][pos & 0xFF] = keycode
+        return matrix
+
+    def to_list(self):
+        """Serialize as a flat [pos, keycode, ...] list"""
+        data = []
+        for pos, keycode in self.keys.items():
+            data.append(pos)
+            data.append(keycode)
+        return data
@@ -9,6 +9,10 @@ Instructions:
 2. Run this tool to interactively map each key
 3. Save your custom layout
 4. Test your layout in real-time
+
+The test command types through an N-key-rollover keyboard when boot.py has
+enabled one (see nkro_keyboard.py), so every key of the matrix can be held at
+once; otherwise it falls back to the 6-key boot keyboard.
 """
 
 import board
@@ -18,6 +22,9 @@ import usb_hid
 import usb_cdc
 import storage
 import json
+from keymap_store import KeymapStore
+from config_journal import ConfigJournal
+from nkro_keyboard import NKROKeyboard, find_nkro_device
 from adafruit_hid.keyboard import Keyboard
 from adafruit_hid.keycode import Keycode
 from adafruit_hid.keyboard_layout_us import KeyboardLayoutUS
@@ -29,6 +36,11 @@ layout = KeyboardLayoutUS(kbd)
 # Set up serial for interaction
 serial = usb_cdc.console
 
+# Config persistence: snapshot plus an append-only journal of key mappings
+journal = ConfigJournal('/keyboard_config.json', '/keyboard_config.jnl')
+# Set once the editor has taken the flash away from the USB drive
+usb_drive_disabled = False
+
 # Key name to keycode mapping
 KEYCODE_MAP = {
     # Basic keys
@@ -114,16 +126,13 @@ DEFAULT_CONFIG = {
     "col_pins": [6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17],  # GP6-GP17
     "current_layout": "default",
     "layouts": {
-        "default": {
-            # (row, col): keycode
-            # This will be populated based on matrix testing
-        },
-        "us_qwerty": {
-            # Predefined US QWERTY layout - will be populated in init_default_layouts
-        },
-        "uk": {
-            # Predefined UK layout - will be populated in init_default_layouts
-        }
+        # Saved as flat [row << 8 | col, keycode, ...] lists, see keymap_store.py
+        # "default" will be populated based on matrix testing
+        "default": [],
+        # Predefined US QWERTY layout - will be populated in init_default_layouts
+        "us_qwerty": [],
+        # Predefined UK layout - will be populated in init_default_layouts
+        "uk": []
     }
 }
 
@@ -131,39 +140,69 @@ def init_default_layouts(config):
     """Initialize predefined layouts if they don't exist"""
     if "us_qwerty" not in config["layouts"] or not config["layouts"]["us_qwerty"]:
         # This is a simplified layout - actual mapping would depend on the physical matrix
-        config["layouts"]["us_qwerty"] = {}
+        config["layouts"]["us_qwerty"] = KeymapStore()
     
     if "uk" not in config["layouts"] or not config["layouts"]["uk"]:
         # This is a simplified layout - actual mapping would depend on the physical matrix
-        config["layouts"]["uk"] = {}
+        config["layouts"]["uk"] = KeymapStore()
     
     return config
 
 def load_config():
-    """Load the keyboard configuration from file"""
+    """Load the keyboard configuration (snapshot plus journal) from file"""
     try:
-        with open('/keyboard_config.json', 'r') as f:
-            config = json.load(f)
-            return init_default_layouts(config)
-    except:
-        return init_default_layouts(DEFAULT_CONFIG.copy())
+        config = journal.load(DEFAULT_CONFIG)
+    except Exception as e:
+        print(f"Error loading configuration: {e}")
+        config = journal.load_default(DEFAULT_CONFIG)
+    return init_default_layouts(config)
+
+def map_key(config, row, col, keycode):
+    """Assign a keycode to a matrix position in the current layout"""
+    layout_name = config.get("current_layout", "default")
+    journal.set_key(config, layout_name, row, col, keycode)
 
 def save_config(config):
-    """Save the keyboard configuration to file"""
-    # Temporarily disable USB drive to allow writing
-    storage.disable_usb_drive()
+    """Save the keyboard configuration to file
+    
+    Only the journal of changes is appended. The full snapshot and the KMK
+    keymap file are rewritten when the journal is compacted, and the KMK
+    file also on export and on exit. Returns True if the KMK file was
+    rebuilt.
+    """
+    writable_flash()
     try:
-        with open('/keyboard_config.json', 'w') as f:
-            json.dump(config, f, indent=2)
+        if journal.save(config):
+            print("Configuration saved successfully (snapshot compacted).")
+            generate_kmk_layout(config)
+            return True
         print("Configuration saved successfully.")
-        
-        # Also generate KMK-compatible keymap file
-        generate_kmk_layout(config)
     except Exception as e:
         print(f"Error saving configuration: {e}")
-    finally:
-        # Re-enable USB drive
+    return False
+
+def writable_flash():
+    """Disable the USB drive before the first write of the session; it
+    stays off until exit_editor() instead of being toggled on every save"""
+    global usb_drive_disabled
+    if not usb_drive_disabled:
+        storage.disable_usb_drive()
+        usb_drive_disabled = True
+
+def export_config(config):
+    """Rebuild the KMK keymap file from the current layout"""
+    writable_flash()
+    generate_kmk_layout(config)
+
+def exit_editor(config):
+    """Save, rebuild the KMK keymap so the keyboard firmware boots the
+    current layout, and give the flash back to the USB drive"""
+    global usb_drive_disabled
+    if not save_config(config):
+        generate_kmk_layout(config)
+    if usb_drive_disabled:
         storage.enable_usb_drive()
+        usb_drive_disabled = False
 
 def generate_kmk_layout(config):
     """Generate a KMK-compatible keymap file from the config"""
@@ -174,21 +213,8 @@ def generate_kmk_layout(config):
         
         layout = config["layouts"][layout_name]
         
-        # Find matrix dimensions
-        max_row = max([r for r, _ in layout.keys()]) if layout else 0
-        max_col = max([c for _, c in layout.keys()]) if layout else 0
-        
-        # Create a template matrix filled with KC.NO (no key)
-        matrix = [["KC.NO" for _ in range(max_col + 1)] for _ in range(max_row + 1)]
-        
-        # Fill in the key mapping
-        for pos_str, keycode in layout.items():
-            # Convert string position "(r,c)" to integers
-            pos = eval(pos_str)
-            r, c = pos
-            
-            key_name = KEYCODE_NAMES.get(keycode, "NO")
-            matrix[r][c] = f"KC.{key_name}"
+        # Matrix of keycodes sized to the mapped keys, 0 where unmapped
+        matrix = layout.to_matrix()
         
         # Generate the Python code
         with open('/kmk_keymap.py', 'w') as f:
@@ -198,7 +224,7 @@ def generate_kmk_layout(config):
             f.write("KEYMAP = [\n")
             
             for row in matrix:
-                row_str = ", ".join(row)
+                row_str = ", ".join(f"KC.{KEYCODE_NAMES.get(keycode, 'NO')}" for keycode in row)
                 f.write(f"    [{row_str}],\n")
             
             f.write("]\n")
@@ -207,6 +233,16 @@ def generate_kmk_layout(config):
     except Exception as e:
         print(f"Error generating KMK layout: {e}")
 
+def view_layout(config):
+    """Print the current layout as a grid of key names"""
+    layout_name = config.get("current_layout", "default")
+    layout = config["layouts"][layout_name]
+    rows, cols = layout.size()
+    print(f"Layout: {layout_name} ({len(layout)} keys, {rows}x{cols} matrix)")
+    for r, row in enumerate(layout.to_matrix()):
+        names = [KEYCODE_NAMES.get(keycode, "--") if keycode else "--" for keycode in row]
+        print(f"R{r:<2} " + " ".join(f"{name:>6}" for name in names))
+
 def setup_matrix(config):
     """Set up the keyboard matrix based on configuration"""
     row_pins = []
@@ -268,3 +304,45 @@ def scan_matrix(row_pins, col_pins):
         row_pin.pull = orig_pull
     
     return pressed_keys
+
+def test_layout(config, nkro=True):
+    """Type with the current layout until a key is sent on the serial console"""
+    layout = config["layouts"][config.get("current_layout", "default")]
+    device = find_nkro_device(usb_hid.devices) if nkro else None
+    if device is not None:
+        keyboard = NKROKeyboard(device)
+        print("Testing layout with NKRO reports; press Enter on the console to stop")
+    else:
+        keyboard = None
+        print("Testing layout with the 6-key keyboard; press Enter on the console to stop")
+    row_pins, col_pins = setup_matrix(config)
+    previous = []
+    try:
+        while not serial.in_waiting:
+            pressed = scan_matrix(row_pins, col_pins)
+            if keyboard is not None:
+                # Only the keys that changed since the last scan touch the bitmap
+                keyboard.update(pressed, layout)
+            else:
+                for r, c in pressed:
+                    if (r, c) not in previous:
+                        keycode = layout.get(r, c)
+                        if keycode:
+                            try:
+                                kbd.press(keycode)
+                            except ValueError:
+                                pass  # more than six keys held
+                for r, c in previous:
+                    if (r, c) not in pressed:
+                        keycode = layout.get(r, c)
+                        if keycode:
+                            kbd.release(keycode)
+            previous = pressed
+            time.sleep(0.001)
+        serial.read(serial.in_waiting)
+    finally:
+        if keyboard is not None:
+            keyboard.release_all()
+        else:
+            kbd.release_all()
+        cleanup_matrix(row_pins, col_pins)
@@ -10,6 +10,13 @@ import board
 import digitalio
 import time
 import usb_cdc
+from matrix_automap import SCRIPTED_KEYS, sweep, bits, automap
+from matrix_analyzer import analyze_pairs, print_analysis, write_matrix_config
+
+try:
+    import memorymap
+except ImportError:
+    memorymap = None
 
 # Define all available GPIO pins on the Pico
 ALL_PINS = [
@@ -29,6 +36,21 @@ PIN_NAMES = [
     "GP27", "GP28"
 ]
 
+# GPIO numbers of ALL_PINS, used as bit positions in whole-port reads
+GPIO_NUMBERS = [
+    0, 1, 2, 3, 4, 5,
+    6, 7, 8, 9, 10, 11,
+    12, 13, 14, 15, 16, 17,
+    18, 19, 20, 21, 22, 26,
+    27, 28
+]
+
+# RP2040/RP2350 SIO registers holding the input levels of GPIO0-31 and GPIO32-47
+SIO_GPIO_IN = 0xd0000004
+
+# Seconds to wait for each key during auto-mapping before skipping it
+AUTO_KEY_TIMEOUT = 10
+
 # Set up serial port for output
 serial = usb_cdc.console
 
@@ -42,6 +64,40 @@ def setup_pins():
         pin_ios.append(io)
     return pin_ios
 
+class GPIOPort:
+    """Drives single pins and reads all of them at once through the SIO block"""
+    def __init__(self, pin_ios, gpios=GPIO_NUMBERS):
+        self.ios = pin_ios
+        self.gpios = gpios
+        self.index = {gpio: i for i, gpio in enumerate(gpios)}
+        self.mask = 0
+        for gpio in gpios:
+            self.mask |= 1 << gpio
+        # Whole-port reads need memorymap; otherwise fall back to one read per pin
+        self.sio = None
+        if memorymap is not None:
+            self.sio = memorymap.AddressRange(start=SIO_GPIO_IN, length=8)
+    
+    def drive_low(self, gpio):
+        io = self.ios[self.index[gpio]]
+        io.direction = digitalio.Direction.OUTPUT
+        io.value = False
+    
+    def release(self, gpio):
+        io = self.ios[self.index[gpio]]
+        io.direction = digitalio.Direction.INPUT
+        io.pull = digitalio.Pull.UP
+    
+    def read(self):
+        """Return the level of every pin as a bitmask indexed by GPIO number"""
+        if self.sio is not None:
+            return int.from_bytes(self.sio[0:8], 'little') & self.mask
+        levels = 0
+        for gpio, io in zip(self.gpios, self.ios):
+            if io.value:
+                levels |= 1 << gpio
+        return levels
+
 def test_direct_connections():
     """
     First test: Find direct connections between pins.
@@ -90,28 +146,22 @@ def find_matrix():
     print("Press Ctrl+C to exit when done.\n")
     
     pin_ios = setup_pins()
+    port = GPIOPort(pin_ios)
+    connections = [0] * len(ALL_PINS)
     key_map = {}
     
     try:
         while True:
-            # Check all possible row-column combinations
+            # Drive each pin low in turn and read all the others at once
+            sweep(port, connections)
             for row_idx in range(len(ALL_PINS)):
-                # Set this pin as output low (potential row pin)
-                pin_ios[row_idx].direction = digitalio.Direction.OUTPUT
-                pin_ios[row_idx].value = False
-                
-                # Check all other pins as potential column pins
-                for col_idx in range(len(ALL_PINS)):
-                    if row_idx != col_idx and not pin_ios[col_idx].value:
-                        # Connection detected - key is pressed
-                        connection = (row_idx, col_idx)
-                        if connection not in key_map:
-                            print(f"Key detected: Row={PIN_NAMES[row_idx]}, Column={PIN_NAMES[col_idx]}")
-                            key_map[connection] = True
-                
-                # Reset to input with pull-up
-                pin_ios[row_idx].direction = digitalio.Direction.INPUT
-                pin_ios[row_idx].pull = digitalio.Pull.UP
+                for gpio in bits(connections[row_idx]):
+                    col_idx = port.index[gpio]
+                    # Connection detected - key is pressed
+                    connection = (row_idx, col_idx)
+                    if connection not in key_map:
+                        print(f"Key detected: Row={PIN_NAMES[row_idx]}, Column={PIN_NAMES[col_idx]}")
+                        key_map[connection] = True
             
             time.sleep(0.01)  # Small delay to avoid flooding the console
     
@@ -126,54 +176,60 @@ def find_matrix():
     
     return key_map
 
+def auto_map_matrix(key_names=SCRIPTED_KEYS):
+    """
+    Guided mapping: prompt for each key in key_names and record the pin pair
+    that closes for it.
+    Returns a key map of (pin_idx, pin_idx) -> key name.
+    """
+    print("\nGuided Matrix Mapping")
+    print("=====================")
+    print("Press each key when asked and release it. Keys not pressed within")
+    print(f"{AUTO_KEY_TIMEOUT} seconds are skipped.\n")
+    
+    pin_ios = setup_pins()
+    try:
+        found = automap(GPIOPort(pin_ios), key_names, timeout=AUTO_KEY_TIMEOUT)
+    finally:
+        for io in pin_ios:
+            io.deinit()
+    
+    # Pins are sorted into rows and columns later by analyze_results()
+    key_map = {}
+    for name, (a, b) in found.items():
+        key_map[(GPIO_NUMBERS.index(a), GPIO_NUMBERS.index(b))] = name
+    return key_map
+
 def analyze_results(key_map):
-    """Analyze the results to determine the actual matrix size"""
+    """
+    Work out the row and column pins from the observed pin pairs.
+    Returns a MatrixAnalysis, or None if no keys were detected.
+    """
     if not key_map:
         print("No keys detected. Check your connections and try again.")
-        return
-    
-    # Find all unique row and column pins used
-    rows = set()
-    cols = set()
-    for row, col in key_map.keys():
-        rows.add(row)
-        cols.add(col)
+        return None
     
-    print("\nAnalysis Results:")
-    print(f"Found {len(rows)} possible row pins: {', '.join(PIN_NAMES[r] for r in sorted(rows))}")
-    print(f"Found {len(cols)} possible column pins: {', '.join(PIN_NAMES[c] for c in sorted(cols))}")
-    print(f"Total keys detected: {len(key_map)}")
+    # The analyzer works on GPIO numbers so it is not tied to ALL_PINS
+    pairs = {}
+    for (a, b), name in key_map.items():
+        pairs[(GPIO_NUMBERS[a], GPIO_NUMBERS[b])] = name
+    analysis = analyze_pairs(pairs)
+    print_analysis(analysis)
     
     print("\nSuggested matrix definition for your code:")
-    print(f"ROW_PINS = [{', '.join('board.' + PIN_NAMES[r] for r in sorted(rows))}]")
-    print(f"COL_PINS = [{', '.join('board.' + PIN_NAMES[c] for c in sorted(cols))}]")
+    print(f"ROW_PINS = [{', '.join(f'board.GP{r}' for r in analysis.rows)}]")
+    print(f"COL_PINS = [{', '.join(f'board.GP{c}' for c in analysis.cols)}]")
+    return analysis
 
-def save_matrix_to_file(key_map):
+def save_matrix_to_file(analysis):
     """Save the detected matrix to a file for later use"""
-    if not key_map:
+    if analysis is None:
         return
     
-    # Find all unique row and column pins used
-    rows = sorted(list(set(row for row, _ in key_map.keys())))
-    cols = sorted(list(set(col for _, col in key_map.keys())))
-    
     try:
-        with open('/matrix_config.py', 'w') as f:
-            f.write("# Keyboard Matrix Configuration\n")
-            f.write("# Generated by Keyboard Matrix Mapper\n\n")
-            f.write("# Row pins\n")
-            f.write(f"ROW_PINS = [{', '.join('board.' + PIN_NAMES[r] for r in rows)}]\n\n")
-            f.write("# Column pins\n")
-            f.write(f"COL_PINS = [{', '.join('board.' + PIN_NAMES[c] for c in cols)}]\n\n")
-            f.write("# Key matrix mapping\n")
-            f.write("KEY_MATRIX = {\n")
-            for row_idx, row in enumerate(rows):
-                for col_idx, col in enumerate(cols):
-                    if (row, col) in key_map:
-                        f.write(f"    ({row_idx}, {col_idx}): 'KEY',  # {PIN_NAMES[row]} - {PIN_NAMES[col]}\n")
-            f.write("}\n")
-        print("\nMatrix configuration saved to 'matrix_config.py'")
-    except:
+        write_matrix_config(analysis, '/matrix_config.py')
+        print(f"\nMatrix configuration saved to 'matrix_config.py' ({len(analysis.keys)} keys)")
+    except OSError:
         print("\nFailed to save configuration file.")
 
 def main():
@@ -185,16 +241,20 @@ def main():
     # First test for direct connections
     connections = test_direct_connections()
     
-    input("\nPress Enter to start matrix mapping...")
+    mode = input("\nType 'auto' for guided mapping, or press Enter for free mapping: ")
     
-    # Find the matrix by having the user press keys
-    key_map = find_matrix()
+    if mode.strip().lower() == 'auto':
+        # Prompt for each key and assign rows/columns automatically
+        key_map = auto_map_matrix()
+    else:
+        # Find the matrix by having the user press keys
+        key_map = find_matrix()
     
     # Analyze and display results
-    analyze_results(key_map)
+    analysis = analyze_results(key_map)
     
     # Save the matrix to a file
-    save_matrix_to_file(key_map)
+    save_matrix_to_file(analysis)
     
     print("\nMapping complete!")
 
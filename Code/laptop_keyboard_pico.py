@@ -8,6 +8,8 @@ laptop keyboard controller that can handle multiple keyboard layouts.
 import board
 import digitalio
 import storage
+import time
+from array import array
 import supervisor
 import usb_hid
 from kmk.kmk_keyboard import KMKKeyboard
@@ -137,17 +139,67 @@ def blink_onboard_led(times):
 
 # --- Define a key combination to switch layouts ---
 def cycle_layout():
-    global current_layout_index
+    global current_layout_index, active_layout
     current_layout_index = (current_layout_index + 1) % len(LAYOUTS)
     save_layout_preference()
     blink_onboard_led(current_layout_index + 1)
-    keyboard.keymap = LAYOUTS[current_layout_index]
+    # Layouts are precompiled, so switching is just a reference swap
+    active_layout = COMPILED_LAYOUTS[current_layout_index]
+    keyboard.keymap = COMPILED_KEYMAPS[current_layout_index]
     return []  # Return empty sequence to not output any keys
 
 # Define the layout cycle key (Fn+L in this example)
 # In your actual implementation, you'd need to define the Fn key somewhere in your layout
 LAYOUT_CYCLE = simple_key_sequence(cycle_layout)
 
+# --- Layout compiler ---
+# Each layout is compiled once at startup into a flat array('H') indexed by
+# row * NUM_COLS + col. Entries are indexes into KEY_TABLE, so a lookup is a
+# single index instead of walking the ragged list-of-lists.
+NUM_ROWS = len(ROW_PINS)
+NUM_COLS = len(COL_PINS)
+
+# Keys replaced in every layout at compile time: (row, col) -> key
+LAYOUT_OVERRIDES = {}
+if LAYOUT_SELECT_MODE == 'key_combo':
+    # Replace the right GUI key (bottom row) with the layout cycle key
+    LAYOUT_OVERRIDES[(5, 5)] = LAYOUT_CYCLE
+
+KEY_TABLE = [KC.NO]  # index 0 is "no key"
+key_indexes = {}
+
+def key_index(key):
+    """Return the KEY_TABLE index for key, adding it if needed"""
+    index = key_indexes.get(id(key))
+    if index is None:
+        index = len(KEY_TABLE)
+        KEY_TABLE.append(key)
+        key_indexes[id(key)] = index
+    return index
+
+def compile_layout(layout, overrides=LAYOUT_OVERRIDES):
+    """Compile a list-of-lists layout into a flat array of KEY_TABLE indexes"""
+    table = array('H', [0] * (NUM_ROWS * NUM_COLS))
+    skipped = 0
+    for r, row in enumerate(layout):
+        for c, key in enumerate(row):
+            if r >= NUM_ROWS or c >= NUM_COLS:
+                skipped += 1
+                continue
+            table[r * NUM_COLS + c] = key_index(overrides.get((r, c), key))
+    if skipped:
+        print(f"{skipped} layout keys fall outside the {NUM_ROWS}x{NUM_COLS} matrix")
+    return table
+
+COMPILED_LAYOUTS = [compile_layout(layout) for layout in LAYOUTS]
+# KMK wants a list of layers, each a flat list of keys in matrix order
+COMPILED_KEYMAPS = [[[KEY_TABLE[i] for i in table]] for table in COMPILED_LAYOUTS]
+active_layout = COMPILED_LAYOUTS[current_layout_index]
+
+def key_at(row, col):
+    """Look up the key at a matrix position in the active layout"""
+    return KEY_TABLE[active_layout[row * NUM_COLS + col]]
+
 # --- Matrix debugging helper ---
 def debug_matrix():
     """Function to help map out an unknown keyboard matrix"""
@@ -197,22 +249,15 @@ def main():
     # This helps identify which pins are connected to which key positions
     # debug_matrix()
     
+    global active_layout
+    
     # Setup layout selection 
     setup_layout_selection()
     
-    # Set the initial keyboard layout
-    keyboard.keymap = LAYOUTS[current_layout_index]
-    
-    # If using key combo for layout switching, add it to a specific key position
-    # For example, replace a rarely used key with the LAYOUT_CYCLE function
-    # In this example, we replace the right GUI key
-    if LAYOUT_SELECT_MODE == 'key_combo':
-        for layout in LAYOUTS:
-            # Find the right GUI key and replace it
-            row_idx = 5  # Bottom row in our layouts
-            key_idx = 5  # Assuming this is the right GUI position
-            if row_idx < len(layout) and key_idx < len(layout[row_idx]):
-                layout[row_idx][key_idx] = LAYOUT_CYCLE
+    # Set the initial keyboard layout (the LAYOUT_CYCLE key is already
+    # compiled in, see LAYOUT_OVERRIDES)
+    active_layout = COMPILED_LAYOUTS[current_layout_index]
+    keyboard.keymap = COMPILED_KEYMAPS[current_layout_index]
     
     # Start the keyboard
     keyboard.go()
@@ -0,0 +1,228 @@
+"""
+Keyboard Matrix Analyzer
+========================
+Works out which ribbon pins are rows and which are columns from the pin
+pairs seen while mapping.
+
+The mapper tests both directions, so every pin turns up as both "driven" and
+"read". Instead of trusting the direction, the analyzer builds the graph of
+observed pin pairs. In a matrix every key joins a row to a column, so the
+graph is bipartite and each connected part of it splits into two sides. The
+smaller side of each part becomes the rows. A short, a ghost or a
+direct-wired key breaks that, so each part is split the way that leaves the
+fewest pairs with both pins on one side (ties go to the split that blames
+unnamed pairs rather than named keys). Only those pairs are reported as
+conflicts.
+
+Pins are plain integers (GPIO numbers), so ribbons with 40+ pins on a Pico 2
+work the same way. Run this file with CPython to analyze a simulated
+48-pin ribbon.
+"""
+
+import time
+
+class MatrixAnalysis:
+    """Result of analyze_pairs()"""
+    def __init__(self, rows, cols, keys, conflicts, components):
+        self.rows = rows              # row pins, sorted
+        self.cols = cols              # column pins, sorted
+        self.keys = keys              # [(row_pin, col_pin, label)]
+        self.conflicts = conflicts    # [(pin_a, pin_b, label)] not row/column pairs
+        self.components = components  # separate groups of connected pins
+
+    def positions(self):
+        """Return {(row_index, col_index): label} for every key"""
+        row_index = {pin: i for i, pin in enumerate(self.rows)}
+        col_index = {pin: i for i, pin in enumerate(self.cols)}
+        return {(row_index[r], col_index[c]): label for r, c, label in self.keys}
+
+def split_cost(split, edges):
+    """(pairs on one side, named keys among them) for a pin -> side split"""
+    same = 0
+    named = 0
+    for (a, b), label in edges.items():
+        if split[a] == split[b]:
+            same += 1
+            if label is not True:
+                named += 1
+    return same, named
+
+def grow_split(first, member, neighbours):
+    """Greedy split: walk outward from first, putting each pin on the side
+    that agrees with most of its already placed neighbours, then move single
+    pins across while that removes same-side pairs"""
+    split = {first: 0}
+    queue = [first]
+    while queue:
+        pin = queue.pop(0)
+        for other in neighbours[pin]:
+            if other in split:
+                continue
+            against_zero = sum(1 for n in neighbours[other] if split.get(n) == 0)
+            against_one = sum(1 for n in neighbours[other] if split.get(n) == 1)
+            split[other] = 1 if against_zero >= against_one else 0
+            queue.append(other)
+    moved = True
+    while moved:
+        moved = False
+        for pin in member:
+            same = sum(1 for n in neighbours[pin] if split[n] == split[pin])
+            if same * 2 > len(neighbours[pin]):
+                split[pin] = 1 - split[pin]
+                moved = True
+    return split
+
+def best_split(member, neighbours, edges):
+    """The split of one component with the fewest same-side pairs, trying
+    every pin as the starting point"""
+    pins = set(member)
+    part = {edge: label for edge, label in edges.items() if edge[0] in pins}
+    best = None
+    best_cost = None
+    for first in member:
+        split = grow_split(first, member, neighbours)
+        cost = split_cost(split, part)
+        if best is None or cost < best_cost:
+            best = split
+            best_cost = cost
+            if cost == (0, 0):
+                break  # bipartite: nothing can beat it
+    return best
+
+def analyze_pairs(pairs):
+    """Partition pins into rows and columns
+
+    pairs maps (pin_a, pin_b) to a label (a key name, or True when unknown).
+    Both directions of a pair may be present; they count as one key.
+    """
+    edges = {}
+    for (a, b), label in pairs.items():
+        if a == b:
+            continue
+        edge = (a, b) if a < b else (b, a)
+        if edge not in edges or edges[edge] is True:
+            edges[edge] = label
+
+    neighbours = {}
+    for a, b in edges:
+        neighbours.setdefault(a, []).append(b)
+        neighbours.setdefault(b, []).append(a)
+
+    # Split each connected component, then put its smaller side on rows
+    side = {}
+    components = 0
+    for start in sorted(neighbours):
+        if start in side:
+            continue
+        components += 1
+        member = [start]
+        queue = [start]
+        seen = {start}
+        while queue:
+            pin = queue.pop()
+            for other in neighbours[pin]:
+                if other not in seen:
+                    seen.add(other)
+                    member.append(other)
+                    queue.append(other)
+        side.update(best_split(member, neighbours, edges))
+        on_rows = sum(1 for pin in member if side[pin] == 0)
+        if on_rows > len(member) - on_rows:
+            for pin in member:
+                side[pin] = 1 - side[pin]
+
+    keys = []
+    conflicts = []
+    for (a, b), label in edges.items():
+        if side[a] == side[b]:
+            conflicts.append((a, b, label))
+        elif side[a] == 0:
+            keys.append((a, b, label))
+        else:
+            keys.append((b, a, label))
+
+    rows = sorted(pin for pin in side if side[pin] == 0)
+    cols = sorted(pin for pin in side if side[pin] == 1)
+    return MatrixAnalysis(rows, cols, sorted(keys), sorted(conflicts), components)
+
+def print_analysis(analysis, pin_name=lambda pin: f"GP{pin}"):
+    """Print the partition and any conflicts"""
+    print("\nAnalysis Results:")
+    print(f"Found {len(analysis.rows)} row pins: {', '.join(pin_name(p) for p in analysis.rows)}")
+    print(f"Found {len(analysis.cols)} column pins: {', '.join(pin_name(p) for p in analysis.cols)}")
+    print(f"Total keys detected: {len(analysis.keys)}")
+    if analysis.components > 1:
+        print(f"Note: pins form {analysis.components} unconnected groups; press more keys "
+              "to tie them together, row/column sides may be swapped between groups")
+    for a, b, label in analysis.conflicts:
+        name = label if isinstance(label, str) else "?"
+        print(f"Conflict: {pin_name(a)} - {pin_name(b)} ({name}) joins two pins on the same side")
+
+def write_matrix_config(analysis, path='/matrix_config.py', pin_name=lambda pin: f"GP{pin}"):
+    """Write a matrix_config.py with the row/column pins and detected keys"""
+    with open(path, 'w') as f:
+        f.write("# Keyboard Matrix Configuration\n")
+        f.write("# Generated by Keyboard Matrix Mapper\n\n")
+        f.write("import board\n\n")
+        f.write("# Row pins\n")
+        f.write(f"ROW_PINS = [{', '.join('board.' + pin_name(p) for p in analysis.rows)}]\n\n")
+        f.write("# Column pins\n")
+        f.write(f"COL_PINS = [{', '.join('board.' + pin_name(p) for p in analysis.cols)}]\n\n")
+        f.write(f"KEY_COUNT = {len(analysis.keys)}\n\n")
+        f.write("# Key matrix mapping\n")
+        f.write("KEY_MATRIX = {\n")
+        row_index = {pin: i for i, pin in enumerate(analysis.rows)}
+        col_index = {pin: i for i, pin in enumerate(analysis.cols)}
+        for r, c, label in analysis.keys:
+            name = label if isinstance(label, str) else 'KEY'
+            f.write(f"    ({row_index[r]}, {col_index[c]}): '{name}',  # {pin_name(r)} - {pin_name(c)}\n")
+        f.write("}\n")
+        if analysis.conflicts:
+            f.write("\n# Pin pairs that do not fit a row/column matrix\n")
+            f.write("CONFLICTS = [\n")
+            for a, b, label in analysis.conflicts:
+                f.write(f"    ({a}, {b}),  # {pin_name(a)} - {pin_name(b)}\n")
+            f.write("]\n")
+
+def simulate(num_rows=8, num_cols=40):
+    """Analyze a simulated 48-pin ribbon seen in both directions, plus one short"""
+    pins = list(range(num_rows + num_cols))
+    row_pins = pins[::6][:num_rows]
+    col_pins = [p for p in pins if p not in row_pins]
+    pairs = {}
+    for r in row_pins:
+        for c in col_pins:
+            pairs[(r, c)] = True
+            pairs[(c, r)] = True
+    pairs[(col_pins[0], col_pins[1])] = True  # shorted neighbours
+
+    start = time.monotonic()
+    analysis = analyze_pairs(pairs)
+    elapsed = time.monotonic() - start
+    print(f"{len(pins)} pins, {len(pairs)} observed pairs analyzed in {elapsed * 1000:.1f} ms")
+    print(f"rows correct: {analysis.rows == row_pins}, cols correct: {analysis.cols == col_pins}, "
+          f"keys: {len(analysis.keys)}, conflicts: {[(a, b) for a, b, _ in analysis.conflicts]}")
+
+def check_single_short():
+    """A short between two row pins must be the only conflict, with every
+    real key kept and both pins still on the row side"""
+    row_pins = [3, 9, 14]
+    col_pins = [4, 5, 6, 7, 10, 11]
+    pairs = {}
+    n = 0
+    for r in row_pins:
+        for c in col_pins:
+            pairs[(c, r) if n % 2 else (r, c)] = f"K{n}"
+            n += 1
+    pairs[(row_pins[0], row_pins[1])] = True  # the short
+    # Start the search at the shorted pins, the order that used to fail
+    analysis = analyze_pairs(dict(reversed(list(pairs.items()))))
+    assert analysis.rows == row_pins, analysis.rows
+    assert analysis.cols == col_pins, analysis.cols
+    assert [(a, b) for a, b, _ in analysis.conflicts] == [(3, 9)], analysis.conflicts
+    assert len(analysis.keys) == n
+    print("single row-to-row short: only the short is a conflict")
+
+if __name__ == "__main__":
+    simulate()
+    check_single_short()
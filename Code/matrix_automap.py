@@ -0,0 +1,203 @@
+"""
+Keyboard Matrix Auto-Mapper
+===========================
+Fast matrix discovery for laptop_keyboard_layout.py.
+
+A sweep drives one pin low at a time and reads the levels of every other pin
+with a single whole-port read, so it makes one read per driven pin instead
+of one per pin pair. Pins are identified by GPIO number, and each pin's
+connections are kept as a bitmask.
+
+automap() walks the user through a scripted key list ("press Q", "press W",
+...). It records which pin pair closes for each key; matrix_analyzer.py then
+sorts the pins into rows and columns. Pure Python: run this file with CPython to map a
+simulated keyboard.
+"""
+
+import time
+from matrix_analyzer import analyze_pairs
+
+# Keys prompted for by default (names from the layout editor's KEYCODE_MAP)
+SCRIPTED_KEYS = (
+    ['ESC'] + [f'F{n}' for n in range(1, 13)] +
+    ['GRAVE', '1', '2', '3', '4', '5', '6', '7', '8', '9', '0', 'MINUS', 'EQUAL', 'BKSP'] +
+    ['TAB', 'Q', 'W', 'E', 'R', 'T', 'Y', 'U', 'I', 'O', 'P', 'LBRACE', 'RBRACE', 'BSLASH'] +
+    ['CAPS', 'A', 'S', 'D', 'F', 'G', 'H', 'J', 'K', 'L', 'SCOLON', 'QUOTE', 'ENTER'] +
+    ['LSHIFT', 'Z', 'X', 'C', 'V', 'B', 'N', 'M', 'COMMA', 'DOT', 'SLASH', 'RSHIFT'] +
+    ['LCTRL', 'LGUI', 'LALT', 'SPACE', 'RALT', 'MENU', 'RCTRL',
+     'INSERT', 'DELETE', 'HOME', 'END', 'PGUP', 'PGDN', 'UP', 'LEFT', 'DOWN', 'RIGHT']
+)
+
+def bits(mask):
+    """Yield the bit numbers set in mask"""
+    n = 0
+    while mask:
+        if mask & 1:
+            yield n
+        mask >>= 1
+        n += 1
+
+def sweep(port, connections):
+    """Drive each pin low in turn; connections[i] = mask of pins pulled low by pin i"""
+    all_mask = port.mask
+    for i, gpio in enumerate(port.gpios):
+        port.drive_low(gpio)
+        connections[i] = ~port.read() & all_mask & ~(1 << gpio)
+        port.release(gpio)
+    return connections
+
+def find_pairs(port, connections, baseline):
+    """Return the (gpio_a, gpio_b) pairs, a < b, connected beyond the baseline"""
+    pairs = []
+    for i, gpio in enumerate(port.gpios):
+        for other in bits(connections[i] & ~baseline[i]):
+            if gpio < other:
+                pairs.append((gpio, other))
+    return pairs
+
+def automap(port, key_names=SCRIPTED_KEYS, prompt=print, on_found=None,
+            stable_sweeps=3, timeout=None, release_timeout=3):
+    """Guide the user through key_names and return {name: (gpio_a, gpio_b)}
+
+    A key is accepted once the same single pin pair has been seen for
+    stable_sweeps sweeps in a row. If timeout (seconds) is set and no key
+    shows up in time, that key is skipped. A pair still closed
+    release_timeout seconds after a key is reported as stuck and treated as
+    part of the baseline from then on.
+    """
+    baseline = sweep(port, [0] * len(port.gpios))
+    for i, gpio in enumerate(port.gpios):
+        for other in bits(baseline[i]):
+            if gpio < other:
+                prompt(f"Warning: GP{gpio} and GP{other} are connected with no key pressed")
+
+    connections = [0] * len(port.gpios)
+    found = {}
+    for name in key_names:
+        prompt(f"Press {name}")
+        candidate = None
+        seen = 0
+        started = time.monotonic()
+        while seen < stable_sweeps:
+            pairs = find_pairs(port, sweep(port, connections), baseline)
+            if len(pairs) == 1 and pairs[0] == candidate:
+                seen += 1
+            elif len(pairs) == 1:
+                candidate = pairs[0]
+                seen = 1
+            else:
+                # Nothing pressed yet, or more than one key down
+                candidate = None
+                seen = 0
+            if timeout and time.monotonic() - started > timeout:
+                break
+
+        if seen < stable_sweeps:
+            prompt(f"  {name} skipped")
+            continue
+        if candidate in found.values():
+            prompt(f"  {name} uses the same pins as another key, skipped")
+        else:
+            found[name] = candidate
+            prompt(f"  {name}: GP{candidate[0]} - GP{candidate[1]}")
+        if on_found:
+            on_found(name, candidate)
+
+        # Wait for the key to be released before prompting for the next one
+        released = time.monotonic() + release_timeout
+        pairs = find_pairs(port, sweep(port, connections), baseline)
+        while pairs and time.monotonic() < released:
+            pairs = find_pairs(port, sweep(port, connections), baseline)
+        if pairs:
+            for a, b in pairs:
+                prompt(f"Warning: GP{a} - GP{b} stuck closed (held key or short), ignoring it")
+            for i in range(len(baseline)):
+                baseline[i] |= connections[i]
+
+    return found
+
+class SimulatedPort:
+    """A diode-less keyboard matrix wired to GPIOs, for testing under CPython"""
+    def __init__(self, gpios, keys):
+        self.gpios = gpios
+        self.mask = 0
+        for gpio in gpios:
+            self.mask |= 1 << gpio
+        self.keys = keys  # name -> (row_gpio, col_gpio)
+        self.pressed = set()
+        self.driven = None
+        self.reads = 0
+        self.pin_writes = 0
+
+    def drive_low(self, gpio):
+        self.driven = gpio
+        self.pin_writes += 1
+
+    def release(self, gpio):
+        self.driven = None
+        self.pin_writes += 1
+
+    def read(self):
+        self.reads += 1
+        low = 0
+        if self.driven is not None:
+            low = 1 << self.driven
+            grew = True
+            while grew:
+                grew = False
+                for name in self.pressed:
+                    a, b = self.keys[name]
+                    if (low >> a) & 1 != (low >> b) & 1:
+                        low |= (1 << a) | (1 << b)
+                        grew = True
+        return self.mask & ~low
+
+def simulate(num_rows=8, num_cols=11):
+    """Map a simulated keyboard and check the recovered matrix"""
+    gpios = list(range(23)) + [26, 27, 28]
+    # Rows and columns interleaved along the ribbon, as on many laptop cables
+    row_gpios = gpios[1::3][:num_rows]
+    col_gpios = [g for g in gpios if g not in row_gpios][:num_cols]
+    keys = {}
+    for n, name in enumerate(SCRIPTED_KEYS):
+        keys[name] = (row_gpios[n % num_rows], col_gpios[n // num_rows])
+    port = SimulatedPort(gpios, keys)
+
+    def press_next(message):
+        if message.startswith("Press "):
+            port.pressed = {message[6:]}
+
+    def release(name, pair):
+        port.pressed = set()
+
+    start = time.monotonic()
+    found = automap(port, prompt=press_next, on_found=release, timeout=1)
+    elapsed = time.monotonic() - start
+    analysis = analyze_pairs({pair: name for name, pair in found.items()})
+    rows = analysis.rows
+
+    correct = rows == sorted(set(row_gpios)) and not analysis.conflicts and all(
+        (r, c) == keys[name] for r, c, name in analysis.keys)
+    print(f"Mapped {len(analysis.keys)}/{len(SCRIPTED_KEYS)} keys onto {len(rows)} rows x "
+          f"{len(analysis.cols)} cols in {elapsed:.2f} s, correct: {correct}")
+    print(f"{port.reads} port reads and {port.pin_writes} pin writes "
+          f"({port.reads // max(len(found), 1)} reads per key)")
+
+    # A key that never comes back up must not hang the mapping
+    messages = []
+    def press_and_stick(message):
+        messages.append(message)
+        if message == "Press ESC":
+            port.pressed = {"ESC"}
+        elif message.startswith("Press "):
+            port.pressed = {"ESC", message[6:]}
+    # (F9 and 5 share no row or column with ESC, so no ghost pairs)
+    found = automap(port, ['ESC', 'F9', '5'], prompt=press_and_stick,
+                    timeout=0.5, release_timeout=0.2)
+    stuck = [m for m in messages if "stuck" in m]
+    print(f"Stuck key: {stuck[0] if stuck else 'not reported'}, "
+          f"mapped afterwards: {sorted(found)}")
+    return correct
+
+if __name__ == "__main__":
+    simulate()
@@ -0,0 +1,362 @@
+"""
+NKRO Keyboard Reports
+=====================
+adafruit_hid's Keyboard sends the 8-byte boot report, which holds six keys:
+a seventh key raises ValueError and never reaches the host. Laptop matrices
+are often tested with whole rows held down, so the layout editor's test
+command can use this N-key-rollover keyboard instead.
+
+The report is a modifier byte followed by a 16-byte bitmap with one bit per
+keycode 0-127. Each scan_matrix() result is compared with the previous one
+and only the keys that went down or up touch the bitmap, with one OR or AND
+per key. At most one report is sent per scan, and only when a bit changed.
+
+The NKRO device has to be enabled in boot.py next to the normal keyboard,
+which stays available for BIOS screens and for adafruit_hid:
+
+    import usb_hid
+    from nkro_keyboard import nkro_device
+    usb_hid.enable((usb_hid.Device.KEYBOARD, usb_hid.Device.MOUSE,
+                    usb_hid.Device.CONSUMER_CONTROL, nkro_device()))
+
+Run this file with CPython for a latency/rollover benchmark against the
+6KRO path, with simulated matrix pins and a simulated HID device.
+"""
+
+import time
+
+try:
+    import usb_hid
+except ImportError:
+    usb_hid = None
+
+NKRO_REPORT_ID = 4       # 1-3 are CircuitPython's keyboard, mouse and consumer control
+NKRO_KEYS = 128          # keycodes 0-127 go in the bitmap
+BITMAP_SIZE = NKRO_KEYS // 8
+NKRO_REPORT_SIZE = 1 + BITMAP_SIZE
+MODIFIER_FIRST = 0xE0    # LEFT_CONTROL; 0xE0-0xE7 are the modifier byte's bits
+
+NKRO_DESCRIPTOR = bytes((
+    0x05, 0x01,          # Usage Page (Generic Desktop)
+    0x09, 0x06,          # Usage (Keyboard)
+    0xA1, 0x01,          # Collection (Application)
+    0x85, NKRO_REPORT_ID,  # Report ID
+    0x05, 0x07,          #   Usage Page (Keyboard)
+    0x19, 0xE0,          #   Usage Minimum (Left Control)
+    0x29, 0xE7,          #   Usage Maximum (Right GUI)
+    0x15, 0x00,          #   Logical Minimum (0)
+    0x25, 0x01,          #   Logical Maximum (1)
+    0x75, 0x01,          #   Report Size (1)
+    0x95, 0x08,          #   Report Count (8)
+    0x81, 0x02,          #   Input (Data, Variable, Absolute) - modifiers
+    0x19, 0x00,          #   Usage Minimum (0)
+    0x29, NKRO_KEYS - 1, #   Usage Maximum (127)
+    0x95, NKRO_KEYS,     #   Report Count (128)
+    0x81, 0x02,          #   Input (Data, Variable, Absolute) - keycode bitmap
+    0x05, 0x08,          #   Usage Page (LEDs)
+    0x19, 0x01,          #   Usage Minimum (Num Lock)
+    0x29, 0x05,          #   Usage Maximum (Kana)
+    0x95, 0x05,          #   Report Count (5)
+    0x91, 0x02,          #   Output (Data, Variable, Absolute) - LEDs
+    0x95, 0x03,          #   Report Count (3)
+    0x91, 0x01,          #   Output (Constant) - padding
+    0xC0,                # End Collection
+))
+
+def nkro_device():
+    """The usb_hid.Device to pass to usb_hid.enable() in boot.py"""
+    return usb_hid.Device(
+        report_descriptor=NKRO_DESCRIPTOR,
+        usage_page=0x01,
+        usage=0x06,
+        report_ids=(NKRO_REPORT_ID,),
+        in_report_lengths=(NKRO_REPORT_SIZE,),
+        out_report_lengths=(1,),
+    )
+
+def find_nkro_device(devices):
+    """Find the NKRO keyboard among usb_hid.devices, None if boot.py did not
+    enable it. The boot keyboard has the same usage, so the report length
+    tells them apart: it rejects a 17-byte report."""
+    empty = bytes(NKRO_REPORT_SIZE)
+    for device in devices:
+        if device.usage_page != 0x01 or device.usage != 0x06:
+            continue
+        try:
+            device.send_report(empty)
+            return device
+        except ValueError:
+            pass
+    return None
+
+class NKROKeyboard:
+    """Keycode bitmap for one keyboard, updated from scan_matrix() deltas"""
+    def __init__(self, device):
+        self.device = device
+        self.report = bytearray(NKRO_REPORT_SIZE)  # modifiers, then the bitmap
+        self.previous = set()  # (row, col) pressed in the last scan
+        self.changed = False
+        self.reports_sent = 0
+
+    def key_down(self, keycode):
+        if keycode >= MODIFIER_FIRST:
+            self.report[0] |= 1 << (keycode - MODIFIER_FIRST)
+        elif 0 < keycode < NKRO_KEYS:
+            self.report[1 + (keycode >> 3)] |= 1 << (keycode & 7)
+        else:
+            return
+        self.changed = True
+
+    def key_up(self, keycode):
+        if keycode >= MODIFIER_FIRST:
+            self.report[0] &= ~(1 << (keycode - MODIFIER_FIRST))
+        elif 0 < keycode < NKRO_KEYS:
+            self.report[1 + (keycode >> 3)] &= ~(1 << (keycode & 7))
+        else:
+            return
+        self.changed = True
+
+    def update(self, pressed, layout):
+        """Apply one scan_matrix() result, mapped through layout (a
+        KeymapStore), and send a report if a key went down or up"""
+        current = set(pressed)
+        for row, col in current - self.previous:
+            self.key_down(layout.get(row, col, 0))
+        for row, col in self.previous - current:
+            self.key_up(layout.get(row, col, 0))
+        self.previous = current
+        return self.send()
+
+    def send(self):
+        if not self.changed:
+            return False
+        self.device.send_report(self.report)
+        self.changed = False
+        self.reports_sent += 1
+        return True
+
+    def release_all(self):
+        for i in range(NKRO_REPORT_SIZE):
+            self.report[i] = 0
+        self.previous = set()
+        self.changed = True
+        self.send()
+
+def pressed_keycodes(report):
+    """Host side: keycodes held in an NKRO report"""
+    codes = [MODIFIER_FIRST + bit for bit in range(8) if report[0] & (1 << bit)]
+    for i in range(BITMAP_SIZE):
+        byte = report[1 + i]
+        for bit in range(8):
+            if byte & (1 << bit):
+                codes.append(i * 8 + bit)
+    return codes
+
+# --- Benchmark ---
+
+class SimulatedHIDDevice:
+    """Records the reports a host would receive"""
+    def __init__(self, report_size):
+        self.usage_page = 0x01
+        self.usage = 0x06
+        self.report_size = report_size
+        self.reports = []
+        self.sent_at = []  # perf_counter() of each report
+
+    def send_report(self, report):
+        if len(report) != self.report_size:
+            raise ValueError("Buffer length must be %d" % self.report_size)
+        self.reports.append(bytes(report))
+        self.sent_at.append(time.perf_counter())
+
+# digitalio.Direction stand-ins for the simulated pins
+INPUT = 'input'
+OUTPUT = 'output'
+
+class SimulatedPin:
+    """A digitalio.DigitalInOut on a keyboard matrix: a column reads low
+    while a pressed key connects it to a row driven low"""
+    def __init__(self, matrix, col=None):
+        self.matrix = matrix
+        self.col = col
+        self.direction = INPUT
+        self.pull = None
+        self.driven = True
+
+    @property
+    def value(self):
+        if self.col is None:
+            return self.driven
+        matrix = self.matrix
+        for row, pin in enumerate(matrix.rows):
+            if pin.direction == OUTPUT and not pin.driven and (row, self.col) in matrix.pressed:
+                return False
+        return True
+
+    @value.setter
+    def value(self, level):
+        self.driven = level
+
+class SimulatedMatrix:
+    """Row and column pins of a keyboard matrix with keys held down"""
+    def __init__(self, num_rows, num_cols):
+        self.pressed = set()
+        self.rows = [SimulatedPin(self) for _ in range(num_rows)]
+        self.cols = [SimulatedPin(self, c) for c in range(num_cols)]
+
+def scan_pins(row_pins, col_pins):
+    """The editor's scan_matrix(), run against simulated pins"""
+    pressed_keys = []
+    for r, row_pin in enumerate(row_pins):
+        orig_dir = row_pin.direction
+        orig_pull = row_pin.pull
+        row_pin.direction = OUTPUT
+        row_pin.value = False
+        for c, col_pin in enumerate(col_pins):
+            if not col_pin.value:
+                pressed_keys.append((r, c))
+        row_pin.direction = orig_dir
+        row_pin.pull = orig_pull
+    return pressed_keys
+
+class SixKeyKeyboard:
+    """The 6KRO path as adafruit_hid's Keyboard does it: an 8-byte boot
+    report sent on every press()/release() call, ValueError on a 7th key"""
+    def __init__(self, device):
+        self.device = device
+        self.report = bytearray(8)
+        self.previous = set()
+
+    def press(self, keycode):
+        if keycode >= MODIFIER_FIRST:
+            self.report[0] |= 1 << (keycode - MODIFIER_FIRST)
+        else:
+            for i in range(2, 8):
+                if self.report[i] == keycode:
+                    break
+            else:
+                for i in range(2, 8):
+                    if self.report[i] == 0:
+                        self.report[i] = keycode
+                        break
+                else:
+                    raise ValueError("Trying to press more than six keys at once.")
+        self.device.send_report(self.report)
+
+    def release(self, keycode):
+        if keycode >= MODIFIER_FIRST:
+            self.report[0] &= ~(1 << (keycode - MODIFIER_FIRST))
+        else:
+            for i in range(2, 8):
+                if self.report[i] == keycode:
+                    self.report[i] = 0
+        self.device.send_report(self.report)
+
+    def update(self, pressed, layout):
+        """What a test loop over kbd.press()/kbd.release() does per scan"""
+        current = set(pressed)
+        for row, col in current - self.previous:
+            try:
+                self.press(layout.get(row, col, 0))
+            except ValueError:
+                pass  # the key is lost
+        for row, col in self.previous - current:
+            self.release(layout.get(row, col, 0))
+        self.previous = current
+
+def chord_scans(num_rows, num_cols, held, repeat):
+    """scan_matrix() results for pressing `held` keys of a row, one per scan,
+    then letting go of them all"""
+    scans = []
+    for n in range(repeat):
+        row = n % num_rows
+        keys = []
+        for col in range(held):
+            keys = keys + [(row, col % num_cols)]
+            scans.append(keys)
+        scans.append([])
+    return scans
+
+def run_path(keyboard, device, scans, layout, decode):
+    """Feed scans through a keyboard; returns (us per scan, reports sent,
+    distinct keys the host saw held at the fullest report)"""
+    start = time.perf_counter()
+    for pressed in scans:
+        keyboard.update(pressed, layout)
+    elapsed = time.perf_counter() - start
+    most = max(len(decode(report)) for report in device.reports)
+    return elapsed * 1e6 / len(scans), len(device.reports), most
+
+def keypress_latency(keyboard, device, layout, num_rows, num_cols, scan_hz, presses=200):
+    """Press random keys on simulated pins while a loop scans the matrix at
+    scan_hz; returns the times in us from each press to its send_report()"""
+    import random
+    random.seed(2)
+    matrix = SimulatedMatrix(num_rows, num_cols)
+    period = 1 / scan_hz
+    latencies = []
+    for _ in range(presses):
+        key = (random.randrange(num_rows), random.randrange(num_cols))
+        # The key goes down somewhere within a scan period
+        next_scan = time.perf_counter() + period
+        pressed = time.perf_counter() + random.random() * period
+        while time.perf_counter() < pressed:
+            pass
+        matrix.pressed.add(key)
+        pressed = time.perf_counter()
+        sent = len(device.reports)
+        for release in (False, True):
+            while time.perf_counter() < next_scan:
+                pass
+            next_scan += period
+            keyboard.update(scan_pins(matrix.rows, matrix.cols), layout)
+            if not release and len(device.reports) > sent:
+                latencies.append((device.sent_at[sent] - pressed) * 1e6)
+            matrix.pressed.discard(key)
+    return latencies
+
+def benchmark(num_rows=8, num_cols=16, scan_hz=1000):
+    from keymap_store import KeymapStore
+    layout = KeymapStore()
+    for r in range(num_rows):
+        for c in range(num_cols):
+            layout.set(r, c, 4 + (r * num_cols + c) % 96)
+
+    def boot_keycodes(report):
+        return [MODIFIER_FIRST + bit for bit in range(8) if report[0] & (1 << bit)] + \
+               [code for code in report[2:] if code]
+
+    for name, keyboard_class, size in (("6KRO", SixKeyKeyboard, 8),
+                                       ("NKRO", NKROKeyboard, NKRO_REPORT_SIZE)):
+        device = SimulatedHIDDevice(size)
+        latencies = sorted(keypress_latency(keyboard_class(device), device, layout,
+                                            num_rows, num_cols, scan_hz))
+        print(f"{name}: keypress to send_report mean {sum(latencies) / len(latencies):.0f} us, "
+              f"max {latencies[-1]:.0f} us, scanning {num_rows}x{num_cols} simulated pins "
+              f"at {scan_hz} Hz")
+
+    for held in (4, 6, 10, 16):
+        scans = chord_scans(num_rows, num_cols, held, 50)
+        device = SimulatedHIDDevice(8)
+        six = run_path(SixKeyKeyboard(device), device, scans, layout, boot_keycodes)
+        device = SimulatedHIDDevice(NKRO_REPORT_SIZE)
+        nkro = run_path(NKROKeyboard(device), device, scans, layout, pressed_keycodes)
+        for name, (per_scan, reports, most) in (("6KRO", six), ("NKRO", nkro)):
+            print(f"{held:2d} keys held, {name}: {most:2d} reach the host, "
+                  f"{reports:4d} reports, {per_scan:5.1f} us per scan update")
+
+    # Several keys changing in one scan: 6KRO sends a report per key
+    device = SimulatedHIDDevice(8)
+    six = SixKeyKeyboard(device)
+    six.update([(0, c) for c in range(5)], layout)
+    device6 = device
+    device = SimulatedHIDDevice(NKRO_REPORT_SIZE)
+    NKROKeyboard(device).update([(0, c) for c in range(5)], layout)
+    # The host takes one report per USB poll (bInterval), so the last of
+    # the 6KRO reports lands several polls after the NKRO one
+    print(f"5 keys down in one scan: 6KRO sends {len(device6.reports)} reports, "
+          f"NKRO sends {len(device.reports)}; at a 1 ms USB poll the last key "
+          f"arrives {len(device6.reports) - len(device.reports)} ms later with 6KRO")
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,309 @@
+"""
+Scanline Streaming for the DPI Output
+=====================================
+Feeds the RGB state machine whole scanlines instead of one pixel per call.
+
+Four 8-bit pixels are packed into each 32-bit word, first pixel in the low
+byte, because the RGB program shifts its OSR right. A 640-pixel line is
+then 160 FIFO words. Because the packing matches little-endian memory, a
+frame stored as bytes needs no packing at all.
+
+Two feeders share the same prepare()/send()/busy() interface:
+  DMAFeeder - two chained DMA channels. The data channel copies one line
+              into the TX FIFO, paced by the state machine's DREQ, then
+              chains to the control channel. The control channel loads the
+              next line address from a table into the data channel's
+              READ_ADDR_TRIG alias. A 0 entry ends the frame, so the CPU
+              only starts each frame.
+  PutFeeder - sm.put() of one array('I') line per call, for firmware
+              without rp2.DMA
+
+Run this file with CPython to simulate both feeders and the old per-pixel
+loop and print the pixels per second each one achieves.
+"""
+
+from array import array
+import time
+
+try:
+    import rp2
+    import uctypes
+except ImportError:
+    rp2 = None
+    uctypes = None
+
+# RP2040/RP2350 register addresses
+DMA_BASE = 0x50000000
+DMA_CHANNEL_STRIDE = 0x40
+DMA_AL3_READ_ADDR_TRIG = 0x3c
+PIO_BASES = (0x50200000, 0x50300000, 0x50400000)
+PIO_TXF0 = 0x10
+
+def pio_tx_fifo(sm_id):
+    """Address of the TX FIFO of state machine sm_id (0-3 PIO0, 4-7 PIO1, ...)"""
+    return PIO_BASES[sm_id // 4] + PIO_TXF0 + 4 * (sm_id % 4)
+
+def pio_tx_dreq(sm_id):
+    """DREQ number that paces DMA to the TX FIFO of state machine sm_id"""
+    return (sm_id // 4) * 8 + sm_id % 4
+
+def address_of(buf):
+    return uctypes.addressof(buf)
+
+def byte_view(words):
+    """Writable bytes sharing memory with an array('I')"""
+    if uctypes is not None:
+        return uctypes.bytearray_at(uctypes.addressof(words), len(words) * 4)
+    return memoryview(words).cast('B')
+
+def pack_line(pixels, words, offset=0):
+    """Pack 8-bit pixels into words[offset:], four per word, first pixel lowest"""
+    i = offset
+    for x in range(0, len(pixels) - 3, 4):
+        words[i] = (pixels[x] | (pixels[x + 1] << 8) |
+                    (pixels[x + 2] << 16) | (pixels[x + 3] << 24))
+        i += 1
+    return words
+
+def pack_frame(rows, words_per_line):
+    """Pack a list of pixel rows into one array('I') frame"""
+    frame = array('I', bytes(4 * words_per_line * len(rows)))
+    for y, row in enumerate(rows):
+        pack_line(row, frame, y * words_per_line)
+    return frame
+
+class PutFeeder:
+    """Sends a frame with one sm.put() per scanline"""
+    def __init__(self, sm, words_per_line):
+        self.sm = sm
+        self.words_per_line = words_per_line
+
+    def prepare(self, frame, lines, repeat=1):
+        """Return one word view per scanline (made once, reused every frame)"""
+        view = memoryview(frame)
+        n = self.words_per_line
+        views = []
+        for y in range(lines):
+            line = view[y * n:(y + 1) * n]
+            views += [line] * repeat
+        return views
+
+    def send(self, line_views):
+        put = self.sm.put
+        for line in line_views:
+            put(line)
+
+    def busy(self):
+        return False
+
+class DMAFeeder:
+    """Streams a frame to the TX FIFO with a data and a control DMA channel"""
+    def __init__(self, sm_id, words_per_line, channels=None, address_of=address_of):
+        self.words_per_line = words_per_line
+        self.address_of = address_of
+        if channels is None:
+            channels = (rp2.DMA(), rp2.DMA())
+        self.data, self.ctrl = channels
+
+        data_trigger = (DMA_BASE + self.data.channel * DMA_CHANNEL_STRIDE +
+                        DMA_AL3_READ_ADDR_TRIG)
+        self.data.config(
+            write=pio_tx_fifo(sm_id), count=words_per_line,
+            ctrl=self.data.pack_ctrl(size=2, inc_write=False,
+                                     treq_sel=pio_tx_dreq(sm_id),
+                                     chain_to=self.ctrl.channel))
+        # One table entry per trigger; the read address walks the table
+        self.ctrl.config(
+            write=data_trigger, count=1,
+            ctrl=self.ctrl.pack_ctrl(size=2, inc_write=False))
+
+    def prepare(self, frame, lines, repeat=1):
+        """Return the line address table for frame, ending in a 0 entry.
+        repeat > 1 sends each line several times (line doubling for free)."""
+        base = self.address_of(frame)
+        step = self.words_per_line * 4
+        table = array('I', [base + (y // repeat) * step for y in range(lines * repeat)])
+        table.append(0)
+        return table
+
+    def send(self, table):
+        """Start streaming the frame described by table; returns at once"""
+        self.ctrl.read = table
+        self.ctrl.active(1)
+
+    def busy(self):
+        return self.data.active() or self.ctrl.active()
+
+def make_feeder(sm, sm_id, words_per_line):
+    """DMA when the firmware has rp2.DMA, otherwise sm.put() per line"""
+    if rp2 is not None and hasattr(rp2, 'DMA'):
+        return DMAFeeder(sm_id, words_per_line)
+    return PutFeeder(sm, words_per_line)
+
+# --- CPython model of the DMA channels and the RGB state machine ---
+
+class SimulatedBus:
+    """Word-addressed memory, DMA trigger registers and PIO TX FIFOs"""
+    def __init__(self):
+        self.regions = []        # (base, words)
+        self.next_base = 0x20000000
+        self.channels = {}       # trigger register address -> channel
+        self.fifos = {}          # TX FIFO address -> state machine
+
+    def address_of(self, buf):
+        for base, words in self.regions:
+            if words is buf:
+                return base
+        base = self.next_base
+        self.regions.append((base, buf))
+        self.next_base += (len(buf) * buf.itemsize + 3) & ~3
+        return base
+
+    def read32(self, addr):
+        for base, words in self.regions:
+            offset = addr - base
+            if 0 <= offset < len(words) * 4:
+                return words[offset // 4]
+        raise ValueError(f"bus error reading {addr:#x}")
+
+    def write32(self, addr, value):
+        if addr in self.fifos:
+            self.fifos[addr].put(value)
+        elif addr in self.channels:
+            self.channels[addr].trigger_read(value)
+        else:
+            raise ValueError(f"bus error writing {addr:#x}")
+
+class SimulatedDMA:
+    """The subset of rp2.DMA used by DMAFeeder, moving one word per step"""
+    def __init__(self, bus, channel):
+        self.bus = bus
+        self.channel = channel
+        bus.channels[DMA_BASE + channel * DMA_CHANNEL_STRIDE + DMA_AL3_READ_ADDR_TRIG] = self
+        self.read = 0
+        self.write = 0
+        self.count = 0
+        self.remaining = 0
+        self.ctrl = {}
+        self.busy = False
+
+    def pack_ctrl(self, **fields):
+        return fields
+
+    def config(self, read=None, write=None, count=None, ctrl=None, trigger=False):
+        if read is not None:
+            self.read = read
+        if write is not None:
+            self.write = write
+        if count is not None:
+            self.count = count
+        if ctrl is not None:
+            self.ctrl = ctrl
+
+    def trigger_read(self, addr):
+        # A write of 0 to a trigger alias is a null trigger: the chain stops
+        if addr:
+            self.read = addr
+            self.active(1)
+
+    def active(self, value=None):
+        if value is None:
+            return self.busy
+        self.busy = bool(value)
+        if self.busy:
+            self.remaining = self.count
+            if not isinstance(self.read, int):
+                self.read = self.bus.address_of(self.read)
+
+    def step(self):
+        """Move one word, return False once the transfer is complete"""
+        self.bus.write32(self.write, self.bus.read32(self.read))
+        if self.ctrl.get('inc_read', True):
+            self.read += 4
+        self.remaining -= 1
+        if self.remaining:
+            return True
+        self.busy = False
+        chain_to = self.ctrl.get('chain_to', self.channel)
+        if chain_to != self.channel:
+            for other in self.bus.channels.values():
+                if other.channel == chain_to:
+                    other.active(1)
+        return False
+
+class SimulatedSM:
+    """RGB state machine stand-in: collects the words it is given"""
+    def __init__(self, sm_id=2):
+        self.sm_id = sm_id
+        self.words = array('I')
+        self.calls = 0
+
+    def put(self, value):
+        self.calls += 1
+        if isinstance(value, int):
+            self.words.append(value)
+        else:
+            self.words.extend(value)
+
+def run_dma(bus):
+    """Let the simulated DMA engine run until every channel is idle"""
+    channels = list(bus.channels.values())
+    running = True
+    while running:
+        running = False
+        for channel in channels:
+            if channel.busy:
+                channel.step()
+                running = True
+
+def simulate(width=640, height=480, frames=3):
+    """Compare per-pixel puts, per-line puts and chained DMA feeding"""
+    rows = [[(x * 7 // width) * 0x24 for x in range(width)] for _ in range(height)]
+    words_per_line = width // 4
+    frame = pack_frame(rows, words_per_line)
+    needed = width * height * 60
+    print(f"{width}x{height}@60 needs {needed / 1e6:.1f} Mpixels/s")
+
+    def report(label, words, expected, calls, elapsed):
+        pixels = width * height * frames
+        print(f"  {label:14} {pixels / elapsed / 1e6:8.1f} Mpixels/s fed, "
+              f"{elapsed / frames * 60 * 100:7.2f}% CPU at 60 fps, "
+              f"{calls // frames:6d} calls per frame, output correct: {words == expected * frames}")
+
+    # Old start_display(): one put() per pixel
+    sm = SimulatedSM()
+    start = time.perf_counter()
+    for _ in range(frames):
+        for y in range(height):
+            for x in range(width):
+                sm.put(rows[y][x])
+    report("per-pixel put", sm.words, array('I', [p for row in rows for p in row]),
+           sm.calls, time.perf_counter() - start)
+
+    # One put() of an array('I') per scanline
+    sm = SimulatedSM()
+    feeder = PutFeeder(sm, words_per_line)
+    lines = feeder.prepare(frame, height)
+    start = time.perf_counter()
+    for _ in range(frames):
+        feeder.send(lines)
+    report("per-line put", sm.words, frame, sm.calls, time.perf_counter() - start)
+
+    # Chained DMA: the CPU only starts each frame, the model moves the words
+    sm = SimulatedSM()
+    bus = SimulatedBus()
+    bus.fifos[pio_tx_fifo(sm.sm_id)] = sm
+    feeder = DMAFeeder(sm.sm_id, words_per_line,
+                       (SimulatedDMA(bus, 0), SimulatedDMA(bus, 1)), bus.address_of)
+    table = feeder.prepare(frame, height)
+    cpu = 0.0
+    for _ in range(frames):
+        start = time.perf_counter()
+        feeder.send(table)
+        cpu += time.perf_counter() - start
+        run_dma(bus)
+    report("chained DMA", sm.words, frame, frames, cpu)
+    print("  (DMA delivery itself is paced by the pixel clock, not the CPU)")
+
+if __name__ == "__main__":
+    simulate()
@@ -0,0 +1,227 @@
+"""
+Text Console for the DPI Output
+===============================
+An 80x30 character-cell terminal for hdmi_pico.py. Each cell holds a
+character byte and an attribute byte (foreground colour in the low nibble,
+background in the high nibble, both indexes into a 16-colour RGB332
+palette). The whole screen is 4.8 KB of cells plus a 4 KB glyph ROM of 8x16
+glyphs, one byte per glyph row, leftmost pixel in bit 7.
+
+Scanlines are rasterized one at a time by render_line(). Each glyph row
+becomes two output words via a 16-entry nibble mask table, so no per-pixel
+work is done. Writes mark their text row dirty; update() re-rasterizes
+only the dirty rows into a full-resolution Framebuffer, which the DMA
+keeps streaming.
+
+The glyph ROM comes from, in order: a raw 8x16 font file or PSF1 console
+font passed to load_glyphs(), MicroPython's built-in framebuf 8x8 font with
+each row doubled, or plain boxes (CPython). Run this file with CPython for a
+throughput benchmark.
+"""
+
+from array import array
+import time
+
+try:
+    import framebuf
+except ImportError:
+    framebuf = None
+
+COLS = 80
+ROWS = 30
+GLYPH_HEIGHT = 16
+
+# CGA-style palette in RGB332: black, blue, green, cyan, red, magenta, brown,
+# light grey, dark grey, then the bright versions
+CGA_PALETTE = [0x00, 0x02, 0x14, 0x16, 0xA0, 0xA2, 0xA8, 0xB6,
+               0x49, 0x4B, 0x5D, 0x5F, 0xE9, 0xEB, 0xFD, 0xFF]
+DEFAULT_ATTR = 0x07  # light grey on black
+
+# Nibble of glyph bits (MSB = leftmost) -> word with 0xFF in each lit pixel byte
+NIBBLE_MASKS = array('I', [
+    (0xFF if n & 8 else 0) | (0xFF00 if n & 4 else 0) |
+    (0xFF0000 if n & 2 else 0) | (0xFF000000 if n & 1 else 0)
+    for n in range(16)])
+
+def load_glyphs(path):
+    """Read a raw 256x16-byte font or a PSF1 font with 16-row glyphs"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:2] == b'\x36\x04':
+        if data[3] != GLYPH_HEIGHT:
+            raise ValueError("Only 8x16 PSF fonts are supported")
+        data = data[4:4 + 256 * GLYPH_HEIGHT]
+    if len(data) < 256 * GLYPH_HEIGHT:
+        raise ValueError("Font file too short for 256 8x16 glyphs")
+    return bytearray(data[:256 * GLYPH_HEIGHT])
+
+def builtin_glyphs():
+    """Build 8x16 glyphs from framebuf's 8x8 font, or boxes without framebuf"""
+    glyphs = bytearray(256 * GLYPH_HEIGHT)
+    if framebuf is not None:
+        cell = bytearray(8)
+        canvas = framebuf.FrameBuffer(cell, 8, 8, framebuf.MONO_HLSB)
+        for code in range(32, 127):
+            canvas.fill(0)
+            canvas.text(chr(code), 0, 0, 1)
+            for row in range(8):
+                glyphs[code * 16 + row * 2] = cell[row]
+                glyphs[code * 16 + row * 2 + 1] = cell[row]
+        return glyphs
+    for code in range(33, 127):
+        for row in range(2, 14):
+            glyphs[code * 16 + row] = 0x7E if row in (2, 13) else 0x42
+    return glyphs
+
+class TextConsole:
+    """Character cells with attributes, rasterized one scanline at a time"""
+    def __init__(self, cols=COLS, rows=ROWS, glyphs=None, palette=CGA_PALETTE):
+        self.cols = cols
+        self.rows = rows
+        self.width = cols * 8
+        self.height = rows * GLYPH_HEIGHT
+        self.line_repeat = 1
+        self.pixel_repeat = 1
+        self.words_per_line = cols * 2
+        self.palette = None
+        self.frame = None
+        self.glyphs = glyphs or builtin_glyphs()
+        self.chars = bytearray(cols * rows)
+        self.attrs = bytearray([DEFAULT_ATTR]) * (cols * rows)
+        # Palette index -> colour repeated in all four bytes of a word
+        self.solid = array('I', [c * 0x01010101 for c in palette])
+        self.dirty = (1 << rows) - 1  # bit per text row
+        self.col = 0
+        self.row = 0
+        self.attr = DEFAULT_ATTR
+
+    def bytes_used(self):
+        return len(self.chars) + len(self.attrs) + len(self.glyphs) + len(self.solid) * 4
+
+    def set_color(self, fg, bg=0):
+        self.attr = (bg << 4) | fg
+
+    def put_char(self, col, row, code, attr=None):
+        i = row * self.cols + col
+        self.chars[i] = code
+        self.attrs[i] = self.attr if attr is None else attr
+        self.dirty |= 1 << row
+
+    def clear(self):
+        for i in range(len(self.chars)):
+            self.chars[i] = 32
+            self.attrs[i] = self.attr
+        self.col = 0
+        self.row = 0
+        self.dirty = (1 << self.rows) - 1
+
+    def scroll(self):
+        """Move every text row up one and blank the bottom row"""
+        cols = self.cols
+        end = cols * self.rows
+        self.chars[0:end - cols] = self.chars[cols:end]
+        self.attrs[0:end - cols] = self.attrs[cols:end]
+        for i in range(end - cols, end):
+            self.chars[i] = 32
+            self.attrs[i] = self.attr
+        self.dirty = (1 << self.rows) - 1
+
+    def newline(self):
+        self.col = 0
+        if self.row == self.rows - 1:
+            self.scroll()
+        else:
+            self.row += 1
+
+    def write(self, text):
+        """Write text at the cursor, handling \\n, \\r, \\b and wrapping"""
+        for ch in text:
+            if ch == '\n':
+                self.newline()
+            elif ch == '\r':
+                self.col = 0
+            elif ch == '\b':
+                if self.col:
+                    self.col -= 1
+            else:
+                if self.col == self.cols:
+                    self.newline()
+                code = ord(ch)
+                self.put_char(self.col, self.row, code if code < 256 else 63)
+                self.col += 1
+        return len(text)
+
+    def render_line(self, y, words, offset=0):
+        """Rasterize scanline y into words[offset:offset + cols * 2]"""
+        glyphs = self.glyphs
+        chars = self.chars
+        attrs = self.attrs
+        solid = self.solid
+        masks = NIBBLE_MASKS
+        i = (y >> 4) * self.cols
+        g = y & 15
+        n = offset
+        for _ in range(self.cols):
+            bits = glyphs[chars[i] * 16 + g]
+            attr = attrs[i]
+            fg = solid[attr & 15]
+            bg = solid[attr >> 4]
+            fx = fg ^ bg
+            words[n] = bg ^ (fx & masks[bits >> 4])
+            words[n + 1] = bg ^ (fx & masks[bits & 15])
+            i += 1
+            n += 2
+
+    def update(self, fb):
+        """Re-rasterize dirty text rows into fb (a full Framebuffer); returns rows drawn"""
+        dirty = self.dirty
+        if not dirty:
+            return 0
+        self.dirty = 0
+        frame = fb.frame
+        step = fb.words_per_line
+        drawn = 0
+        for row in range(self.rows):
+            if dirty & (1 << row):
+                y = row * GLYPH_HEIGHT
+                for g in range(GLYPH_HEIGHT):
+                    self.render_line(y + g, frame, (y + g) * step)
+                drawn += 1
+        return drawn
+
+def benchmark():
+    """Host throughput of writes, full redraws and dirty-row updates"""
+    from framebuffer import Framebuffer
+    console = TextConsole()
+    fb = Framebuffer(console.width, console.height)
+    print(f"Console {console.cols}x{console.rows}: {console.bytes_used()} bytes "
+          f"(cells {len(console.chars) + len(console.attrs)}), "
+          f"framebuffer {fb.bytes_used()} bytes")
+
+    text = "The quick brown fox jumps over the lazy dog 0123456789 ~!@#$%^&*()\n"
+    start = time.perf_counter()
+    count = 0
+    while time.perf_counter() - start < 0.2:
+        console.write(text)
+        count += len(text)
+    elapsed = time.perf_counter() - start
+    print(f"  write():        {count / elapsed / 1000:8.1f} k characters/s (with scrolling)")
+
+    console.dirty = (1 << console.rows) - 1
+    start = time.perf_counter()
+    console.update(fb)
+    full = time.perf_counter() - start
+    print(f"  full redraw:    {full * 1000:8.2f} ms, "
+          f"{console.height / full / 1000:.1f} k scanlines/s")
+
+    console.col = 0
+    console.row = 5
+    start = time.perf_counter()
+    console.write("$ ls")
+    rows = console.update(fb)
+    typed = time.perf_counter() - start
+    print(f"  typing a word:  {typed * 1000:8.2f} ms, {rows} dirty row re-rasterized "
+          f"({full / typed:.0f}x less than a full redraw)")
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,495 @@
+"""
+PIO Timing Generator for the DPI Output
+=======================================
+One sync state machine makes HSYNC and VSYNC for every line of a mode from
+video_timing.py, and raises a PIO IRQ that starts the RGB state machine on
+each visible line. Both run from the same sys_clk (the RGB machine at twice
+the pixel clock, the sync machine at the pixel clock) and are started
+together, so every line's pixels land on the same clock as its sync edges.
+This replaces the separate HSYNC and VSYNC machines.
+
+Sync program, one cycle per pixel:
+  visible lines  irq(4) one pixel before active video, wait through active
+                 and front porch, HSYNC pulse, back porch
+  blank lines    the same line without the irq; VSYNC (OUT pin) is written
+                 from the OSR at each HSYNC pulse and the OSR shifted on
+  between        irq(rel(0)) at the start of blanking, for the CPU (frame
+                 swap and the start of the next frame)
+Line counts and the VSYNC pattern live in the ISR, loaded once before the
+machine starts: bits 0-9 visible lines - 1, bits 10-15 blank lines - 1,
+bits 16-31 VSYNC level per blank line. Waits are built from instruction
+delays and X loops worked out for each mode by wait_plan().
+
+RGB program, two cycles per pixel: wait for irq(4), send a line of pixels
+with an X count, then drive black until the next line. Until pixels are
+queued it takes the line irq and stalls on autopull, so the first frame is
+started from the blanking IRQ after rearm_rgb(), which puts it back to
+waiting for line 0.
+
+Run this file with CPython to simulate both programs cycle by cycle and
+check the waveforms against the timing table.
+"""
+
+import time
+from video_timing import MODES
+from scanline import PIO_BASES
+
+try:
+    from machine import mem32
+except ImportError:
+    mem32 = None
+
+# PIO IRQ flag the sync machine raises for each visible line
+LINE_IRQ = 4
+# Pixels between the line irq and the first pixel on the pins: the RGB
+# machine sees the flag one cycle later and outputs on the cycle after
+IRQ_LEAD = 1
+# Cycles between the end of one line loop and the start of the next:
+# a padding jmp when repeating, two setup instructions when moving on
+PAD = 2
+PIO_CTRL_OFFSET = 0x000
+PIO_IRQ_OFFSET = 0x030
+
+def spread(spare, count):
+    """Delays for count instructions adding up to spare, filled from the last"""
+    delays = [0] * count
+    for i in range(count - 1, -1, -1):
+        delays[i] = min(spare, 31)
+        spare -= delays[i]
+    return delays
+
+def wait_plan(cycles, fixed):
+    """Fill cycles with fixed one-cycle instructions and, if needed, an X loop
+
+    Returns (delays, loop): a delay for each fixed instruction, and None or
+    (n, a, b) for set(x, n) [a] followed by jmp(x_dec, ...) [b].
+    """
+    spare = cycles - fixed
+    if spare < 0:
+        raise ValueError(f"{cycles} cycles is shorter than {fixed} instructions")
+    if spare <= 31 * fixed:
+        return spread(spare, fixed), None
+    spare -= 1                          # the set instruction
+    iterations = min(32, spare // 32)
+    if iterations < 1:
+        raise ValueError(f"{cycles} cycles is too short for a loop")
+    spare -= iterations * 32
+    a = min(spare, 31)
+    spare -= a
+    if spare > 31 * fixed:
+        raise ValueError(f"{cycles} cycles does not fit in one X loop")
+    return spread(spare, fixed), (iterations - 1, a, 31)
+
+def sync_isr(mode):
+    """ISR word for the sync program: line counts and the VSYNC pattern"""
+    blank = mode.v_front + mode.v_sync + mode.v_back
+    if mode.height > 1024 or blank > 64 or mode.v_front + mode.v_sync > 16:
+        raise ValueError(f"{mode.name} vertical timing does not fit the sync program")
+    pattern = ((1 << mode.v_sync) - 1) << mode.v_front
+    return (pattern << 16) | ((blank - 1) << 10) | (mode.height - 1)
+
+def sync_program(mode):
+    """Return the sync program for mode (HSYNC on the SET pin, VSYNC on the OUT pin)"""
+    line_irq = LINE_IRQ
+    h_idle = 0 if mode.hsync_positive else 1
+    h_sync = 1 - h_idle
+    vsync_positive = mode.vsync_positive
+    active = IRQ_LEAD + mode.width + mode.h_front
+    back = mode.h_back - IRQ_LEAD - PAD
+    v1 = wait_plan(active, 1)
+    v2 = wait_plan(mode.h_sync, 1)
+    v3 = wait_plan(back, 2)
+    b1 = wait_plan(active, 0)
+    b2 = wait_plan(mode.h_sync, 3)
+
+    def video_sync_pio():
+        def loop(name, plan):
+            # X loop for the rest of a wait, if the delays alone are too short
+            if plan[1] is not None:
+                n, a, b = plan[1]
+                set(x, n)                   [a]
+                label(name)
+                jmp(x_dec, name)            [b]
+
+        wrap_target()
+        # Frame start: OSR = VSYNC pattern, blank lines - 1, visible lines - 1
+        mov(osr, isr)
+        out(y, 10)
+
+        label("visible")
+        irq(line_irq)                       [v1[0][0]]  # RGB line starts after IRQ_LEAD
+        loop("visible_active", v1)
+        set(pins, h_sync)                   [v2[0][0]]
+        loop("visible_sync", v2)
+        set(pins, h_idle)                   [v3[0][0]]
+        loop("visible_back", v3)
+        jmp(y_dec, "visible_pad")           [v3[0][1]]
+
+        # Blanking: tell the CPU, then count the blank lines
+        out(y, 6)
+        irq(rel(0))
+
+        label("blank")
+        loop("blank_active", b1)
+        set(pins, h_sync)                   [b2[0][0]]
+        if vsync_positive:
+            mov(pins, osr)                  [b2[0][1]]
+        else:
+            mov(pins, invert(osr))          [b2[0][1]]
+        out(null, 1)                        [b2[0][2]]  # next line's VSYNC level
+        loop("blank_sync", b2)
+        set(pins, h_idle)                   [v3[0][0]]
+        loop("blank_back", v3)
+        jmp(y_dec, "blank_pad")             [v3[0][1]]
+        wrap()
+
+        # Taken loop jumps spend the same two cycles as the setup code
+        label("visible_pad")
+        jmp("visible")                      [1]
+        label("blank_pad")
+        jmp("blank")                        [1]
+
+    return video_sync_pio
+
+def rgb_program(pixel_repeat=1):
+    """Return the RGB program; Y must hold the stored pixels per line - 1"""
+    line_irq = LINE_IRQ
+    extra = 2 * pixel_repeat - 2
+    hold = extra // 2
+
+    def video_rgb_pio():
+        wrap_target()
+        mov(x, y)
+        wait(1, irq, line_irq)
+        label("pixel")
+        out(pins, 8)                        [hold]
+        jmp(x_dec, "pixel")                 [extra - hold]
+        mov(pins, null)                     # black outside active video
+        wrap()
+
+    return video_rgb_pio
+
+def load_sync(sm, mode):
+    """Put the line counts and VSYNC pattern into the sync machine's ISR"""
+    sm.put(sync_isr(mode))
+    sm.exec("pull()")
+    sm.exec("mov(isr, osr)")
+
+def load_rgb(sm, pixels):
+    """Put the pixel count into the RGB machine's Y register"""
+    sm.put(pixels - 1)
+    sm.exec("pull()")
+    sm.exec("mov(y, osr)")
+
+def start_together(sm_ids):
+    """Enable state machines of one PIO block on the same cycle, with their
+    clock dividers restarted so their cycles stay in phase"""
+    mask = 0
+    for sm_id in sm_ids:
+        mask |= 1 << (sm_id % 4)
+    ctrl = PIO_BASES[sm_ids[0] // 4] + PIO_CTRL_OFFSET
+    # SM_ENABLE bits 0-3, CLKDIV_RESTART bits 8-11
+    mem32[ctrl] = mem32[ctrl] | mask | (mask << 8)
+
+def rearm_rgb(sm, sm_id):
+    """Call in vertical blanking, before the first pixels of a frame are
+    queued. After a frame that went out without pixels, or started late,
+    the RGB machine holds a line irq and stalls inside a line; after a
+    complete frame it already waits for the next irq. Clears the line irq
+    (write 1 to clear) and restarts the machine at that wait; Y and the
+    clock divider are kept."""
+    mem32[PIO_BASES[sm_id // 4] + PIO_IRQ_OFFSET] = 1 << LINE_IRQ
+    sm.restart()
+
+# --- CPython model of the two state machines ---
+
+def assemble(program):
+    """Assemble a program function like rp2.asm_pio; returns (instructions, labels, wrap)"""
+    from types import FunctionType  # CPython only
+    instructions = []
+    labels = {}
+    wrap = [0, None]
+
+    def emit(op):
+        def add(*args):
+            instruction = [op, args, 0]
+            instructions.append(instruction)
+            return Delay(instruction)
+        return add
+
+    def set_wrap_target():
+        wrap[0] = len(instructions)
+
+    def set_wrap():
+        wrap[1] = len(instructions) - 1
+
+    irq = emit('irq')
+    dsl = {
+        'wrap_target': set_wrap_target, 'wrap': set_wrap,
+        'label': lambda name: labels.__setitem__(name, len(instructions)),
+        'set': emit('set'), 'mov': emit('mov'), 'out': emit('out'), 'jmp': emit('jmp'),
+        'wait': emit('wait'), 'irq': irq,
+        'invert': lambda src: ('invert', src), 'rel': lambda index: ('rel', index),
+    }
+    for name in ('pins', 'x', 'y', 'null', 'isr', 'osr', 'x_dec', 'y_dec'):
+        dsl[name] = name
+    FunctionType(program.__code__, dsl, closure=program.__closure__)()
+    if wrap[1] is None:
+        wrap[1] = len(instructions) - 1
+    # wait(1, irq, n) passes the irq function itself as the source
+    for instruction in instructions:
+        if instruction[0] == 'wait':
+            instruction[1] = tuple('irq' if arg is irq else arg for arg in instruction[1])
+    return instructions, labels, wrap
+
+class Delay:
+    """Lets program code write instruction(...) [delay]"""
+    def __init__(self, instruction):
+        self.instruction = instruction
+
+    def __getitem__(self, delay):
+        if not 0 <= delay <= 31:
+            raise ValueError(f"delay {delay} out of range")
+        self.instruction[2] = delay
+        return self
+
+class SMModel:
+    """One state machine running the subset of instructions used above"""
+    def __init__(self, program, index, flags, words=None, out_bits=1):
+        self.instructions, self.labels, self.wrap = assemble(program)
+        self.index = index
+        self.flags = flags      # shared PIO IRQ flags: {'set': set(), 'pending': set()}
+        self.words = words      # iterator feeding autopull, or None
+        self.out_mask = (1 << out_bits) - 1
+        self.pc = 0
+        self.x = self.y = self.isr = self.osr = 0
+        self.osr_used = 32
+        self.delay = 0
+        self.set_pins = 0
+        self.out_pins = 0
+        self.cpu_irqs = []      # cycle numbers of irq flags 0-3
+        self.cycles = 0
+
+    def restart(self):
+        """SM_RESTART and a jump to the start: shift counter, delay and
+        stalls are cleared, X and Y kept"""
+        self.pc = 0
+        self.osr_used = 32
+        self.delay = 0
+
+    def source(self, src):
+        if isinstance(src, tuple):
+            return ~self.source(src[1]) & 0xFFFFFFFF
+        if src == 'null':
+            return 0
+        return getattr(self, src)
+
+    def cycle(self):
+        self.cycles += 1
+        if self.delay:
+            self.delay -= 1
+            return
+        op, args, delay = self.instructions[self.pc]
+        next_pc = self.wrap[0] if self.pc == self.wrap[1] else self.pc + 1
+
+        if op == 'set':
+            if args[0] == 'pins':
+                self.set_pins = args[1]
+            else:
+                setattr(self, args[0], args[1])
+        elif op == 'mov':
+            value = self.source(args[1])
+            if args[0] == 'pins':
+                self.out_pins = value & self.out_mask
+            else:
+                setattr(self, args[0], value)
+                if args[0] == 'osr':
+                    self.osr_used = 0
+        elif op == 'out':
+            if self.words is not None and self.osr_used >= 32:
+                word = next(self.words, None)
+                if word is None:
+                    return  # autopull with an empty FIFO stalls
+                self.osr = word
+                self.osr_used = 0
+            bits = args[1]
+            value = self.osr & ((1 << bits) - 1)
+            self.osr >>= bits
+            self.osr_used += bits
+            if args[0] == 'pins':
+                self.out_pins = value & self.out_mask
+            elif args[0] != 'null':
+                setattr(self, args[0], value)
+        elif op == 'jmp':
+            if len(args) == 1:
+                next_pc = self.labels[args[0]]
+            else:
+                register = args[0][0]
+                taken = getattr(self, register) != 0
+                setattr(self, register, (getattr(self, register) - 1) & 0xFFFFFFFF)
+                if taken:
+                    next_pc = self.labels[args[1]]
+        elif op == 'irq':
+            index = args[0]
+            if isinstance(index, tuple):
+                index = (index[1] & 4) | ((index[1] + self.index) & 3)
+            self.flags['pending'].add(index)
+            if index < 4:
+                self.cpu_irqs.append(self.cycles)
+        elif op == 'wait':
+            index = args[2]
+            if index not in self.flags['set']:
+                return  # stall until the flag is raised
+            self.flags['set'].discard(index)
+
+        self.delay = delay
+        self.pc = next_pc
+
+def frame_words(mode, pixel):
+    """Yield the RGB FIFO words for endless frames, four pixels per word"""
+    stored_width, stored_height = mode.stored_size()
+    while True:
+        for line in range(mode.height):
+            y = line // mode.repeat
+            for x in range(0, stored_width, 4):
+                yield (pixel(x, y) | (pixel(x + 1, y) << 8) |
+                       (pixel(x + 2, y) << 16) | (pixel(x + 3, y) << 24))
+
+def fed_from(started, words):
+    """Yield None (an empty FIFO) until started[0] is set, then words"""
+    while not started[0]:
+        yield None
+    yield from words
+
+def run_model(mode, lines, feed_after=None):
+    """Run both programs for lines scanlines; returns per-pixel hsync, vsync, rgb
+
+    With feed_after, the RGB FIFO stays empty until that many pixels after
+    the first blanking IRQ, when frames start queuing, and rearm_rgb() runs
+    that long after every blanking IRQ, as the CPU does from its handler."""
+    flags = {'set': set(), 'pending': set()}
+    pixel = lambda x, y: (x + 3 * y) % 255 + 1
+    started = [feed_after is None]
+    sync = SMModel(sync_program(mode), 0, flags)
+    rgb = SMModel(rgb_program(mode.repeat), 1, flags,
+                  fed_from(started, frame_words(mode, pixel)), out_bits=8)
+    sync.isr = sync_isr(mode)
+    rgb.y = mode.width // mode.repeat - 1
+    # Pins start idle, as set_init/out_init leave them
+    sync.set_pins = 0 if mode.hsync_positive else 1
+    sync.out_pins = 0 if mode.vsync_positive else 1
+
+    pixels = lines * mode.h_total()
+    hsync = bytearray(pixels)
+    vsync = bytearray(pixels)
+    colors = bytearray(pixels)
+    for t in range(pixels):
+        if feed_after is not None and sync.cpu_irqs and t == sync.cpu_irqs[-1] + feed_after:
+            flags['set'].discard(LINE_IRQ)
+            flags['pending'].discard(LINE_IRQ)
+            rgb.restart()
+            started[0] = True
+        # The RGB machine runs two cycles for each sync machine cycle
+        sync.cycle()
+        rgb.cycle()
+        flags['set'] |= flags['pending']
+        flags['pending'].clear()
+        hsync[t] = sync.set_pins
+        vsync[t] = sync.out_pins
+        colors[t] = rgb.out_pins
+        rgb.cycle()
+        flags['set'] |= flags['pending']
+        flags['pending'].clear()
+    return hsync, vsync, colors, pixel, sync, rgb
+
+def edges(levels, active):
+    """Positions where levels changes to active"""
+    return [t for t in range(1, len(levels)) if levels[t] == active and levels[t - 1] != active]
+
+def check_waveform(mode, hsync, vsync, colors, pixel):
+    """Compare simulated pins with the timing table; returns a list of errors"""
+    errors = []
+    h_total = mode.h_total()
+    h_on = 1 if mode.hsync_positive else 0
+    v_on = 1 if mode.vsync_positive else 0
+    h_edges = edges(hsync, h_on)
+    for a, b in zip(h_edges, h_edges[1:]):
+        if b - a != h_total:
+            errors.append(f"HSYNC period {b - a} at {a}, expected {h_total}")
+            break
+    for e in h_edges:
+        width = 0
+        while e + width < len(hsync) and hsync[e + width] == h_on:
+            width += 1
+        if e + width < len(hsync) and width != mode.h_sync:
+            errors.append(f"HSYNC pulse {width} at {e}, expected {mode.h_sync}")
+            break
+
+    v_edges = edges(vsync, v_on)
+    if not v_edges:
+        return errors + ["no VSYNC pulse"]
+    v_start = v_edges[0]
+    width = 0
+    while v_start + width < len(vsync) and vsync[v_start + width] == v_on:
+        width += 1
+    if width != mode.v_sync * h_total:
+        errors.append(f"VSYNC pulse {width} pixels, expected {mode.v_sync * h_total}")
+    # The HSYNC edge at or just before the VSYNC edge belongs to the first sync line
+    k = max(i for i, e in enumerate(h_edges) if e <= v_start)
+
+    # Frame 0's visible lines end v_front lines before VSYNC, frame 1's
+    # first line follows v_sync + v_back lines after it
+    lines = [(m, k - mode.v_front - mode.height + m) for m in range(mode.height)]
+    lines.append((0, k + mode.v_sync + mode.v_back))
+    expected_lit = 0
+    end = 0
+    for m, j in lines:
+        if j < 0 or j >= len(h_edges):
+            errors.append(f"line {m} is outside the simulated span")
+            break
+        start = h_edges[j] - mode.h_front - mode.width
+        y = m // mode.repeat
+        expected = bytes(pixel(x // mode.repeat, y) for x in range(mode.width))
+        if bytes(colors[start:start + mode.width]) != expected:
+            errors.append(f"line {m} pixels wrong or misaligned")
+            break
+        if colors[start - 1] or colors[start + mode.width]:
+            errors.append(f"line {m} spills into blanking")
+            break
+        expected_lit += mode.width
+        end = start + mode.width
+    if not errors and sum(1 for c in colors[:end] if c) != expected_lit:
+        errors.append("pixels outside the visible lines")
+    return errors
+
+def simulate(modes=MODES):
+    """Check every mode's sync and RGB waveforms, one frame plus a line"""
+    for key, mode in modes.items():
+        sync_size = len(assemble(sync_program(mode))[0])
+        rgb_size = len(assemble(rgb_program(mode.repeat))[0])
+        start = time.perf_counter()
+        hsync, vsync, colors, pixel, sync, rgb = run_model(
+            mode, mode.v_total() + 2)
+        errors = check_waveform(mode, hsync, vsync, colors, pixel)
+        elapsed = time.perf_counter() - start
+        blank_irq = sync.cpu_irqs[0] if sync.cpu_irqs else None
+        print(f"{mode.name}: sync {sync_size} + RGB {rgb_size} = {sync_size + rgb_size}/32 "
+              f"instructions, blanking IRQ at pixel {blank_irq} "
+              f"(line {blank_irq // mode.h_total() if blank_irq else '-'})")
+        print(f"  {len(colors)} pixels simulated in {elapsed:.1f} s: "
+              f"{'waveform matches the timing table' if not errors else '; '.join(errors)}")
+
+        # Frames fed from the first blanking IRQ, a few lines late: the
+        # first frame is black and the second must start at line 0
+        late = 5 * mode.h_total()
+        frame = mode.v_total() * mode.h_total()
+        hsync, vsync, colors, pixel, sync, rgb = run_model(
+            mode, 2 * mode.v_total() + 2, feed_after=late)
+        errors = check_waveform(mode, hsync[frame:], vsync[frame:], colors[frame:], pixel)
+        if any(colors[:frame]):
+            errors.insert(0, "pixels during the unfed first frame")
+        print(f"  fed from the blanking IRQ 5 lines late, after rearm_rgb(): "
+              f"{'second frame matches' if not errors else '; '.join(errors)}")
+
+if __name__ == "__main__":
+    simulate()
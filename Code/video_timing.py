@@ -0,0 +1,188 @@
+"""
+Video Timing for the DPI Output
+===============================
+Standard video modes and a clock solver for hdmi_pico.py.
+
+The RP2040 makes its system clock from the 12 MHz crystal with a PLL:
+  sys_clk = 12 MHz * fbdiv / (postdiv1 * postdiv2)
+with the VCO (12 MHz * fbdiv) between 750 and 1600 MHz, fbdiv 16-320 and
+postdivs 1-7. Each PIO state machine then divides sys_clk by a 16.8 fixed
+point divider. solve_clock() searches every PLL setting and divider for the
+pixel clock closest to a mode's, preferring integer dividers: a fractional
+divider stretches some PIO cycles by one sys_clk, which shows as jitter.
+
+line_budget() works out what a mode asks of the RGB state machine's TX FIFO
+per scanline: bytes to deliver, how long the 8-word FIFO lasts, the DMA bus
+share and the frame size. check_mode() turns that into a list of problems,
+so a mode can be checked under CPython before flashing, optionally against
+the heap of a chip. Run this file to print the table.
+"""
+
+XOSC_HZ = 12_000_000
+VCO_MIN = 750_000_000
+VCO_MAX = 1_600_000_000
+FBDIV_MIN = 16
+FBDIV_MAX = 320
+POSTDIV_MAX = 7
+# Highest sys_clk to consider (RP2040 rated speed; the RP2350 runs at 150 MHz)
+MAX_SYS_CLK = 133_000_000
+# VESA monitors accept a pixel clock within 0.5%
+MAX_CLOCK_ERROR = 0.005
+
+# RGB state machine TX FIFO joined to 8 words
+FIFO_BYTES = 32
+BYTES_PER_PIXEL = 1  # RGB332
+# Approximate MicroPython heap left for a frame on each chip
+HEAP_BYTES = {'RP2040': 190 * 1024, 'RP2350': 460 * 1024}
+
+class VideoMode:
+    """Pixel clock, horizontal and vertical timing of one video mode"""
+    def __init__(self, name, pixel_clock, h, v, hsync_positive=False,
+                 vsync_positive=False, repeat=1):
+        self.name = name
+        self.pixel_clock = pixel_clock
+        self.width, self.h_front, self.h_sync, self.h_back = h
+        self.height, self.v_front, self.v_sync, self.v_back = v
+        self.hsync_positive = hsync_positive
+        self.vsync_positive = vsync_positive
+        self.repeat = repeat  # output pixels and lines per stored pixel and line
+
+    def h_total(self):
+        return self.width + self.h_front + self.h_sync + self.h_back
+
+    def v_total(self):
+        return self.height + self.v_front + self.v_sync + self.v_back
+
+    def refresh(self, pixel_clock=None):
+        return (pixel_clock or self.pixel_clock) / (self.h_total() * self.v_total())
+
+    def stored_size(self):
+        """Width and height of the framebuffer behind this mode"""
+        return self.width // self.repeat, self.height // self.repeat
+
+MODES = {
+    '640x480': VideoMode('640x480@60', 25_175_000, (640, 16, 96, 48), (480, 10, 2, 33)),
+    '800x600': VideoMode('800x600@56', 36_000_000, (800, 24, 72, 128), (600, 1, 2, 22),
+                         hsync_positive=True, vsync_positive=True),
+    '720x400': VideoMode('720x400@70', 28_322_000, (720, 18, 108, 54), (400, 12, 2, 35),
+                         vsync_positive=True),
+    # 640x480 timing with every pixel and line sent twice
+    '320x240': VideoMode('320x240@60 doubled', 25_175_000, (640, 16, 96, 48), (480, 10, 2, 33),
+                         repeat=2),
+}
+
+class ClockSetting:
+    """PLL and PIO divider settings found by solve_clock()"""
+    def __init__(self, fbdiv, postdiv1, postdiv2, div_int, div_frac, cycles_per_pixel, target):
+        self.fbdiv = fbdiv
+        self.postdiv1 = postdiv1
+        self.postdiv2 = postdiv2
+        self.div_int = div_int
+        self.div_frac = div_frac    # 1/256ths
+        self.vco = XOSC_HZ * fbdiv
+        self.sys_clk = self.vco // (postdiv1 * postdiv2)
+        self.divider = div_int + div_frac / 256
+        self.pio_freq = self.sys_clk / self.divider
+        self.pixel_clock = self.pio_freq / cycles_per_pixel
+        self.error = (self.pixel_clock - target) / target
+
+    def __repr__(self):
+        return (f"sys_clk {self.sys_clk / 1e6:.3f} MHz (fbdiv {self.fbdiv}, "
+                f"postdiv {self.postdiv1}/{self.postdiv2}), PIO divider {self.divider:g}, "
+                f"pixel clock {self.pixel_clock / 1e6:.4f} MHz ({self.error * 1e6:+.0f} ppm)")
+
+def pll_settings(max_sys_clk=MAX_SYS_CLK):
+    """Yield (sys_clk, fbdiv, postdiv1, postdiv2) for every exact PLL setting"""
+    for fbdiv in range(FBDIV_MIN, FBDIV_MAX + 1):
+        vco = XOSC_HZ * fbdiv
+        if vco < VCO_MIN or vco > VCO_MAX:
+            continue
+        for postdiv1 in range(1, POSTDIV_MAX + 1):
+            for postdiv2 in range(1, postdiv1 + 1):
+                if vco % (postdiv1 * postdiv2):
+                    continue
+                sys_clk = vco // (postdiv1 * postdiv2)
+                if sys_clk <= max_sys_clk:
+                    yield sys_clk, fbdiv, postdiv1, postdiv2
+
+def solve_clock(pixel_clock, cycles_per_pixel=1, max_sys_clk=MAX_SYS_CLK, fractional=False):
+    """Return the ClockSetting with the smallest pixel clock error
+
+    Integer dividers win over fractional ones unless fractional is True, and
+    among equal errors the faster sys_clk wins (more CPU for drawing).
+    """
+    pio_target = pixel_clock * cycles_per_pixel
+    best = None
+    best_key = None
+    for sys_clk, fbdiv, postdiv1, postdiv2 in pll_settings(max_sys_clk):
+        ideal = sys_clk / pio_target
+        if ideal < 1:
+            continue
+        if fractional:
+            steps = min(max(round(ideal * 256), 256), 65536 * 256)
+        else:
+            steps = min(round(ideal), 65536) * 256
+        setting = ClockSetting(fbdiv, postdiv1, postdiv2, steps >> 8, steps & 0xFF,
+                               cycles_per_pixel, pixel_clock)
+        key = (round(abs(setting.error) * 1e9), setting.div_frac != 0, -sys_clk)
+        if best_key is None or key < best_key:
+            best = setting
+            best_key = key
+    if best is None:
+        raise ValueError(f"No sys_clk up to {max_sys_clk} Hz reaches {pixel_clock} Hz")
+    return best
+
+def line_budget(mode, clock, fifo_bytes=FIFO_BYTES):
+    """Per-scanline FIFO figures for mode at the achieved clock"""
+    line_bytes = mode.width // mode.repeat * BYTES_PER_PIXEL
+    line_time = mode.h_total() / clock.pixel_clock
+    # Source bytes drain at the pixel clock divided by the pixel repeat
+    drain_rate = clock.pixel_clock / mode.repeat * BYTES_PER_PIXEL
+    words = (line_bytes + 3) // 4
+    return {
+        'line_bytes': line_bytes,
+        'line_words': words,
+        'line_time_us': line_time * 1e6,
+        'active_time_us': mode.width / clock.pixel_clock * 1e6,
+        'fifo_time_us': fifo_bytes / drain_rate * 1e6,   # how long a full FIFO lasts
+        'sys_clks_per_word': clock.sys_clk * 4 / drain_rate,
+        'dma_share': words / (line_time * clock.sys_clk),  # bus cycles used by the DMA
+        'frame_bytes': line_bytes * (mode.height // mode.repeat),
+        'refresh': mode.refresh(clock.pixel_clock),
+    }
+
+def check_mode(mode, clock=None, heap_bytes=None, frame_bytes=None):
+    """Return a list of reasons mode will not work (empty when it should).
+    With heap_bytes, the frame must also fit in it: frame_bytes if given
+    (see framebuffer.frame_bytes()), else a full RGB332 frame."""
+    clock = clock or solve_clock(mode.pixel_clock)
+    budget = line_budget(mode, clock)
+    if frame_bytes is None:
+        frame_bytes = budget['frame_bytes']
+    problems = []
+    if abs(clock.error) > MAX_CLOCK_ERROR:
+        problems.append(f"pixel clock off by {clock.error * 100:+.2f}%")
+    if budget['sys_clks_per_word'] < 1:
+        problems.append("FIFO drains faster than one word per sys_clk")
+    if heap_bytes and frame_bytes > heap_bytes:
+        problems.append(f"{frame_bytes // 1024} KB frame does not fit "
+                        f"in a {heap_bytes // 1024} KB heap")
+    return problems
+
+def print_table(modes=MODES, max_sys_clk=MAX_SYS_CLK):
+    for key, mode in modes.items():
+        clock = solve_clock(mode.pixel_clock, max_sys_clk=max_sys_clk)
+        budget = line_budget(mode, clock)
+        problems = check_mode(mode, clock)
+        print(f"{mode.name}: {mode.h_total()}x{mode.v_total()} total, {budget['refresh']:.2f} Hz")
+        print(f"  {clock}")
+        print(f"  {budget['line_bytes']} bytes ({budget['line_words']} words) per "
+              f"{budget['line_time_us']:.2f} us line, full FIFO lasts {budget['fifo_time_us']:.2f} us, "
+              f"DMA {budget['dma_share'] * 100:.1f}% of bus cycles, "
+              f"frame {budget['frame_bytes'] // 1024} KB")
+        print(f"  {'OK' if not problems else 'NOT ACHIEVABLE: ' + '; '.join(problems)}")
+        fits = [chip for chip, heap in HEAP_BYTES.items() if not check_mode(mode, clock, heap)]
+        print(f"  full frame fits on: {', '.join(fits) or 'neither'}")
+
+if __name__ == "__main__":
+    print_table()
@@ -3,10 +3,37 @@ Raspberry Pi Pico 2 Multi-Ribbon Cable Interface System
 Handles keyboard matrix, trackpad I2C, and USB ribbon connections
 """
 
-from machine import Pin, I2C, UART
+from machine import Pin, I2C, UART, mem32
 import time
 import json
 import sys
+from matrix_scan import PinBank, MatrixScanner, NO_EVENT, event_name, event_pressed
+from debounce import Debouncer
+from ghosting import GhostFilter
+from pio_scan import PioBank
+from telemetry import TelemetryLink, BINARY, JSON
+from scheduler import RibbonScheduler, DeadlinePoller
+from trackpad import PointerMotion, DataReady, SAMPLE_SIZE, GAIN_ONE
+from gestures import GestureEngine, MULTI_SAMPLE_SIZE, PALM_SIZE
+from hid_output import (HIDSender, KeyboardReport, keyboard_sender, keymap_table,
+                        start_usb, MOUSE_DESCRIPTOR, MOUSE_REPORT_SIZE, PROTOCOL_MOUSE)
+
+TELEMETRY_BAUD = 115200
+# 'asyncio': one task per device at its own rate (see scheduler.py)
+# 'loop': poll due devices, most overdue first, from a single loop
+SCHEDULER = 'asyncio'
+# Checks per second for a trackpad with a data-ready line (no bus traffic
+# unless the pad has a sample)
+DATA_READY_RATE = 1000
+
+# RP2040/RP2350 SIO register holding the input level of GPIO0-31
+SIO_GPIO_IN = 0xd0000004
+
+def read_gpio_in():
+    return mem32[SIO_GPIO_IN]
+
+def is_contiguous(pins):
+    return pins == list(range(pins[0], pins[0] + len(pins)))
 
 class RibbonConfig:
     """Stores configuration for each ribbon connector"""
@@ -18,45 +45,114 @@ class RibbonConfig:
 
 class KeyboardMatrix:
     """Handles keyboard matrix scanning"""
-    def __init__(self, row_pins, col_pins):
-        self.rows = [Pin(p, Pin.OUT) for p in row_pins]
-        self.cols = [Pin(p, Pin.IN, Pin.PULL_DOWN) for p in col_pins]
-        self.key_state = {}
+    def __init__(self, row_pins, col_pins, settle_us=10,
+                 debounce='deferred', debounce_ms=5, ghosting='suppress',
+                 scan='gpio', pio_sm=0):
+        self.rows = [Pin(p, Pin.OUT, value=1) for p in row_pins]
+        self.cols = [Pin(p, Pin.IN, Pin.PULL_UP) for p in col_pins]
         
-        # Initialize all rows high
-        for row in self.rows:
-            row.value(1)
+        # A PIO state machine can scan consecutive row and column pins by itself
+        self.pio = None
+        if scan == 'pio':
+            if is_contiguous(row_pins) and is_contiguous(col_pins):
+                self.pio = PioBank.start(pio_sm, row_pins, col_pins, settle_us)
+            else:
+                print("PIO scan needs consecutive row and column pins, using GPIO scan")
+        
+        if self.pio is not None:
+            self.bank = self.pio
+        else:
+            # Contiguous column pins can be sampled with a single port read
+            read_port = read_gpio_in if is_contiguous(col_pins) else None
+            self.bank = PinBank(self.rows, self.cols, settle_us,
+                                read_port, col_pins[0])
+        debouncer = None
+        if debounce:
+            debouncer = Debouncer(len(self.rows), len(self.cols),
+                                  debounce, debounce_ms)
+        # Laptop matrices have no diodes, so filter out phantom keys
+        self.ghost_filter = GhostFilter(len(self.rows), ghosting) if ghosting else None
+        self.scanner = MatrixScanner(self.bank, len(self.rows), len(self.cols),
+                                     debouncer=debouncer,
+                                     ghost_filter=self.ghost_filter)
+        self.key_state = self.scanner.state  # one column bitmask per row
+        self.hid = None  # KeyboardReport when the keys go out as USB HID
     
     def scan(self):
         """Scan keyboard matrix and return pressed keys"""
-        pressed = []
-        
-        for row_idx, row in enumerate(self.rows):
-            # Set current row low, others high
-            for r in self.rows:
-                r.value(1)
-            row.value(0)
-            
-            time.sleep_us(10)  # Settling time
-            
-            # Check columns
-            for col_idx, col in enumerate(self.cols):
-                if col.value() == 0:  # Active low when pressed
-                    key = (row_idx, col_idx)
-                    pressed.append(key)
-        
-        return pressed
+        self.scanner.scan()
+        return self.scanner.pressed()
     
     def get_keys(self):
         """Get formatted key presses"""
         keys = self.scan()
         return [f"R{r}C{c}" for r, c in keys]
+    
+    def get_event_codes(self):
+        """Scan and return key changes as packed event codes (see matrix_scan)"""
+        scanner = self.scanner
+        scanner.scan()
+        events = []
+        event = scanner.pop_event()
+        while event != NO_EVENT:
+            events.append(event)
+            event = scanner.pop_event()
+        if self.hid is not None:
+            # Also resends a report that found USB busy last time
+            self.hid.update(events)
+        return events
+    
+    def get_events(self):
+        """Scan and return key changes as "+R{r}C{c}" (press) / "-R{r}C{c}" (release)"""
+        return [event_name(event) for event in self.get_event_codes()]
+    
+    def get_stats(self):
+        """Get n-key-rollover and ghosting statistics"""
+        if self.ghost_filter is None:
+            return None
+        stats = self.ghost_filter.stats()
+        stats['events_dropped'] = self.scanner.events_dropped
+        if self.pio is not None:
+            stats['pio_words'] = self.pio.words
+        return stats
+    
+    def deinit(self):
+        """Release the PIO state machine, if one is scanning"""
+        if self.pio is not None:
+            self.pio.deinit()
+            self.pio = None
 
 class TrackpadI2C:
     """Handles I2C trackpad communication"""
-    def __init__(self, sda_pin, scl_pin, address=0x2A, freq=400000):
+    def __init__(self, sda_pin, scl_pin, address=0x2A, freq=400000, register=None,
+                 touch_mask=0, curve='classic', sensitivity=GAIN_ONE, mouse=None,
+                 int_pin=None, int_active_low=True, sample_format='single',
+                 palm_size=PALM_SIZE):
         self.i2c = I2C(0, sda=Pin(sda_pin), scl=Pin(scl_pin), freq=freq)
         self.address = address
+        # Register to read from after a repeated start, or None for a plain read
+        self.register = register
+        # Status bits set while a finger is down (0: the pad does not say)
+        self.touch_mask = touch_mask
+        self.motion = PointerMotion(curve, sensitivity)
+        # 'single': X_low, X_high, Y_low, Y_high, buttons, status
+        # 'multi': several contacts, interpreted by a GestureEngine
+        self.gestures = None
+        if sample_format == 'multi':
+            self.sample = bytearray(MULTI_SAMPLE_SIZE)
+            self.gestures = GestureEngine(self.motion, palm_size)
+        else:
+            self.sample = bytearray(SAMPLE_SIZE)  # reused for every read
+        self.x = 0
+        self.y = 0
+        self.buttons = 0
+        self.mouse = mouse  # HIDSender for mouse reports, or None
+        # Data-ready/interrupt line; without one every poll reads the bus
+        self.ready = None
+        if int_pin is not None:
+            pull = Pin.PULL_UP if int_active_low else Pin.PULL_DOWN
+            self.ready = DataReady(Pin(int_pin, Pin.IN, pull), int_active_low)
+        self.reads = 0
         self.available = self.check_device()
     
     def check_device(self):
@@ -67,29 +163,65 @@ class TrackpadI2C:
         except:
             return False
     
-    def read_data(self):
-        """Read trackpad data (implementation depends on specific trackpad)"""
+    def poll(self):
+        """Read a sample, update the pointer motion and send a mouse report if
+        one is due. Allocates nothing; returns True if x, y or buttons changed."""
         if not self.available:
-            return None
+            return False
+        if self.ready is not None and not self.ready.pending():
+            return False
         
+        sample = self.sample
+        self.reads += 1
         try:
-            # Example: read 6 bytes (X_low, X_high, Y_low, Y_high, buttons, status)
-            data = self.i2c.readfrom(self.address, 6)
-            
-            x = (data[1] << 8) | data[0]
-            y = (data[3] << 8) | data[2]
-            buttons = data[4]
-            
-            return {
-                'x': x,
-                'y': y,
-                'buttons': buttons,
-                'left_click': bool(buttons & 0x01),
-                'right_click': bool(buttons & 0x02)
-            }
+            if self.register is None:
+                self.i2c.readfrom_into(self.address, sample)
+            else:
+                self.i2c.readfrom_mem_into(self.address, self.register, sample)
         except Exception as e:
             print(f"Trackpad read error: {e}")
+            return False
+        
+        motion = self.motion
+        gestures = self.gestures
+        if gestures is not None:
+            gestures.feed(time.ticks_ms(), sample)
+            x = gestures.x
+            y = gestures.y
+            buttons = sample[0]
+        else:
+            x = (sample[1] << 8) | sample[0]
+            y = (sample[3] << 8) | sample[2]
+            buttons = sample[4]
+            touching = not self.touch_mask or bool(sample[5] & self.touch_mask)
+            motion.update(x, y, buttons, touching)
+        
+        mouse = self.mouse
+        if mouse is not None and motion.pending() and mouse.ready():
+            motion.fill_report(mouse.report)
+            if mouse.send():
+                motion.commit()
+        
+        changed = x != self.x or y != self.y or buttons != self.buttons
+        if gestures is not None and gestures.event_count:
+            changed = True
+        self.x = x
+        self.y = y
+        self.buttons = buttons
+        return changed
+    
+    def read_data(self):
+        """Read trackpad data as a dict (for the REPL; poll() is the per-sample path)"""
+        if not self.available:
             return None
+        self.poll()
+        return {
+            'x': self.x,
+            'y': self.y,
+            'buttons': self.buttons,
+            'left_click': bool(self.buttons & 0x01),
+            'right_click': bool(self.buttons & 0x02)
+        }
 
 class USBPassthrough:
     """Handles USB data line passthrough"""
@@ -111,7 +243,12 @@ class RibbonManager:
     def __init__(self):
         self.devices = {}
         self.configs = []
-        self.uart = UART(0, baudrate=115200, tx=Pin(0), rx=Pin(1))
+        self.uart = UART(0, baudrate=TELEMETRY_BAUD, tx=Pin(0), rx=Pin(1))
+        self.telemetry = TelemetryLink(self.uart, TELEMETRY_BAUD)
+        self.poller = DeadlinePoller()
+        # Per-connector timing for 'stats'; RibbonScheduler swaps in its own
+        self.task_stats = self.poller.stats
+        self.hid_senders = []  # USB HID interfaces of the configured devices
     
     def load_config(self, config_json):
         """Load configuration from JSON string"""
@@ -125,6 +262,8 @@ class RibbonManager:
                     cfg.get('params', {})
                 ))
             print(f"Loaded {len(configs)} device configurations")
+            if start_usb(self.hid_senders):
+                print(f"USB HID: {len(self.hid_senders)} interface(s)")
             return True
         except Exception as e:
             print(f"Config load error: {e}")
@@ -136,13 +275,47 @@ class RibbonManager:
             if config.device_type == 'keyboard':
                 device = KeyboardMatrix(
                     config.pins['rows'],
-                    config.pins['cols']
+                    config.pins['cols'],
+                    config.params.get('settle_us', 10),
+                    config.params.get('debounce', 'deferred'),
+                    config.params.get('debounce_ms', 5),
+                    config.params.get('ghosting', 'suppress'),
+                    config.params.get('scan', 'gpio'),
+                    config.params.get('pio_sm', 0)
                 )
+                # With a keymap the keyboard types on the host by itself
+                keymap = config.params.get('keymap')
+                report = config.params.get('hid', '6kro')
+                if keymap and report:
+                    nkro = report == 'nkro'
+                    sender = keyboard_sender(nkro)
+                    self.hid_senders.append(sender)
+                    num_cols = len(config.pins['cols'])
+                    device.hid = KeyboardReport(
+                        sender,
+                        keymap_table(keymap, len(config.pins['rows']), num_cols),
+                        num_cols, nkro)
             elif config.device_type == 'trackpad':
+                int_pin = config.pins.get('int')
+                if int_pin is not None:
+                    config.params.setdefault('rate_hz', DATA_READY_RATE)
+                mouse = None
+                if config.params.get('hid', True):
+                    mouse = HIDSender(MOUSE_DESCRIPTOR, MOUSE_REPORT_SIZE, PROTOCOL_MOUSE)
+                    self.hid_senders.append(mouse)
                 device = TrackpadI2C(
                     config.pins['sda'],
                     config.pins['scl'],
-                    config.params.get('address', 0x2A)
+                    config.params.get('address', 0x2A),
+                    register=config.params.get('register'),
+                    touch_mask=config.params.get('touch_mask', 0),
+                    curve=config.params.get('curve', 'classic'),
+                    sensitivity=config.params.get('sensitivity', GAIN_ONE),
+                    mouse=mouse,
+                    int_pin=int_pin,
+                    int_active_low=config.params.get('int_active_low', True),
+                    sample_format=config.params.get('format', 'single'),
+                    palm_size=config.params.get('palm_size', PALM_SIZE)
                 )
             elif config.device_type == 'usb':
                 device = USBPassthrough(
@@ -157,12 +330,13 @@ class RibbonManager:
                 'device': device,
                 'config': config
             }
+            self.poller.add(config.connector_id, config)
             print(f"Added {config.device_type} on connector {config.connector_id}")
         except Exception as e:
             print(f"Error adding device {config.connector_id}: {e}")
     
     def read_device(self, connector_id):
-        """Read data from specific device"""
+        """Read changes from specific device, None if nothing changed"""
         if connector_id not in self.devices:
             return None
         
@@ -171,38 +345,127 @@ class RibbonManager:
         
         try:
             if device_type == 'keyboard':
-                return dev['device'].get_keys()
+                return dev['device'].get_event_codes()
             elif device_type == 'trackpad':
-                return dev['device'].read_data()
+                # Motion already went out as a mouse report; the device is
+                # returned as-is so nothing is allocated per sample
+                return dev['device'] if dev['device'].poll() else None
             elif device_type == 'usb':
-                return {'connected': dev['device'].check_connection()}
+                data = {'connected': dev['device'].check_connection()}
+            else:
+                return None
         except Exception as e:
             print(f"Error reading {connector_id}: {e}")
             return None
+        
+        # Only forward readings that differ from the last one sent
+        if data == dev.get('last'):
+            return None
+        dev['last'] = data
+        return data
     
     def poll_all(self):
-        """Poll all connected devices"""
-        results = {}
-        for conn_id in self.devices:
-            data = self.read_device(conn_id)
-            if data:
-                results[conn_id] = data
-        return results
+        """Poll the devices that are due, most overdue first, and return only the changes"""
+        return self.poller.poll(self.read_device)
+    
+    def clear_devices(self):
+        """Remove all devices, stopping any PIO keyboard scanners"""
+        for dev in self.devices.values():
+            if dev['config'].device_type == 'keyboard':
+                dev['device'].deinit()
+        self.devices.clear()
+        self.poller.clear()
+        self.hid_senders = []
+    
+    def get_stats(self):
+        """Collect rollover statistics from all keyboards and bus reads from trackpads"""
+        stats = {}
+        for conn_id, dev in self.devices.items():
+            device_type = dev['config'].device_type
+            if device_type == 'keyboard':
+                stats[conn_id] = dev['device'].get_stats()
+            elif device_type == 'trackpad':
+                device = dev['device']
+                stats[conn_id] = {'reads': device.reads,
+                                  'data_ready': device.ready is not None}
+                if device.gestures is not None:
+                    stats[conn_id]['gestures'] = device.gestures.stats()
+        return stats
+    
+    def report(self, results):
+        """Print changes from poll_all() or read_device() and queue them for the UART"""
+        for conn_id, values in results.items():
+            device_type = self.devices[conn_id]['config'].device_type
+            if device_type == 'trackpad':
+                continue  # up to 200 samples/s: printing would cost more than the read
+            if device_type == 'keyboard':
+                values = [event_name(event) for event in values]
+            print(f"{conn_id}: {values}")
+        self.send_changes(results)
+    
+    def send_changes(self, results):
+        """Queue the changes from poll_all() for the next telemetry frame"""
+        telemetry = self.telemetry
+        for conn_id, data in results.items():
+            dev = self.devices[conn_id]
+            device_type = dev['config'].device_type
+            if device_type == 'keyboard':
+                # The key state lets the host resync if events are dropped
+                telemetry.key_events(conn_id, data, dev['device'].key_state)
+                self.note_typing(data)
+            elif device_type == 'trackpad':
+                telemetry.trackpad(conn_id, data.x, data.y, data.buttons)
+                if data.gestures is not None:
+                    event = data.gestures.pop_event()
+                    while event != NO_EVENT:
+                        telemetry.gesture(conn_id, event)
+                        event = data.gestures.pop_event()
+            elif device_type == 'usb':
+                telemetry.usb(conn_id, data['connected'])
+    
+    def note_typing(self, events):
+        """Tell the gesture engines about key presses, for palm rejection"""
+        for event in events:
+            if event_pressed(event):
+                now = time.ticks_ms()
+                for dev in self.devices.values():
+                    device = dev['device']
+                    if dev['config'].device_type == 'trackpad' and device.gestures is not None:
+                        device.gestures.note_typing(now)
+                return
     
     def send_status(self, data):
-        """Send status over UART"""
-        try:
-            json_str = json.dumps(data) + '\n'
-            self.uart.write(json_str)
-        except:
-            pass
+        """Queue a status object (e.g. statistics) for the next telemetry frame"""
+        self.telemetry.text(data)
+    
+    def set_telemetry_mode(self, mode):
+        """Switch between binary frames and JSON lines"""
+        self.telemetry.flush()
+        self.telemetry = TelemetryLink(self.uart, TELEMETRY_BAUD, mode)
+        print(f"Telemetry mode: {mode}")
+    
+    def handle_command(self, cmd):
+        """Act on a command from check_commands(); returns True if the devices changed"""
+        if cmd == 'stats':
+            status = {'stats': self.get_stats(), 'telemetry': self.telemetry.stats()}
+            if self.task_stats:
+                status['tasks'] = {name: stats.summary() for name, stats in self.task_stats.items()}
+            self.send_status(status)
+        elif cmd in (BINARY, JSON):
+            self.set_telemetry_mode(cmd)
+        else:
+            print("Reconfiguring...")
+            self.clear_devices()
+            self.load_config(cmd)
+            return True
+        return False
     
     def check_commands(self):
         """Check for incoming configuration commands"""
         if self.uart.any():
             try:
                 cmd = self.uart.readline().decode('utf-8').strip()
-                if cmd.startswith('{'):
+                if cmd.startswith('{') or cmd in ('stats', BINARY, JSON):
                     return cmd
             except:
                 pass
@@ -266,35 +529,32 @@ def main():
     
     print("Starting main loop...")
     print("Send JSON config via serial to reconfigure")
+    print("Send 'stats' for keyboard rollover statistics")
+    print("Send 'json' or 'binary' to choose the telemetry format")
     print("")
     
-    # Main loop
-    last_poll = 0
-    poll_interval = 0.05  # 50ms polling
-    
+    if SCHEDULER == 'asyncio':
+        RibbonScheduler(manager).run()
+    else:
+        poll_loop(manager)
+
+def poll_loop(manager):
+    """Poll devices from a single loop as they fall due (see DeadlinePoller)"""
     while True:
         # Check for new configuration
         cmd = manager.check_commands()
         if cmd:
-            print("Reconfiguring...")
-            manager.devices.clear()
-            manager.load_config(cmd)
+            manager.handle_command(cmd)
         
-        # Poll devices
-        if time.time() - last_poll >= poll_interval:
-            data = manager.poll_all()
-            if data:
-                # Print to console
-                for conn_id, values in data.items():
-                    if values:
-                        print(f"{conn_id}: {values}")
-                
-                # Send over UART
-                manager.send_status(data)
-            
-            last_poll = time.time()
+        # Poll the devices whose rate says they are due
+        data = manager.poll_all()
+        if data:
+            manager.report(data)
+        
+        # Send a frame whenever the UART has finished the last one
+        manager.telemetry.flush()
         
-        time.sleep(0.01)
+        time.sleep_us(100)
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,222 @@
+"""
+Per-key debounce filters for the matrix scan engine
+Filters raw row bitmasks from MatrixScanner with a time-based window.
+Each key has one 8-bit millisecond counter in a shared bytearray, and rows
+with no pending keys cost a single comparison per scan.
+
+Algorithms:
+  eager     - report a change at once, then ignore the key for the window
+  deferred  - report a change once the key has been stable for the window
+  symmetric - integrate toward/away from a change, report when it fills the window
+
+Run with CPython to replay bouncy waveforms and print the added latency of
+each algorithm.
+"""
+
+from array import array
+
+EAGER = 'eager'
+DEFERRED = 'deferred'
+SYMMETRIC = 'symmetric'
+ALGORITHMS = (EAGER, DEFERRED, SYMMETRIC)
+
+class Debouncer:
+    """Debounces a matrix of num_rows x num_cols keys"""
+    def __init__(self, num_rows, num_cols, algorithm=DEFERRED, window_ms=5):
+        if algorithm not in ALGORITHMS:
+            raise ValueError(f"Unknown debounce algorithm: {algorithm}")
+        if not 0 < window_ms < 256:
+            raise ValueError("window_ms must be between 1 and 255")
+        self.num_cols = num_cols
+        self.algorithm = algorithm
+        self.window_ms = window_ms
+        self.state = array('L', [0] * num_rows)   # debounced row bitmasks
+        self.raw = array('L', [0] * num_rows)     # last raw row bitmasks
+        self.active = array('L', [0] * num_rows)  # keys with a running counter
+        self.counters = bytearray(num_rows * num_cols)
+        self.last_ms = None
+        self.dt = 0
+
+    def begin(self, now_ms):
+        """Start a scan pass, now_ms from ticks_ms()"""
+        if self.last_ms is None:
+            self.dt = 0
+        else:
+            self.dt = min((now_ms - self.last_ms) & 0xFFFF, 255)
+        self.last_ms = now_ms
+
+    def filter(self, row, raw):
+        """Feed one raw row bitmask, return the debounced bitmask"""
+        stable = self.state[row]
+        bounced = raw ^ self.raw[row]
+        work = (raw ^ stable) | self.active[row] | bounced
+        if not work:
+            return stable
+
+        self.raw[row] = raw
+        if self.algorithm == EAGER:
+            self.filter_eager(row, raw, work)
+        elif self.algorithm == DEFERRED:
+            self.filter_deferred(row, raw, work, bounced)
+        else:
+            self.filter_symmetric(row, raw, work)
+        return self.state[row]
+
+    def filter_eager(self, row, raw, work):
+        counters = self.counters
+        dt = self.dt
+        stable = self.state[row]
+        active = self.active[row]
+        i = row * self.num_cols
+        bit = 1
+        while work:
+            if work & 1:
+                if active & bit:
+                    # Key locked out: count down the remaining window
+                    left = counters[i] - dt
+                    if left > 0:
+                        counters[i] = left
+                    else:
+                        counters[i] = 0
+                        active &= ~bit
+                if not active & bit and (raw ^ stable) & bit:
+                    stable ^= bit
+                    counters[i] = self.window_ms
+                    active |= bit
+            work >>= 1
+            bit <<= 1
+            i += 1
+        self.state[row] = stable
+        self.active[row] = active
+
+    def filter_deferred(self, row, raw, work, bounced):
+        counters = self.counters
+        dt = self.dt
+        stable = self.state[row]
+        active = self.active[row]
+        i = row * self.num_cols
+        bit = 1
+        while work:
+            if work & 1:
+                if not (raw ^ stable) & bit:
+                    # Bounced back to the reported level
+                    counters[i] = 0
+                    active &= ~bit
+                elif bounced & bit or not active & bit:
+                    # Raw level just changed: restart the stability window
+                    counters[i] = 0
+                    active |= bit
+                else:
+                    elapsed = min(counters[i] + dt, 255)
+                    if elapsed >= self.window_ms:
+                        stable ^= bit
+                        counters[i] = 0
+                        active &= ~bit
+                    else:
+                        counters[i] = elapsed
+            work >>= 1
+            bit <<= 1
+            i += 1
+        self.state[row] = stable
+        self.active[row] = active
+
+    def filter_symmetric(self, row, raw, work):
+        counters = self.counters
+        dt = self.dt
+        stable = self.state[row]
+        active = self.active[row]
+        i = row * self.num_cols
+        bit = 1
+        while work:
+            if work & 1:
+                if (raw ^ stable) & bit:
+                    level = min(counters[i] + dt, 255)
+                    if level >= self.window_ms:
+                        stable ^= bit
+                        level = 0
+                else:
+                    level = max(counters[i] - dt, 0)
+                counters[i] = level
+                if level or (raw ^ stable) & bit:
+                    active |= bit
+                else:
+                    active &= ~bit
+            work >>= 1
+            bit <<= 1
+            i += 1
+        self.state[row] = stable
+        self.active[row] = active
+
+# --- Waveform replay harness ---
+# A trace is a list of (time_ms, level) edges for one key, level 1 = closed.
+# The first entry of each tuple in BOUNCY_TRACES is the clean edge time the
+# key is considered to have really changed at.
+BOUNCY_TRACES = {
+    'clean': (
+        (10, 40),
+        [(10, 1), (40, 0)],
+    ),
+    'press bounce': (
+        (10, 40),
+        [(10, 1), (11, 0), (12, 1), (13, 0), (14, 1), (40, 0)],
+    ),
+    'release bounce': (
+        (10, 40),
+        [(10, 1), (40, 0), (41, 1), (42, 0), (44, 1), (45, 0)],
+    ),
+    'long chatter': (
+        (10, 50),
+        [(10, 1), (11, 0), (13, 1), (14, 0), (17, 1), (18, 0), (19, 1),
+         (50, 0), (51, 1), (52, 0), (55, 1), (56, 0)],
+    ),
+}
+
+def load_trace(path):
+    """Load a trace recorded as "time_ms,level" lines"""
+    edges = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                t, level = line.split(',')
+                edges.append((int(t), int(level)))
+    return edges
+
+def replay(edges, algorithm, window_ms=5, scan_period_ms=1, end_ms=None):
+    """Sample a trace at the scan rate, return the debounced (time_ms, level) edges"""
+    if end_ms is None:
+        end_ms = edges[-1][0] + 4 * window_ms
+    debouncer = Debouncer(1, 1, algorithm, window_ms)
+    reported = []
+    level = 0
+    edge = 0
+    last = 0
+    for now in range(0, end_ms + 1, scan_period_ms):
+        while edge < len(edges) and edges[edge][0] <= now:
+            level = edges[edge][1]
+            edge += 1
+        debouncer.begin(now)
+        out = debouncer.filter(0, level)
+        if out != last:
+            reported.append((now, out))
+            last = out
+    return reported
+
+def benchmark(window_ms=5):
+    """Replay BOUNCY_TRACES through every algorithm and print latency/chatter"""
+    for name, (true_edges, edges) in BOUNCY_TRACES.items():
+        print(f"{name}:")
+        for algorithm in ALGORITHMS:
+            reported = replay(edges, algorithm, window_ms)
+            presses = [t for t, level in reported if level]
+            releases = [t for t, level in reported if not level]
+            if presses and releases:
+                press_lat = presses[0] - true_edges[0]
+                release_lat = releases[0] - true_edges[1]
+                print(f"  {algorithm:9}  press {press_lat:+d} ms, release {release_lat:+d} ms, "
+                      f"{len(reported) - 2} extra edges")
+            else:
+                print(f"  {algorithm:9}  missed key: {reported}")
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,356 @@
+"""
+Multi-finger gestures for the Multi-Ribbon trackpad
+For trackpads that report several contacts (param "format": "multi"). Each
+sample is read into a reused buffer laid out as
+
+  buttons | contact count | x_lo x_hi y_lo y_hi size  (per contact, up to 3)
+
+and GestureEngine.feed() turns it into:
+  - pointer motion from a single finger (through PointerMotion);
+  - tap-to-click: a short touch that barely moves clicks the left button,
+    two fingers the right button, three the middle one;
+  - two-finger scroll, sent as mouse wheel motion;
+  - pinch, queued as zoom events for the host;
+  - palm rejection: a touch in which any contact is larger than palm_size
+    is ignored until every finger lifts, and a tap that starts right after
+    typing (note_typing()) does not click.
+
+Two fingers only become a scroll or a pinch once the centroid or the
+finger spread has changed by a threshold across a ring buffer of the last
+few samples, so a still resting pair does neither. Everything is integer
+arithmetic on preallocated arrays: nothing is allocated per sample.
+Events (taps and zoom steps) wait in a small ring like the matrix events
+and are popped as packed ints. Run with CPython to replay touch traces
+(built in, or files with one "ms buttons x,y,size ..." line per sample)
+and time each sample.
+"""
+
+from array import array
+import time
+from matrix_scan import ticks_diff, NO_EVENT
+
+MAX_CONTACTS = 3
+CONTACT_SIZE = 5
+MULTI_SAMPLE_SIZE = 2 + MAX_CONTACTS * CONTACT_SIZE
+
+# Thresholds in trackpad units (about 10 per mm) and milliseconds
+TAP_MS = 180          # longest touch that still counts as a tap
+TAP_SLOP = 30         # furthest a tap may travel
+PALM_SIZE = 60        # contact size from which a touch is a palm
+TYPING_GUARD_MS = 300 # no tap-to-click this soon after a key press
+SCROLL_START = 20     # centroid travel across the ring that starts a scroll
+PINCH_START = 40      # spread change across the ring that starts a pinch
+SCROLL_UNITS = 32     # trackpad units per wheel detent
+PINCH_UNITS = 40      # spread change per zoom step
+RING = 8              # samples in the gesture decision window
+
+# Touch states
+IDLE = 0
+POINTING = 1   # one finger
+TWO = 2        # two or more fingers, not yet a scroll or a pinch
+SCROLLING = 3
+PINCHING = 4
+PALM = 5       # ignored until every finger lifts
+
+# Events: kind in the high byte, a signed byte of value in the low byte
+EVENT_TAP = 1     # value: buttons clicked
+EVENT_ZOOM = 2    # value: zoom steps, positive when the fingers spread
+TAP_BUTTONS = (0, 0x01, 0x02, 0x04)  # by finger count: left, right, middle
+
+def event_kind(event):
+    return event >> 8
+
+def event_value(event):
+    value = event & 0xFF
+    return value - 256 if value > 127 else value
+
+def distance(dx, dy):
+    """Integer approximation of the length of (dx, dy)"""
+    dx = dx if dx >= 0 else -dx
+    dy = dy if dy >= 0 else -dy
+    return dx + (dy >> 1) if dx > dy else dy + (dx >> 1)
+
+def pack_sample(buf, buttons, contacts):
+    """Write buttons and a list of (x, y, size) contacts in the multi layout"""
+    buf[0] = buttons
+    buf[1] = len(contacts)
+    i = 2
+    for x, y, size in contacts[:MAX_CONTACTS]:
+        buf[i] = x & 0xFF
+        buf[i + 1] = x >> 8
+        buf[i + 2] = y & 0xFF
+        buf[i + 3] = y >> 8
+        buf[i + 4] = size
+        i += CONTACT_SIZE
+
+class GestureEngine:
+    """Streams multi-contact samples into pointer motion, clicks, scroll and zoom"""
+    def __init__(self, motion, palm_size=PALM_SIZE, queue_size=16):
+        self.motion = motion
+        self.palm_size = palm_size
+        self.state = IDLE
+        self.fingers = 0        # contacts in the previous sample
+        self.max_fingers = 0    # most contacts during this touch
+        self.down_time = 0
+        self.travel = 0         # distance moved during this touch
+        self.x = 0              # first contact, or the centroid of two
+        self.y = 0
+        self.spread = 0         # distance between the first two contacts
+        self.typed = None       # ticks_ms() of the last key press
+
+        # Centroid and spread of the last RING two-finger samples
+        self.ring_x = array('i', [0] * RING)
+        self.ring_y = array('i', [0] * RING)
+        self.ring_spread = array('i', [0] * RING)
+        self.ring_pos = 0
+        self.ring_len = 0
+        self.zoom = 0           # pinch progress, 1/256ths of a step
+
+        self.events = array('H', [0] * queue_size)
+        self.event_head = 0
+        self.event_count = 0
+
+        self.taps = 0
+        self.scrolls = 0
+        self.pinches = 0
+        self.palms = 0
+
+    def note_typing(self, now):
+        """Call with ticks_ms() when a key is pressed"""
+        self.typed = now
+
+    def push_event(self, kind, value):
+        if self.event_count < len(self.events):
+            i = (self.event_head + self.event_count) % len(self.events)
+            self.events[i] = (kind << 8) | (value & 0xFF)
+            self.event_count += 1
+
+    def pop_event(self):
+        """Return the oldest queued event, or NO_EVENT if the queue is empty"""
+        if not self.event_count:
+            return NO_EVENT
+        event = self.events[self.event_head]
+        self.event_head = (self.event_head + 1) % len(self.events)
+        self.event_count -= 1
+        return event
+
+    def feed(self, now, sample):
+        """Add one sample (multi layout) taken at ticks_ms() now"""
+        motion = self.motion
+        buttons = sample[0]
+        count = sample[1]
+        if count > MAX_CONTACTS:
+            count = MAX_CONTACTS
+
+        if count == 0:
+            if self.state != IDLE:
+                self.lift(now)
+            motion.update(self.x, self.y, buttons, False)
+            return
+
+        if self.state == IDLE:
+            self.state = POINTING
+            self.down_time = now
+            self.travel = 0
+            self.max_fingers = 0
+            self.fingers = 0
+        if count > self.max_fingers:
+            self.max_fingers = count
+
+        if self.state != PALM:
+            i = 2
+            for _ in range(count):
+                if sample[i + 4] >= self.palm_size:
+                    self.state = PALM
+                    self.palms += 1
+                    break
+                i += CONTACT_SIZE
+        if self.state == PALM:
+            # Physical buttons still work under a resting palm
+            motion.update(self.x, self.y, buttons, False)
+            self.fingers = count
+            return
+
+        x = sample[2] | (sample[3] << 8)
+        y = sample[4] | (sample[5] << 8)
+        if count == 1:
+            if self.fingers == 1:
+                self.travel += distance(x - self.x, y - self.y)
+            # The first one-finger sample of a touch, or a finger left behind
+            # by a two-finger gesture, only seeds the position (motion was
+            # last updated as not touching), so the next sample already moves
+            motion.update(x, y, buttons)
+            if self.state != POINTING and self.fingers > 1:
+                self.state = POINTING
+            self.x = x
+            self.y = y
+            self.fingers = 1
+            return
+
+        x1 = sample[7] | (sample[8] << 8)
+        y1 = sample[9] | (sample[10] << 8)
+        cx = (x + x1) >> 1
+        cy = (y + y1) >> 1
+        spread = distance(x1 - x, y1 - y)
+        if self.fingers < 2:
+            self.ring_len = 0
+        elif self.fingers == count:
+            self.travel += distance(cx - self.x, cy - self.y)
+            self.two_fingers(cx, cy, spread)
+        self.push_ring(cx, cy, spread)
+        # Keep the pointer still, but let button presses through
+        motion.update(self.x, self.y, buttons, False)
+        self.x = cx
+        self.y = cy
+        self.spread = spread
+        self.fingers = count
+
+    def push_ring(self, cx, cy, spread):
+        pos = self.ring_pos
+        self.ring_x[pos] = cx
+        self.ring_y[pos] = cy
+        self.ring_spread[pos] = spread
+        self.ring_pos = (pos + 1) % RING
+        if self.ring_len < RING:
+            self.ring_len += 1
+
+    def two_fingers(self, cx, cy, spread):
+        """Continue a two-finger touch with this sample's centroid and spread"""
+        state = self.state
+        if state == TWO or state == POINTING:
+            # Decide from the change across the window, so drift does not count
+            oldest = (self.ring_pos - self.ring_len) % RING
+            pinch = spread - self.ring_spread[oldest]
+            moved = distance(cx - self.ring_x[oldest], cy - self.ring_y[oldest])
+            if pinch >= PINCH_START or pinch <= -PINCH_START:
+                self.state = PINCHING
+                self.pinches += 1
+                self.zoom = 0
+            elif moved >= SCROLL_START:
+                self.state = SCROLLING
+                self.scrolls += 1
+            else:
+                self.state = TWO
+        elif state == SCROLLING:
+            # Fingers moving up scroll up (positive wheel)
+            self.motion.scroll((self.y - cy) * 256 // SCROLL_UNITS)
+        elif state == PINCHING:
+            self.zoom += (spread - self.spread) * 256 // PINCH_UNITS
+            steps = self.zoom >> 8 if self.zoom >= 0 else -((-self.zoom) >> 8)
+            if steps:
+                self.zoom -= steps << 8
+                self.push_event(EVENT_ZOOM, steps)
+
+    def lift(self, now):
+        """Every finger is up: finish the touch, clicking if it was a tap"""
+        if (self.state in (POINTING, TWO) and self.travel <= TAP_SLOP and
+                ticks_diff(now, self.down_time) <= TAP_MS and
+                (self.typed is None or ticks_diff(self.down_time, self.typed) > TYPING_GUARD_MS)):
+            buttons = TAP_BUTTONS[self.max_fingers]
+            self.motion.tap(buttons)
+            self.push_event(EVENT_TAP, buttons)
+            self.taps += 1
+        self.state = IDLE
+        self.fingers = 0
+        self.ring_len = 0
+
+    def stats(self):
+        return {'taps': self.taps, 'scrolls': self.scrolls,
+                'pinches': self.pinches, 'palms': self.palms}
+
+# --- Replay harness ---
+
+def trace_tap(t, x=500, y=400, fingers=1, ms=90):
+    return [(t + i * 10, 0, [(x + 50 * f, y, 20) for f in range(fingers)])
+            for i in range(ms // 10)] + [(t + ms, 0, [])]
+
+def trace_move(t, steps=30, dx=4, x=300, y=300):
+    return [(t + i * 10, 0, [(x + i * dx, y, 20)]) for i in range(steps)] + [(t + steps * 10, 0, [])]
+
+def trace_scroll(t, steps=30, dy=-6, x=500, y=600):
+    return [(t + i * 10, 0, [(x, y + i * dy, 20), (x + 80, y + i * dy, 22)])
+            for i in range(steps)] + [(t + steps * 10, 0, [])]
+
+def trace_pinch(t, steps=30, grow=6, x=500, y=500):
+    return [(t + i * 10, 0, [(x - 40 - i * grow // 2, y, 20), (x + 40 + i * grow // 2, y, 20)])
+            for i in range(steps)] + [(t + steps * 10, 0, [])]
+
+def trace_palm(t, steps=30):
+    return [(t + i * 10, 0, [(300 + i * 3, 700, 90)]) for i in range(steps)] + [(t + steps * 10, 0, [])]
+
+TRACES = {
+    'tap':             (trace_tap(0), None),
+    'two-finger tap':  (trace_tap(0, fingers=2), None),
+    'slow press':      (trace_tap(0, ms=400), None),
+    'pointer move':    (trace_move(0), None),
+    'two-finger scroll': (trace_scroll(0), None),
+    'pinch out':       (trace_pinch(0), None),
+    'resting palm':    (trace_palm(0), None),
+    'tap while typing': (trace_tap(1000), 900),
+}
+
+def load_trace(path):
+    """Read a recorded trace: "ms buttons x,y,size x,y,size ..." per line"""
+    trace = []
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            contacts = [tuple(int(v) for v in c.split(',')) for c in fields[2:]]
+            trace.append((int(fields[0]), int(fields[1]), contacts))
+    return trace
+
+def replay(trace, typed=None):
+    """Feed a trace through a GestureEngine; returns the engine, the mouse
+    reports and the time per sample"""
+    from trackpad import PointerMotion
+    from hid_output import HIDSender, MOUSE_DESCRIPTOR, MOUSE_REPORT_SIZE
+    motion = PointerMotion()
+    engine = GestureEngine(motion)
+    mouse = HIDSender(MOUSE_DESCRIPTOR, MOUSE_REPORT_SIZE, keep=True)
+    if typed is not None:
+        engine.note_typing(typed)
+    buf = bytearray(MULTI_SAMPLE_SIZE)
+    elapsed = 0.0
+    # Two extra empty samples let a tap's release report go out
+    for now, buttons, contacts in trace + [(trace[-1][0] + 10 * i, 0, []) for i in (1, 2)]:
+        pack_sample(buf, buttons, contacts)
+        start = time.perf_counter()
+        engine.feed(now, buf)
+        if motion.pending() and mouse.ready():
+            motion.fill_report(mouse.report)
+            if mouse.send():
+                motion.commit()
+        elapsed += time.perf_counter() - start
+    return engine, mouse.log, elapsed / (len(trace) + 2)
+
+def describe(engine, reports):
+    moved = sum(r[1] - 256 if r[1] > 127 else r[1] for r in reports)
+    wheel = sum(r[3] - 256 if r[3] > 127 else r[3] for r in reports)
+    clicks = [r[0] for r in reports if r[0]]
+    zoom = 0
+    event = engine.pop_event()
+    while event != NO_EVENT:
+        if event_kind(event) == EVENT_ZOOM:
+            zoom += event_value(event)
+        event = engine.pop_event()
+    return f"x {moved:+4d}, wheel {wheel:+3d}, zoom {zoom:+3d}, clicks {clicks}"
+
+def simulate(paths=()):
+    worst = 0.0
+    traces = dict(TRACES)
+    for path in paths:
+        traces[path] = (load_trace(path), None)
+    for name, (trace, typed) in traces.items():
+        engine, reports, per_sample = replay(trace, typed)
+        # Best of several runs, to keep host scheduling noise out of the timing
+        per_sample = min([per_sample] + [replay(trace, typed)[2] for _ in range(9)])
+        worst = max(worst, per_sample)
+        print(f"  {name:18} {describe(engine, reports):46} {per_sample * 1e6:5.1f} us/sample")
+    print(f"Slowest trace {worst * 1e6:.1f} us per sample under CPython "
+          f"(a 200 Hz poll budget is 5000 us)")
+
+if __name__ == "__main__":
+    import sys
+    simulate(sys.argv[1:])
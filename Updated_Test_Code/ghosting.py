@@ -0,0 +1,123 @@
+"""
+Ghost-key detection for diode-less laptop matrices
+Without diodes, holding three corners of a rectangle makes the fourth corner
+read as pressed. Two rows whose bitmasks share two or more columns form such
+a rectangle, so each row pair costs one AND plus one "more than one bit" test.
+Only rows with keys down are compared, which keeps the stage well inside a
+1 kHz scan budget. Also keeps n-key-rollover statistics.
+
+Run with CPython for a timing benchmark against a simulated matrix.
+"""
+
+from array import array
+from matrix_scan import MatrixScanner, SimulatedBank, ticks_us, ticks_diff, NO_EVENT
+
+SUPPRESS = 'suppress'  # hold back new presses inside an ambiguous rectangle
+FLAG = 'flag'          # pass keys through, only count ambiguous chords
+
+def popcount(bits):
+    count = 0
+    while bits:
+        bits &= bits - 1
+        count += 1
+    return count
+
+class GhostFilter:
+    """Checks scanned row bitmasks for ghost rectangles"""
+    def __init__(self, num_rows, mode=SUPPRESS, max_chord=16):
+        if mode not in (SUPPRESS, FLAG):
+            raise ValueError(f"Unknown ghost mode: {mode}")
+        self.num_rows = num_rows
+        self.mode = mode
+        self.down_rows = bytearray(num_rows)  # indexes of rows with keys down
+
+        # Rollover statistics
+        self.chords = array('L', [0] * (max_chord + 1))  # chord size histogram
+        self.max_rollover = 0
+        self.ghost_scans = 0
+        self.blocked_keys = 0
+        self.last_total = 0
+        self.ghosted = False
+
+    def apply(self, rows, prev):
+        """Filter rows in place, prev holds the last reported bitmasks"""
+        down_rows = self.down_rows
+        n = 0
+        for r in range(self.num_rows):
+            if rows[r]:
+                down_rows[n] = r
+                n += 1
+
+        ghosted = False
+        blocked = 0
+        for i in range(n - 1):
+            ri = down_rows[i]
+            a = rows[ri]
+            for j in range(i + 1, n):
+                rj = down_rows[j]
+                shared = a & rows[rj]
+                if shared & (shared - 1):
+                    # Two rows share 2+ columns: any corner may be a phantom
+                    ghosted = True
+                    if self.mode == SUPPRESS:
+                        new_i = shared & ~prev[ri]
+                        new_j = shared & ~prev[rj]
+                        if new_i or new_j:
+                            blocked += popcount(new_i) + popcount(new_j)
+                            rows[ri] &= ~new_i
+                            rows[rj] &= ~new_j
+
+        if ghosted and not self.ghosted:
+            self.ghost_scans += 1
+            self.blocked_keys += blocked
+        self.ghosted = ghosted
+
+        # Rollover counts the keys that survived suppression, not phantoms
+        total = 0
+        for i in range(n):
+            total += popcount(rows[down_rows[i]])
+        if total != self.last_total:
+            self.last_total = total
+            if total > self.max_rollover:
+                self.max_rollover = total
+            self.chords[min(total, len(self.chords) - 1)] += 1
+
+        return ghosted
+
+    def stats(self):
+        """Return rollover statistics as a dict (allocates, for reporting)"""
+        return {
+            'max_rollover': self.max_rollover,
+            'ghost_chords': self.ghost_scans,
+            'blocked_keys': self.blocked_keys,
+            'chords': {n: count for n, count in enumerate(self.chords) if count and n},
+        }
+
+def benchmark(num_rows=16, num_cols=8, duration_ms=1000):
+    """Time full scans with a ghosting chord held on a diode-less simulated matrix"""
+    for mode in (None, SUPPRESS):
+        bank = SimulatedBank(num_rows, num_cols, diodes=False)
+        ghost_filter = GhostFilter(num_rows, mode) if mode else None
+        scanner = MatrixScanner(bank, num_rows, num_cols, ghost_filter=ghost_filter)
+
+        # Press keys one scan apart; (6, 4) then reads as a phantom
+        for r, c in ((12, 7), (1, 1), (1, 4), (6, 1)):
+            bank.press(r, c)
+            scanner.scan()
+
+        scans = 0
+        start = ticks_us()
+        elapsed = 0
+        while elapsed < duration_ms * 1000:
+            scanner.scan()
+            while scanner.pop_event() != NO_EVENT:
+                pass
+            scans += 1
+            elapsed = ticks_diff(ticks_us(), start)
+        print(f"ghost filter {mode or 'off'}: {scans * 1_000_000 // elapsed} scans/s, "
+              f"keys {scanner.pressed()}")
+        if ghost_filter:
+            print(f"  stats: {ghost_filter.stats()}")
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,410 @@
+"""
+USB HID output for the Multi-Ribbon interface
+Lets the Pico enumerate as a HID device next to its serial REPL, using the
+usb-device-hid package from micropython-lib (mip install usb-device-hid,
+MicroPython 1.23 or later). Each HIDSender owns one preallocated report
+buffer that is filled in place and sent without blocking: when the previous
+report is still in flight, send() returns False and the caller keeps its
+state for the next try.
+
+KeyboardReport turns matrix events (see matrix_scan) into keyboard reports
+through a keymap of HID usage IDs, one byte per matrix position:
+  6kro - the 8-byte boot report (modifiers, reserved, six key slots), which
+         BIOS setup screens and boot loaders understand too. A seventh key
+         waits for a free slot.
+  nkro - modifiers plus a 128-bit bitmap of usages 0-127 (report protocol
+         only), so every key of a laptop matrix can be down at once.
+Presses and releases only change the report state; a report is sent only
+when that state has changed, and again on the next poll if USB was busy.
+
+Without the USB package (or under CPython) a HIDSender just counts the
+reports, and can keep copies of them, so the pipelines feeding it can be
+benchmarked off-device. Run with CPython for keypress-to-report latency and
+rollover of the two report formats against simulated pins.
+"""
+
+import time
+from matrix_scan import event_row, event_col, EVENT_PRESSED, ticks_us, ticks_diff
+
+try:
+    import usb.device
+    from usb.device.hid import HIDInterface
+except ImportError:
+    HIDInterface = None
+
+PROTOCOL_NONE = 0
+PROTOCOL_KEYBOARD = 1
+PROTOCOL_MOUSE = 2
+
+# Boot-compatible mouse: 3 buttons, then X, Y and wheel as signed bytes
+MOUSE_DESCRIPTOR = bytes((
+    0x05, 0x01,        # Usage Page (Generic Desktop)
+    0x09, 0x02,        # Usage (Mouse)
+    0xA1, 0x01,        # Collection (Application)
+    0x09, 0x01,        #   Usage (Pointer)
+    0xA1, 0x00,        #   Collection (Physical)
+    0x05, 0x09,        #     Usage Page (Button)
+    0x19, 0x01,        #     Usage Minimum (1)
+    0x29, 0x03,        #     Usage Maximum (3)
+    0x15, 0x00,        #     Logical Minimum (0)
+    0x25, 0x01,        #     Logical Maximum (1)
+    0x95, 0x03,        #     Report Count (3)
+    0x75, 0x01,        #     Report Size (1)
+    0x81, 0x02,        #     Input (Data, Variable, Absolute)
+    0x95, 0x01,        #     Report Count (1)
+    0x75, 0x05,        #     Report Size (5)
+    0x81, 0x01,        #     Input (Constant) - padding
+    0x05, 0x01,        #     Usage Page (Generic Desktop)
+    0x09, 0x30,        #     Usage (X)
+    0x09, 0x31,        #     Usage (Y)
+    0x09, 0x38,        #     Usage (Wheel)
+    0x15, 0x81,        #     Logical Minimum (-127)
+    0x25, 0x7F,        #     Logical Maximum (127)
+    0x75, 0x08,        #     Report Size (8)
+    0x95, 0x03,        #     Report Count (3)
+    0x81, 0x06,        #     Input (Data, Variable, Relative)
+    0xC0,              #   End Collection
+    0xC0,              # End Collection
+))
+MOUSE_REPORT_SIZE = 4  # buttons, x, y, wheel
+
+# Boot keyboard: modifiers, reserved byte, six key slots; five LED outputs
+KEYBOARD_DESCRIPTOR = bytes((
+    0x05, 0x01,        # Usage Page (Generic Desktop)
+    0x09, 0x06,        # Usage (Keyboard)
+    0xA1, 0x01,        # Collection (Application)
+    0x05, 0x07,        #   Usage Page (Keyboard)
+    0x19, 0xE0,        #   Usage Minimum (Left Control)
+    0x29, 0xE7,        #   Usage Maximum (Right GUI)
+    0x15, 0x00,        #   Logical Minimum (0)
+    0x25, 0x01,        #   Logical Maximum (1)
+    0x75, 0x01,        #   Report Size (1)
+    0x95, 0x08,        #   Report Count (8)
+    0x81, 0x02,        #   Input (Data, Variable, Absolute) - modifiers
+    0x95, 0x01,        #   Report Count (1)
+    0x75, 0x08,        #   Report Size (8)
+    0x81, 0x01,        #   Input (Constant) - reserved
+    0x05, 0x08,        #   Usage Page (LEDs)
+    0x19, 0x01,        #   Usage Minimum (Num Lock)
+    0x29, 0x05,        #   Usage Maximum (Kana)
+    0x95, 0x05,        #   Report Count (5)
+    0x75, 0x01,        #   Report Size (1)
+    0x91, 0x02,        #   Output (Data, Variable, Absolute) - LEDs
+    0x95, 0x01,        #   Report Count (1)
+    0x75, 0x03,        #   Report Size (3)
+    0x91, 0x01,        #   Output (Constant) - padding
+    0x05, 0x07,        #   Usage Page (Keyboard)
+    0x19, 0x00,        #   Usage Minimum (0)
+    0x29, 0xFF,        #   Usage Maximum (255)
+    0x15, 0x00,        #   Logical Minimum (0)
+    0x26, 0xFF, 0x00,  #   Logical Maximum (255)
+    0x95, 0x06,        #   Report Count (6)
+    0x75, 0x08,        #   Report Size (8)
+    0x81, 0x00,        #   Input (Data, Array) - key slots
+    0xC0,              # End Collection
+))
+KEYBOARD_REPORT_SIZE = 8
+
+# NKRO keyboard: modifiers, then one bit per usage 0-127; five LED outputs
+NKRO_DESCRIPTOR = bytes((
+    0x05, 0x01,        # Usage Page (Generic Desktop)
+    0x09, 0x06,        # Usage (Keyboard)
+    0xA1, 0x01,        # Collection (Application)
+    0x05, 0x07,        #   Usage Page (Keyboard)
+    0x19, 0xE0,        #   Usage Minimum (Left Control)
+    0x29, 0xE7,        #   Usage Maximum (Right GUI)
+    0x15, 0x00,        #   Logical Minimum (0)
+    0x25, 0x01,        #   Logical Maximum (1)
+    0x75, 0x01,        #   Report Size (1)
+    0x95, 0x08,        #   Report Count (8)
+    0x81, 0x02,        #   Input (Data, Variable, Absolute) - modifiers
+    0x19, 0x00,        #   Usage Minimum (0)
+    0x29, 0x7F,        #   Usage Maximum (127)
+    0x95, 0x80,        #   Report Count (128)
+    0x81, 0x02,        #   Input (Data, Variable, Absolute) - key bitmap
+    0x05, 0x08,        #   Usage Page (LEDs)
+    0x19, 0x01,        #   Usage Minimum (Num Lock)
+    0x29, 0x05,        #   Usage Maximum (Kana)
+    0x95, 0x05,        #   Report Count (5)
+    0x91, 0x02,        #   Output (Data, Variable, Absolute) - LEDs
+    0x95, 0x03,        #   Report Count (3)
+    0x91, 0x01,        #   Output (Constant) - padding
+    0xC0,              # End Collection
+))
+NKRO_KEYS = 128
+NKRO_REPORT_SIZE = 1 + NKRO_KEYS // 8
+
+MODIFIER_FIRST = 0xE0  # Left Control; 0xE0-0xE7 are modifier bits
+
+class HIDSender:
+    """One HID interface and the report buffer that is sent through it"""
+    def __init__(self, descriptor, report_size, protocol=PROTOCOL_NONE, keep=False):
+        self.report = bytearray(report_size)
+        self.interface = None
+        if HIDInterface is not None:
+            self.interface = HIDInterface(descriptor, protocol=protocol)
+        self.sent = 0
+        self.busy = 0      # send() calls refused while a report was in flight
+        self.log = [] if keep else None
+
+    def ready(self):
+        """True when the report buffer may be changed and sent"""
+        interface = self.interface
+        if interface is None:
+            return True
+        # The USB stack reads self.report until the transfer completes
+        return interface.is_open() and not interface.busy()
+
+    def send(self):
+        """Queue self.report without waiting; returns False if it was not sent"""
+        if self.interface is not None and not self.interface.send_report(self.report, 0):
+            self.busy += 1
+            return False
+        self.sent += 1
+        if self.log is not None:
+            self.log.append(bytes(self.report))
+        return True
+
+def keymap_table(keymap, num_rows, num_cols):
+    """Build a row * num_cols + col -> keycode table from a flat
+    [position, keycode, ...] list, position = row << 8 | col (the layout
+    editor's format)"""
+    table = bytearray(num_rows * num_cols)
+    for i in range(0, len(keymap) - 1, 2):
+        row = keymap[i] >> 8
+        col = keymap[i] & 0xFF
+        if row < num_rows and col < num_cols:
+            table[row * num_cols + col] = keymap[i + 1]
+    return table
+
+def keyboard_sender(nkro=False, keep=False):
+    """A HIDSender with the 6KRO boot keyboard or the NKRO descriptor"""
+    if nkro:
+        return HIDSender(NKRO_DESCRIPTOR, NKRO_REPORT_SIZE, PROTOCOL_NONE, keep)
+    return HIDSender(KEYBOARD_DESCRIPTOR, KEYBOARD_REPORT_SIZE, PROTOCOL_KEYBOARD, keep)
+
+class KeyboardReport:
+    """Held keys of one keyboard, sent as 6KRO or NKRO reports when they change"""
+    def __init__(self, sender, keymap, num_cols, nkro=False):
+        self.sender = sender
+        self.keymap = keymap        # from keymap_table()
+        self.num_cols = num_cols
+        self.nkro = nkro
+        self.modifiers = 0
+        self.held = bytearray(NKRO_KEYS // 8)  # bit per usage 0-127
+        self.held_bits = memoryview(self.held)
+        self.presses = bytearray(256)  # positions holding each keycode
+        self.slots = bytearray(6)   # 6KRO key slots, in press order
+        self.changed = False
+        self.waiting = 0            # 6KRO: keys held without a slot
+
+    def press(self, code):
+        self.presses[code] += 1
+        if self.presses[code] > 1:
+            return  # another position already holds this keycode
+        if code >= MODIFIER_FIRST:
+            self.modifiers |= 1 << (code - MODIFIER_FIRST)
+        elif code < NKRO_KEYS:
+            self.held[code >> 3] |= 1 << (code & 7)
+            if not self.nkro:
+                slots = self.slots
+                for i in range(6):
+                    if not slots[i]:
+                        slots[i] = code
+                        break
+                else:
+                    self.waiting += 1
+        self.changed = True
+
+    def release(self, code):
+        if not self.presses[code]:
+            return
+        self.presses[code] -= 1
+        if self.presses[code]:
+            return  # still held at another position
+        if code >= MODIFIER_FIRST:
+            self.modifiers &= ~(1 << (code - MODIFIER_FIRST))
+        elif code < NKRO_KEYS:
+            self.held[code >> 3] &= ~(1 << (code & 7))
+            if not self.nkro:
+                slots = self.slots
+                for i in range(6):
+                    if slots[i] == code:
+                        # Close the gap, keeping the press order
+                        for j in range(i, 5):
+                            slots[j] = slots[j + 1]
+                        slots[5] = 0
+                        if self.waiting:
+                            self.fill_slot()
+                        break
+                else:
+                    self.waiting -= 1  # it was held without a slot
+        self.changed = True
+
+    def fill_slot(self):
+        """Give the free last slot to a held key that has none"""
+        slots = self.slots
+        held = self.held
+        for code in range(1, NKRO_KEYS):
+            if not held[code >> 3] & (1 << (code & 7)):
+                continue
+            # Not `code in slots`: MicroPython cannot search a bytearray
+            for i in range(6):
+                if slots[i] == code:
+                    break
+            else:
+                slots[5] = code
+                self.waiting -= 1
+                return
+
+    def update(self, events):
+        """Apply matrix events and send a report if anything changed;
+        returns True if a report went out"""
+        keymap = self.keymap
+        num_cols = self.num_cols
+        for event in events:
+            code = keymap[event_row(event) * num_cols + event_col(event)]
+            if not code:
+                continue
+            if event & EVENT_PRESSED:
+                self.press(code)
+            else:
+                self.release(code)
+        return self.send()
+
+    def send(self):
+        """Send the current state if it changed since the last report"""
+        sender = self.sender
+        if not self.changed or not sender.ready():
+            return False
+        report = sender.report
+        report[0] = self.modifiers
+        if self.nkro:
+            report[1:] = self.held_bits
+        else:
+            report[1] = 0
+            report[2:] = self.slots
+        if sender.send():
+            self.changed = False
+            return True
+        return False
+
+def start_usb(senders):
+    """Enumerate the senders' interfaces next to the serial REPL; False without USB support"""
+    interfaces = [sender.interface for sender in senders if sender.interface is not None]
+    if not interfaces:
+        return False
+    usb.device.get().init(*interfaces, builtin_driver=True)
+    return True
+
+# --- Benchmark ---
+
+def letter_keymap(num_rows, num_cols):
+    """Keycodes for every position: letters, digits and so on in order"""
+    keymap = []
+    for row in range(num_rows):
+        for col in range(num_cols):
+            keymap += [(row << 8) | col, 4 + (row * num_cols + col) % 96]
+    return keymap
+
+def keypress_latency(nkro, presses=200, scan_us=1000, num_rows=8, num_cols=16):
+    """Press random keys on simulated pins while a 1 kHz loop scans the
+    matrix and updates the report; returns press-to-report times in us"""
+    import random
+    from matrix_scan import SimulatedBank, MatrixScanner, NO_EVENT
+    random.seed(2)
+    bank = SimulatedBank(num_rows, num_cols)
+    scanner = MatrixScanner(bank, num_rows, num_cols)
+    report = KeyboardReport(keyboard_sender(nkro), keymap_table(
+        letter_keymap(num_rows, num_cols), num_rows, num_cols), num_cols, nkro)
+    events = []
+    latencies = []
+    for _ in range(presses):
+        row = random.randrange(num_rows)
+        col = random.randrange(num_cols)
+        # The key goes down somewhere within a scan period
+        next_scan = time.perf_counter() + scan_us / 1e6
+        pressed = time.perf_counter() + random.random() * scan_us / 1e6
+        while time.perf_counter() < pressed:
+            pass
+        bank.press(row, col)
+        pressed = time.perf_counter()
+        for release in (False, True):
+            while time.perf_counter() < next_scan:
+                pass
+            next_scan += scan_us / 1e6
+            scanner.scan()
+            event = scanner.pop_event()
+            while event != NO_EVENT:
+                events.append(event)
+                event = scanner.pop_event()
+            if report.update(events) and not release:
+                latencies.append((time.perf_counter() - pressed) * 1e6)
+            events.clear()
+            bank.release(row, col)
+    return latencies, report
+
+def rollover(nkro, keys=10):
+    """Hold keys at once and count how many the last report carries"""
+    from matrix_scan import SimulatedBank, MatrixScanner, NO_EVENT
+    bank = SimulatedBank(8, 16)
+    scanner = MatrixScanner(bank, 8, 16)
+    sender = keyboard_sender(nkro, keep=True)
+    report = KeyboardReport(sender, keymap_table(letter_keymap(8, 16), 8, 16), 16, nkro)
+    for k in range(keys):
+        bank.press(k // 4, k % 4 * 3)
+    scanner.scan()
+    events = []
+    event = scanner.pop_event()
+    while event != NO_EVENT:
+        events.append(event)
+        event = scanner.pop_event()
+    report.update(events)
+    last = sender.log[-1]
+    if nkro:
+        return sum(bin(b).count('1') for b in last[1:])
+    return sum(1 for b in last[2:] if b)
+
+def duplicate_keys():
+    """Six keys held, one keycode at two positions, then a 7th key: returns
+    (keycode still held after one copy is let go, 7th key gets the slot
+    once the second copy is let go too)"""
+    sender = keyboard_sender(False, keep=True)
+    report = KeyboardReport(sender, bytearray(128), 16)
+    for code in (4, 5, 6, 7, 8, 9):
+        report.press(code)
+    report.press(4)   # the same keycode at another matrix position
+    report.press(10)  # no free slot: waits
+    report.release(4)
+    report.send()
+    still_held = 4 in sender.log[-1][2:]
+    report.release(4)
+    report.send()
+    return still_held, 10 in sender.log[-1][2:]
+
+def benchmark():
+    for nkro in (False, True):
+        name = 'NKRO' if nkro else '6KRO'
+        latencies, report = keypress_latency(nkro)
+        latencies.sort()
+        held = rollover(nkro)
+        start = ticks_us()
+        for _ in range(1000):
+            report.press(20)
+            report.send()
+            report.release(20)
+            report.send()
+        per_report = ticks_diff(ticks_us(), start) / 2000
+        print(f"{name}: keypress to report mean {sum(latencies) / len(latencies):.0f} us, "
+              f"max {latencies[-1]:.0f} us at 1 kHz scanning; "
+              f"{per_report:.1f} us per report update; 10 keys held -> {held} in the report")
+    held, filled = duplicate_keys()
+    print(f"6KRO, one keycode at two positions: held after the first release {held}, "
+          f"waiting 7th key reported after the second {filled}")
+    # The old path: an event string in a JSON line, then the UART to a host
+    line = '{"CONN1": ["+R0C3"]}\n'
+    print(f"UART path: {len(line)}-byte JSON line takes {len(line) * 10 * 1e6 / 115200:.0f} us "
+          f"on the wire at 115200 baud before the host can even make a keystroke")
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,246 @@
+"""
+Keyboard matrix scan engine for the Multi-Ribbon interface
+Keeps the matrix as one column bitmask per row and only switches the two
+row pins that change between rows, so a steady-state scan allocates nothing.
+Key changes are queued as press/release events from the XOR of the old and
+new row bitmasks, optionally after a per-key Debouncer (see debounce.py) and
+a GhostFilter (see ghosting.py).
+Pure Python: runs on the Pico under MicroPython and on a PC under CPython
+with SimulatedBank standing in for the GPIO pins.
+"""
+
+from array import array
+import time
+
+try:
+    from time import ticks_ms, ticks_us, ticks_diff, ticks_add, sleep_us
+except ImportError:
+    # CPython fallbacks so the engine can be benchmarked off-device
+    def ticks_ms():
+        return time.perf_counter_ns() // 1_000_000
+
+    def ticks_us():
+        return time.perf_counter_ns() // 1000
+
+    def ticks_diff(a, b):
+        return a - b
+
+    def ticks_add(ticks, delta):
+        return ticks + delta
+
+    def sleep_us(us):
+        time.sleep(us / 1_000_000)
+
+# Event encoding: bit 15 set for a press, row in bits 8-14, column in bits 0-7
+EVENT_PRESSED = 0x8000
+NO_EVENT = -1
+
+def event_row(event):
+    return (event >> 8) & 0x7F
+
+def event_col(event):
+    return event & 0xFF
+
+def event_pressed(event):
+    return bool(event & EVENT_PRESSED)
+
+def event_name(event):
+    """Format an event as "+R{row}C{col}" (press) or "-R{row}C{col}" (release)"""
+    sign = '+' if event & EVENT_PRESSED else '-'
+    return f"{sign}R{event_row(event)}C{event_col(event)}"
+
+class PinBank:
+    """Drives row pins and reads column pins of one keyboard connector"""
+    def __init__(self, rows, cols, settle_us=10, read_port=None, col_shift=0):
+        self.rows = rows
+        self.cols = cols
+        self.settle_us = settle_us
+        # Optional whole-port read (e.g. SIO GPIO_IN) for contiguous columns
+        self.read_port = read_port
+        self.col_shift = col_shift
+        self.col_mask = (1 << len(cols)) - 1
+        self.active = -1
+
+        # Idle state: all rows high
+        for row in rows:
+            row.value(1)
+
+    def select(self, row_idx):
+        """Drive row_idx low and release the previously selected row"""
+        if self.active >= 0:
+            self.rows[self.active].value(1)
+        self.rows[row_idx].value(0)
+        self.active = row_idx
+        if self.settle_us:
+            sleep_us(self.settle_us)
+
+    def read(self):
+        """Return the selected row's pressed columns as a bitmask"""
+        if self.read_port is not None:
+            # Columns are active low, so invert the port bits
+            return ~(self.read_port() >> self.col_shift) & self.col_mask
+
+        bits = 0
+        bit = 1
+        for col in self.cols:
+            if not col.value():
+                bits |= bit
+            bit <<= 1
+        return bits
+
+class SimulatedBank:
+    """Pin bank stand-in that reads key presses from a table (for CPython)"""
+    def __init__(self, num_rows, num_cols, diodes=True):
+        self.num_rows = num_rows
+        self.num_cols = num_cols
+        self.diodes = diodes  # False: reads show phantom keys like a laptop matrix
+        self.keys = array('L', [0] * num_rows)  # pressed columns per row
+        self.active = -1
+        self.pin_writes = 0
+
+    def press(self, row, col):
+        self.keys[row] |= 1 << col
+
+    def release(self, row, col):
+        self.keys[row] &= ~(1 << col)
+
+    def select(self, row_idx):
+        if self.active >= 0:
+            self.pin_writes += 1
+        self.pin_writes += 1
+        self.active = row_idx
+
+    def read(self):
+        cols = self.keys[self.active]
+        if self.diodes:
+            return cols
+
+        # Current flows back through any row sharing a pressed column
+        reached = 1 << self.active
+        grew = True
+        while grew:
+            grew = False
+            for r in range(self.num_rows):
+                if not reached & (1 << r) and self.keys[r] & cols:
+                    reached |= 1 << r
+                    cols |= self.keys[r]
+                    grew = True
+        return cols
+
+class MatrixScanner:
+    """Scans a pin bank into a preallocated array of row bitmasks"""
+    def __init__(self, bank, num_rows, num_cols, queue_size=64,
+                 debouncer=None, ghost_filter=None):
+        if num_cols > 32:
+            raise ValueError("at most 32 columns per matrix")
+        self.bank = bank
+        self.debouncer = debouncer
+        self.ghost_filter = ghost_filter
+        self.num_rows = num_rows
+        self.num_cols = num_cols
+        self.state = array('L', [0] * num_rows)
+        self.scratch = array('L', [0] * num_rows)  # this pass, before ghost filtering
+
+        # Ring buffer of encoded press/release events
+        self.events = array('H', [0] * queue_size)
+        self.event_head = 0
+        self.event_count = 0
+        self.events_dropped = 0
+
+    def scan(self):
+        """Scan every row once, return True if any row changed"""
+        bank = self.bank
+        state = self.state
+        debouncer = self.debouncer
+        ghost_filter = self.ghost_filter
+        scratch = self.scratch
+        changed = False
+
+        if debouncer is not None:
+            debouncer.begin(ticks_ms())
+
+        for r in range(self.num_rows):
+            bank.select(r)
+            bits = bank.read()
+            if debouncer is not None:
+                bits = debouncer.filter(r, bits)
+            scratch[r] = bits
+
+        if ghost_filter is not None:
+            ghost_filter.apply(scratch, state)
+
+        for r in range(self.num_rows):
+            bits = scratch[r]
+            diff = bits ^ state[r]
+            if diff:
+                state[r] = bits
+                self.queue_edges(r, diff, bits)
+                changed = True
+
+        return changed
+
+    def queue_edges(self, row, diff, bits):
+        """Queue one event per set bit of diff"""
+        events = self.events
+        size = len(events)
+        col = 0
+        while diff:
+            if diff & 1:
+                if self.event_count == size:
+                    self.events_dropped += 1
+                else:
+                    event = (row << 8) | col
+                    if bits & 1:
+                        event |= EVENT_PRESSED
+                    events[(self.event_head + self.event_count) % size] = event
+                    self.event_count += 1
+            diff >>= 1
+            bits >>= 1
+            col += 1
+
+    def pop_event(self):
+        """Return the oldest queued event, or NO_EVENT if the queue is empty"""
+        if not self.event_count:
+            return NO_EVENT
+        event = self.events[self.event_head]
+        self.event_head = (self.event_head + 1) % len(self.events)
+        self.event_count -= 1
+        return event
+
+    def pressed(self):
+        """Return pressed keys as (row, col) tuples (allocates, for reporting)"""
+        keys = []
+        for r in range(self.num_rows):
+            bits = self.state[r]
+            c = 0
+            while bits:
+                if bits & 1:
+                    keys.append((r, c))
+                bits >>= 1
+                c += 1
+        return keys
+
+def benchmark(num_rows=16, num_cols=8, duration_ms=1000):
+    """Measure scans per second against simulated pins"""
+    bank = SimulatedBank(num_rows, num_cols)
+    bank.press(2, 3)
+    bank.press(9, 7)
+    scanner = MatrixScanner(bank, num_rows, num_cols)
+
+    scans = 0
+    start = ticks_us()
+    elapsed = 0
+    while elapsed < duration_ms * 1000:
+        scanner.scan()
+        while scanner.pop_event() != NO_EVENT:
+            pass
+        scans += 1
+        elapsed = ticks_diff(ticks_us(), start)
+
+    rate = scans * 1_000_000 // elapsed
+    print(f"{num_rows}x{num_cols} matrix: {rate} scans/s, "
+          f"{bank.pin_writes // scans} pin writes per scan")
+    return rate
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,350 @@
+"""
+PIO scan backend for the matrix scan engine
+A state machine walks a low level across the row pins, samples every column
+with a single in_ instruction and pushes a word only for rows with a key
+down. An end-of-scan marker (word 0) follows every scan that had keys down,
+plus the first idle scan after it, so an idle keyboard puts nothing in the
+RX FIFO. PioBank drains the FIFO and stands in for PinBank, so MatrixScanner,
+the Debouncer and the GhostFilter work unchanged.
+
+Row pins must be consecutive GPIOs, and so must the column pins, with
+rows + columns <= 32.
+
+Row word layout (the in_ shift direction is left):
+  bits C..C+R-1  row pins as driven, a single 0 marks the scanned row
+  bits 0..C-1    pressed columns (1 = pressed)
+
+The same program function is assembled by rp2.asm_pio on the Pico and by
+PioModel under CPython, a cycle-accurate model of the instructions it uses.
+Run this file with CPython to simulate a scan.
+"""
+
+from array import array
+from matrix_scan import (MatrixScanner, SimulatedBank, NO_EVENT,
+                         event_row, event_col, event_pressed)
+
+try:
+    import rp2
+    from machine import Pin
+except ImportError:
+    rp2 = None
+
+# State machine clock: one cycle per microsecond makes the settle delay in us
+PIO_FREQ = 1_000_000
+# Longest delay a single PIO instruction can carry
+MAX_SETTLE = 31
+
+def scan_program(num_rows, num_cols, settle):
+    """Return the scan program for a num_rows x num_cols matrix"""
+    def matrix_scan_pio():
+        wrap_target()
+        label("scan")
+        # Y = row pattern: a single 0 for the first row, at bit 32 - num_rows
+        set(x, 1)
+        in_(x, 1)
+        in_(null, 32 - num_rows)
+        mov(y, invert(isr))
+
+        label("row")
+        mov(pins, reverse(y))      [settle]  # drive one row low, let it settle
+        mov(isr, invert(null))
+        in_(pins, num_cols)                  # idle columns read high
+        mov(x, invert(isr))                  # X = pressed columns
+        jmp(not_x, "next")
+        mov(isr, reverse(y))
+        in_(x, num_cols)                     # row pattern above the pressed columns
+        push(block)
+        mov(osr, invert(null))               # keys down in this scan
+
+        label("next")
+        mov(isr, invert(y))
+        in_(null, 1)                         # step to the next row
+        mov(y, invert(isr))
+        mov(x, isr)                          # 0 once every row has been scanned
+        jmp(x_dec, "row")
+
+        # End of scan: ISR is 0 here, push it as the marker while keys are
+        # down and for one idle scan after; OSR counts down ~0 -> 1 -> 0
+        mov(x, osr)
+        jmp(not_x, "scan")
+        push(block)
+        out(null, 31)
+        wrap()
+
+    return matrix_scan_pio
+
+class PioBank:
+    """Pin bank fed by the PIO scan program through the RX FIFO"""
+    def __init__(self, sm, num_rows, num_cols, program=None, sm_id=0):
+        if num_rows + num_cols > 32:
+            raise ValueError("PIO scan needs rows + columns <= 32")
+        self.sm = sm
+        self.program = program
+        self.sm_id = sm_id
+        self.num_rows = num_rows
+        self.num_cols = num_cols
+        self.col_mask = (1 << num_cols) - 1
+        self.row_mask = (1 << num_rows) - 1
+        self.row_of = {1 << r: r for r in range(num_rows)}
+        self.rows = array('L', [0] * num_rows)     # last complete scan
+        self.pending = array('L', [0] * num_rows)  # scan still arriving
+        self.active = 0
+        self.words = 0  # FIFO words handled, for statistics
+
+    @classmethod
+    def start(cls, sm_id, row_pins, col_pins, settle_us=10):
+        """Load the scan program on state machine sm_id and start it"""
+        program = rp2.asm_pio(
+            out_init=(rp2.PIO.OUT_HIGH,) * len(row_pins),
+            in_shiftdir=rp2.PIO.SHIFT_LEFT,
+            out_shiftdir=rp2.PIO.SHIFT_RIGHT,
+            fifo_join=rp2.PIO.JOIN_RX,
+        )(scan_program(len(row_pins), len(col_pins), min(settle_us, MAX_SETTLE)))
+        sm = rp2.StateMachine(sm_id, program, freq=PIO_FREQ,
+                              out_base=Pin(row_pins[0]), in_base=Pin(col_pins[0]))
+        sm.active(1)
+        return cls(sm, len(row_pins), len(col_pins), program, sm_id)
+
+    def deinit(self):
+        """Stop the state machine and free its instruction memory"""
+        self.sm.active(0)
+        if self.program is not None:
+            rp2.PIO(self.sm_id // 4).remove_program(self.program)
+
+    def poll(self):
+        """Drain the words already in the FIFO, return True if a row changed"""
+        sm = self.sm
+        rows = self.rows
+        pending = self.pending
+        changed = False
+        # Bounded by the current fill level so a busy FIFO cannot stall us
+        for _ in range(sm.rx_fifo()):
+            word = sm.get()
+            self.words += 1
+            if word:
+                pending[self.row_of[(~word >> self.num_cols) & self.row_mask]] = word & self.col_mask
+            else:
+                for r in range(self.num_rows):
+                    if rows[r] != pending[r]:
+                        rows[r] = pending[r]
+                        changed = True
+                    pending[r] = 0
+        return changed
+
+    def select(self, row_idx):
+        # The state machine drives the rows; a new pass reads the FIFO
+        if row_idx == 0:
+            self.poll()
+        self.active = row_idx
+
+    def read(self):
+        return self.rows[self.active]
+
+# --- CPython model of the PIO instructions used above ---
+
+class Instruction:
+    def __init__(self, op, args):
+        self.op = op
+        self.args = args
+        self.delay = 0
+
+    def __getitem__(self, delay):
+        self.delay = delay
+        return self
+
+def assemble(program):
+    """Assemble a program function like rp2.asm_pio; returns (instructions, labels, wrap)"""
+    from types import FunctionType  # CPython only, MicroPython has no types module
+    instructions = []
+    labels = {}
+    wrap = [0, None]
+
+    def emit(op):
+        def add(*args):
+            instruction = Instruction(op, args)
+            instructions.append(instruction)
+            return instruction
+        return add
+
+    def set_wrap_target():
+        wrap[0] = len(instructions)
+
+    def set_wrap():
+        wrap[1] = len(instructions) - 1
+
+    dsl = {
+        'wrap_target': set_wrap_target, 'wrap': set_wrap,
+        'label': lambda name: labels.__setitem__(name, len(instructions)),
+        'set': emit('set'), 'in_': emit('in'), 'out': emit('out'), 'mov': emit('mov'),
+        'jmp': emit('jmp'), 'push': emit('push'),
+        'invert': lambda src: ('invert', src), 'reverse': lambda src: ('reverse', src),
+    }
+    for name in ('pins', 'x', 'y', 'null', 'isr', 'osr', 'not_x', 'x_dec',
+                 'not_y', 'y_dec', 'block', 'noblock'):
+        dsl[name] = name
+    FunctionType(program.__code__, dsl, closure=program.__closure__)()
+    if wrap[1] is None:
+        wrap[1] = len(instructions) - 1
+    return instructions, labels, wrap
+
+def reverse32(value):
+    result = 0
+    for _ in range(32):
+        result = (result << 1) | (value & 1)
+        value >>= 1
+    return result
+
+class PioModel:
+    """Runs the scan program one PIO cycle at a time against a SimulatedBank
+
+    Has the rx_fifo()/get() interface of rp2.StateMachine, so PioBank can
+    use it directly.
+    """
+    def __init__(self, bank, num_rows, num_cols, settle=10, fifo_depth=8):
+        self.bank = bank
+        self.num_rows = num_rows
+        self.num_cols = num_cols
+        self.instructions, self.labels, self.wrap = assemble(
+            scan_program(num_rows, num_cols, settle))
+        self.fifo = []
+        self.fifo_depth = fifo_depth
+        self.pc = self.wrap[0]
+        self.x = self.y = self.isr = self.osr = 0
+        self.out_pins = (1 << num_rows) - 1
+        self.delay = 0
+        self.cycles = 0
+        self.stalls = 0  # cycles spent waiting for FIFO space
+        self.scans = 0   # passes through the "scan" label
+
+    def rx_fifo(self):
+        return len(self.fifo)
+
+    def get(self):
+        return self.fifo.pop(0)
+
+    def read_pins(self):
+        """Column levels at the in pins: pressed keys on the low row pull low"""
+        low = ~self.out_pins & ((1 << self.num_rows) - 1)
+        pressed = 0
+        for r in range(self.num_rows):
+            if low & (1 << r):
+                self.bank.active = r
+                pressed |= self.bank.read()
+        return ~pressed & 0xFFFFFFFF
+
+    def source(self, src):
+        if isinstance(src, tuple):
+            value = self.source(src[1])
+            if src[0] == 'invert':
+                return ~value & 0xFFFFFFFF
+            return reverse32(value)
+        if src == 'pins':
+            return self.read_pins()
+        if src == 'null':
+            return 0
+        return getattr(self, src)
+
+    def run(self, cycles):
+        """Advance the state machine by cycles PIO clock cycles"""
+        for _ in range(cycles):
+            self.cycles += 1
+            if self.delay:
+                self.delay -= 1
+                continue
+            self.step()
+
+    def step(self):
+        instruction = self.instructions[self.pc]
+        op = instruction.op
+        args = instruction.args
+        next_pc = self.pc + 1
+        if self.pc == self.wrap[1]:
+            next_pc = self.wrap[0]
+        if self.pc == self.labels.get("scan"):
+            self.scans += 1
+
+        if op == 'set':
+            setattr(self, args[0], args[1])
+        elif op == 'mov':
+            value = self.source(args[1])
+            if args[0] == 'pins':
+                self.out_pins = value & ((1 << self.num_rows) - 1)
+            else:
+                setattr(self, args[0], value)
+        elif op == 'in':
+            bits = args[1]
+            mask = (1 << bits) - 1
+            self.isr = ((self.isr << bits) | (self.source(args[0]) & mask)) & 0xFFFFFFFF
+        elif op == 'out':
+            # Only out(null, n) is used: discard n bits from the OSR
+            self.osr >>= args[1]
+        elif op == 'push':
+            if len(self.fifo) >= self.fifo_depth:
+                self.stalls += 1
+                return  # blocking push: retry next cycle, delay not yet applied
+            self.fifo.append(self.isr)
+            self.isr = 0
+        elif op == 'jmp':
+            if len(args) == 1:
+                next_pc = self.labels[args[0]]
+            else:
+                condition, target = args
+                if condition == 'not_x':
+                    taken = self.x == 0
+                elif condition == 'not_y':
+                    taken = self.y == 0
+                elif condition == 'x_dec':
+                    taken = self.x != 0
+                    self.x = (self.x - 1) & 0xFFFFFFFF
+                else:
+                    taken = self.y != 0
+                    self.y = (self.y - 1) & 0xFFFFFFFF
+                if taken:
+                    next_pc = self.labels[target]
+
+        self.delay = instruction.delay
+        self.pc = next_pc
+
+def simulate(num_rows=8, num_cols=16, settle=10, poll_us=1000):
+    """Model the PIO scanner with a 1 kHz Python poll and report the FIFO traffic"""
+    bank = SimulatedBank(num_rows, num_cols)
+    model = PioModel(bank, num_rows, num_cols, settle)
+    pio_bank = PioBank(model, num_rows, num_cols)
+    scanner = MatrixScanner(pio_bank, num_rows, num_cols)
+    print(f"Program: {len(model.instructions)} instructions")
+
+    # Scan period with no keys down
+    model.run(5000)
+    start_cycles, start_scans = model.cycles, model.scans
+    model.run(10000)
+    period = (model.cycles - start_cycles) / (model.scans - start_scans)
+    print(f"{num_rows}x{num_cols} matrix, settle {settle} cycles: {period:.0f} cycles per scan "
+          f"({PIO_FREQ / period:.0f} scans/s at {PIO_FREQ // 1000} kHz)")
+
+    def phase(label, polls):
+        words = pio_bank.words
+        events = []
+        for _ in range(polls):
+            model.run(poll_us)
+            scanner.scan()
+            event = scanner.pop_event()
+            while event != NO_EVENT:
+                sign = '+' if event_pressed(event) else '-'
+                events.append(f"{sign}R{event_row(event)}C{event_col(event)}")
+                event = scanner.pop_event()
+        print(f"  {label:18} {pio_bank.words - words:5d} FIFO words in {polls} ms, "
+              f"events {events}")
+
+    phase("idle", 100)
+    bank.press(2, 3)
+    bank.press(5, 11)
+    phase("two keys pressed", 100)
+    bank.release(2, 3)
+    bank.release(5, 11)
+    phase("released", 100)
+    phase("idle again", 100)
+    print(f"  push stalls while Python was not polling: {model.stalls} cycles")
+    return scanner
+
+if __name__ == "__main__":
+    simulate()
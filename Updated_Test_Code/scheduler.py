@@ -0,0 +1,495 @@
+"""
+Cooperative device scheduler for the Multi-Ribbon interface
+Runs every connector as its own asyncio task at the rate its device needs
+(keyboard 1 kHz, trackpad 200 Hz, USB detect 2 Hz by default, or the
+connector's "rate_hz" param), next to a UART command task and a telemetry
+task. A slow trackpad read then only delays the keyboard when the trackpad
+is actually due, instead of on every pass of a single loop.
+
+Each task keeps an absolute schedule: it sleeps until its next due time,
+records how late it started (jitter) and how long it ran, and skips whole
+periods rather than running a burst when it falls behind. Tasks yield to
+each other only between runs, so one device read is never interrupted.
+Tasks of the same rate start staggered across their period, and slower
+devices start just after a keyboard run, so two trackpad reads do not land
+back to back on a keyboard's due time. Only the last stretch before a due
+time, as long as asyncio's measured wake-up lateness, is spent yielding.
+
+DeadlinePoller does the same for the single polling loop without asyncio:
+each connector's next due time sits in a small heap, every poll runs the
+most overdue connector first (keyboards before trackpads before USB on a
+tie), and a connector that starts later than its deadline ("deadline_us"
+param, one period by default) counts a miss.
+
+Run with CPython to compare keyboard latency, jitter and deadline misses for
+the plain loop, the deadline loop and the tasks, with simulated devices.
+"""
+
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+import heapq
+from matrix_scan import ticks_us, ticks_diff, ticks_add
+
+# Polls per second for each device type
+DEFAULT_RATES = {'keyboard': 1000, 'trackpad': 200, 'usb': 2}
+# Order among connectors due at the same time
+PRIORITIES = {'keyboard': 0, 'trackpad': 1, 'usb': 2}
+COMMAND_RATE = 20
+TELEMETRY_RATE = 1000
+# asyncio wakes a sleeping task late (MicroPython's asyncio counts in
+# milliseconds): tasks sleep until spin_us before the due time, then keep
+# yielding. RibbonScheduler measures spin_us at startup; these bound it.
+SPIN_MIN_US = 100
+SPIN_MAX_US = 1000
+# Slower devices start this far into the fastest task's period, after its run
+STAGGER_US = 150
+# DeadlinePoller keeps due times relative to an epoch, moved forward before
+# they outgrow a small int or reach the ticks_us() wrap
+REBASE_US = 1 << 28
+
+def device_rate(config, rates=DEFAULT_RATES):
+    """Polls per second for a connector: its "rate_hz" param or the type's default"""
+    return config.params.get('rate_hz', rates.get(config.device_type, 100))
+
+class TaskStats:
+    """Start lateness and run time of one periodic task, in microseconds"""
+    def __init__(self, period_us, deadline_us=None):
+        self.period_us = period_us
+        self.deadline_us = deadline_us or period_us  # lateness counted as a miss
+        self.runs = 0
+        self.late_total = 0
+        self.late_max = 0
+        self.run_total = 0
+        self.run_max = 0
+        self.skipped = 0  # periods missed entirely
+        self.misses = 0   # runs that started after the deadline
+        self.sleeps = 0   # real sleeps, as opposed to yields while spinning
+
+    def record(self, late, run):
+        self.runs += 1
+        if late >= self.deadline_us:
+            self.misses += 1
+        self.late_total += late
+        self.run_total += run
+        if late > self.late_max:
+            self.late_max = late
+        if run > self.run_max:
+            self.run_max = run
+
+    def summary(self):
+        runs = self.runs or 1
+        return {'rate_hz': 1_000_000 // self.period_us, 'runs': self.runs,
+                'jitter_mean_us': self.late_total // runs, 'jitter_max_us': self.late_max,
+                'run_mean_us': self.run_total // runs, 'run_max_us': self.run_max,
+                'skipped': self.skipped, 'misses': self.misses,
+                'sleeps': self.sleeps}
+
+async def measure_spin_us(samples=20, clock=ticks_us):
+    """How late asyncio.sleep() wakes up: the 90th percentile of a few 1 ms
+    sleeps, bounded by SPIN_MIN_US and SPIN_MAX_US"""
+    lateness = []
+    for _ in range(samples):
+        start = clock()
+        await asyncio.sleep(0.001)
+        lateness.append(ticks_diff(clock(), start) - 1000)
+    lateness.sort()
+    return min(max(lateness[samples * 9 // 10], SPIN_MIN_US), SPIN_MAX_US)
+
+def stagger(periods, slot_us=STAGGER_US):
+    """First-run offsets in us for tasks with the given periods: tasks of
+    one rate spread evenly over their period, and slower rates moved to
+    slot_us after a run of the fastest tasks"""
+    fastest = min(periods) if periods else 0
+    offsets = []
+    for i, period in enumerate(periods):
+        same = [j for j, other in enumerate(periods) if other == period]
+        offset = same.index(i) * period // len(same)
+        if period != fastest:
+            offset = offset - offset % fastest + slot_us
+        offsets.append(offset)
+    return offsets
+
+async def periodic(work, period_us, stats, clock=ticks_us, offset_us=0, spin_us=SPIN_MAX_US):
+    """Call work() every period_us microseconds, first after offset_us, until cancelled"""
+    due = ticks_add(clock(), offset_us)
+    while True:
+        wait = ticks_diff(due, clock())
+        if wait > spin_us:
+            stats.sleeps += 1
+            await asyncio.sleep((wait - spin_us) / 1_000_000)
+            continue
+        if wait > 0:
+            await asyncio.sleep(0)
+            continue
+        start = clock()
+        work()
+        end = clock()
+        stats.record(ticks_diff(start, due), ticks_diff(end, start))
+        due = ticks_add(due, period_us)
+        behind = ticks_diff(end, due)
+        if behind >= period_us:
+            missed = behind // period_us
+            stats.skipped += missed
+            due = ticks_add(due, missed * period_us)
+        # Always yield after a run, so a late task cannot starve the others
+        await asyncio.sleep(0)
+
+class RibbonScheduler:
+    """Runs each connector, UART commands and telemetry as separate asyncio tasks"""
+    def __init__(self, manager, rates=None, clock=ticks_us):
+        self.manager = manager
+        self.rates = dict(DEFAULT_RATES)
+        if rates:
+            self.rates.update(rates)
+        self.clock = clock
+        self.stats = {}          # task name -> TaskStats
+        self.device_tasks = []
+        self.spin_us = SPIN_MAX_US  # replaced by a measurement in main()
+        self.measure_spin = True
+        self.stagger_us = STAGGER_US  # None starts every task at once
+        manager.task_stats = self.stats  # reported by the 'stats' command
+
+    def rate(self, dev):
+        return device_rate(dev['config'], self.rates)
+
+    def device_poll(self, conn_id):
+        manager = self.manager
+        def poll():
+            data = manager.read_device(conn_id)
+            if data:
+                manager.report({conn_id: data})
+        return poll
+
+    def spawn(self, name, work, rate_hz, offset_us=0):
+        stats = TaskStats(1_000_000 // rate_hz)
+        self.stats[name] = stats
+        return asyncio.create_task(periodic(work, stats.period_us, stats, self.clock,
+                                            offset_us, self.spin_us))
+
+    def start_devices(self):
+        """(Re)start one task per configured connector, staggered"""
+        for task in self.device_tasks:
+            task.cancel()
+        for conn_id in [name for name in self.stats if name not in ('commands', 'telemetry')]:
+            del self.stats[conn_id]
+        devices = list(self.manager.devices.items())
+        rates = [self.rate(dev) for conn_id, dev in devices]
+        offsets = [0] * len(rates)
+        if self.stagger_us is not None:
+            offsets = stagger([1_000_000 // rate for rate in rates], self.stagger_us)
+        self.device_tasks = [self.spawn(conn_id, self.device_poll(conn_id), rate, offset)
+                             for (conn_id, dev), rate, offset in zip(devices, rates, offsets)]
+
+    def check_commands(self):
+        cmd = self.manager.check_commands()
+        if cmd and self.manager.handle_command(cmd):
+            self.start_devices()
+
+    def flush_telemetry(self):
+        # Looked up each time: set_telemetry_mode() replaces the link
+        self.manager.telemetry.flush()
+
+    async def main(self, seconds=None):
+        if self.measure_spin:
+            self.spin_us = await measure_spin_us(clock=self.clock)
+        self.start_devices()
+        # Halfway between keyboard runs
+        half = 0 if self.stagger_us is None else 2
+        tasks = [self.spawn('commands', self.check_commands, COMMAND_RATE,
+                            half and 1_000_000 // COMMAND_RATE // half),
+                 self.spawn('telemetry', self.flush_telemetry, TELEMETRY_RATE,
+                            half and 1_000_000 // TELEMETRY_RATE // half)]
+        if seconds is None:
+            await asyncio.gather(*tasks)
+            return
+        await asyncio.sleep(seconds)
+        for task in tasks + self.device_tasks:
+            task.cancel()
+
+    def run(self, seconds=None):
+        """Run the tasks forever, or for seconds"""
+        asyncio.run(self.main(seconds))
+
+    def summary(self):
+        return {name: stats.summary() for name, stats in self.stats.items()}
+
+class DeadlinePoller:
+    """Polls connectors most overdue first from a heap of next due times"""
+    def __init__(self, rates=None, clock=ticks_us):
+        self.rates = dict(DEFAULT_RATES)
+        if rates:
+            self.rates.update(rates)
+        self.clock = clock
+        self.epoch = clock()
+        self.heap = []    # (due us after epoch, priority, sequence, connector id)
+        self.stats = {}   # connector id -> TaskStats
+        self.sequence = 0
+
+    def add(self, conn_id, config):
+        """Schedule a connector, replacing any earlier entry for it"""
+        self.remove(conn_id)
+        stats = TaskStats(1_000_000 // device_rate(config, self.rates),
+                          config.params.get('deadline_us'))
+        self.stats[conn_id] = stats
+        self.sequence += 1
+        due = ticks_diff(self.clock(), self.epoch)
+        heapq.heappush(self.heap, (due, PRIORITIES.get(config.device_type, 3),
+                                   self.sequence, conn_id))
+
+    def remove(self, conn_id):
+        if conn_id in self.stats:
+            del self.stats[conn_id]
+            self.heap = [entry for entry in self.heap if entry[3] != conn_id]
+            heapq.heapify(self.heap)
+
+    def clear(self):
+        self.heap = []
+        self.stats.clear()
+
+    def rebase(self, now):
+        shift = ticks_diff(now, self.epoch)
+        self.epoch = now
+        self.heap = [(due - shift, priority, sequence, conn_id)
+                     for due, priority, sequence, conn_id in self.heap]
+        heapq.heapify(self.heap)
+
+    def poll(self, read):
+        """Call read(conn_id) for each connector that is due, most overdue
+        first, and return {conn_id: data} for the ones that returned data.
+        At most one read per scheduled connector, so a pass always ends."""
+        results = {}
+        heap = self.heap
+        clock = self.clock
+        for _ in range(len(heap)):
+            start = clock()
+            now = ticks_diff(start, self.epoch)
+            if now >= REBASE_US:
+                self.rebase(start)
+                heap = self.heap
+                now = 0
+            due, priority, sequence, conn_id = heap[0]
+            if due > now:
+                break
+            data = read(conn_id)
+            end = clock()
+            stats = self.stats[conn_id]
+            stats.record(now - due, ticks_diff(end, start))
+            period = stats.period_us
+            due += period
+            behind = ticks_diff(end, self.epoch) - due
+            if behind >= period:
+                missed = behind // period
+                stats.skipped += missed
+                due += missed * period
+            # MicroPython's heapq has no heapreplace()
+            heapq.heappop(heap)
+            heapq.heappush(heap, (due, priority, sequence, conn_id))
+            if data:
+                if conn_id in results and isinstance(data, list):
+                    results[conn_id].extend(data)
+                else:
+                    results[conn_id] = data
+        return results
+
+    def summary(self):
+        return {conn_id: stats.summary() for conn_id, stats in self.stats.items()}
+
+# --- Simulation ---
+# Runs on a virtual clock so results do not depend on the host's load: every
+# clock reading costs READ_US, a device read costs its bus time, each asyncio
+# scheduler pass costs YIELD_US, and sleeps wake on SLEEP_RESOLUTION_US
+# boundaries like MicroPython's millisecond asyncio timers.
+READ_US = 1
+YIELD_US = 20
+SLEEP_RESOLUTION_US = 100
+
+class VirtualClock:
+    """A ticks_us() replacement that only moves when the simulation says so"""
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        self.now += READ_US
+        return self.now
+
+    def advance(self, us):
+        self.now += us
+
+def virtual_loop(clock):
+    """An asyncio event loop whose time and sleeps follow clock"""
+    import selectors
+
+    class VirtualSelector(selectors.SelectSelector):
+        slept = 0
+
+        def select(self, timeout=None):
+            clock.advance(YIELD_US)
+            if timeout:
+                wake = clock.now + int(timeout * 1_000_000)
+                wake = -(-wake // SLEEP_RESOLUTION_US) * SLEEP_RESOLUTION_US
+                self.slept += wake - clock.now
+                clock.now = wake
+            return []
+
+    selector = VirtualSelector()
+    loop = asyncio.SelectorEventLoop(selector)
+    loop.time = lambda: clock.now / 1_000_000
+    return loop, selector
+
+class SimulatedDevice:
+    """A device whose read takes cost_us of CPU, like a blocking bus transfer"""
+    def __init__(self, device_type, cost_us, clock):
+        self.config = SimulatedConfig(device_type)
+        self.cost_us = cost_us
+        self.clock = clock
+        self.presses = []     # keyboard: due times of simulated key presses
+        self.latencies = []   # keyboard: press to detection, us
+
+    def read(self):
+        self.clock.advance(self.cost_us)
+        now = self.clock()
+        found = []
+        while self.presses and ticks_diff(now, self.presses[0]) >= 0:
+            self.latencies.append(ticks_diff(now, self.presses.pop(0)))
+            found.append(0x8000)
+        return found
+
+class SimulatedConfig:
+    def __init__(self, device_type):
+        self.device_type = device_type
+        self.params = {}
+
+class SimulatedTelemetry:
+    def flush(self):
+        return 0
+
+class SimulatedManager:
+    """The parts of RibbonManager the schedulers use, with simulated devices"""
+    def __init__(self, devices, clock):
+        self.devices = {conn_id: {'device': dev, 'config': dev.config}
+                        for conn_id, dev in devices.items()}
+        self.telemetry = SimulatedTelemetry()
+        self.poller = DeadlinePoller(clock=clock)
+        for conn_id, dev in devices.items():
+            self.poller.add(conn_id, dev.config)
+        self.task_stats = self.poller.stats
+        self.reports = 0
+
+    def read_device(self, conn_id):
+        return self.devices[conn_id]['device'].read()
+
+    def poll_all(self):
+        return self.poller.poll(self.read_device)
+
+    def poll_every(self):
+        """Every device on every pass, as poll_all() did before DeadlinePoller"""
+        results = {}
+        for conn_id in self.devices:
+            data = self.read_device(conn_id)
+            if data:
+                results[conn_id] = data
+        return results
+
+    def report(self, results):
+        self.reports += 1
+
+    def check_commands(self):
+        return None
+
+    def handle_command(self, cmd):
+        return False
+
+def simulated_manager(seconds, trackpad_us=600):
+    """A keyboard with 200 random key presses, two slow I2C trackpads and a
+    USB port, on a fresh virtual clock"""
+    import random
+    random.seed(1)
+    clock = VirtualClock()
+    keyboard = SimulatedDevice('keyboard', 60, clock)
+    start = 50_000
+    keyboard.presses = sorted(start + random.randrange(seconds * 1_000_000)
+                              for _ in range(200))
+    devices = {'CONN1': keyboard,
+               'CONN2': SimulatedDevice('trackpad', trackpad_us, clock),
+               'CONN3': SimulatedDevice('usb', 20, clock),
+               'CONN4': SimulatedDevice('trackpad', trackpad_us, clock)}
+    return SimulatedManager(devices, clock), keyboard, clock
+
+def poll_every_loop(manager, seconds, clock):
+    """The single loop before DeadlinePoller: every device each 1 ms pass"""
+    stats = TaskStats(1000)
+    end = ticks_add(clock(), int(seconds * 1_000_000))
+    last = clock()
+    while ticks_diff(end, clock()) > 0:
+        now = clock()
+        if ticks_diff(now, last) >= 1000:
+            start = clock()
+            if manager.poll_every():
+                manager.report(None)
+            stats.record(ticks_diff(start, last) - 1000, ticks_diff(clock(), start))
+            last = now
+        manager.telemetry.flush()
+    return stats
+
+def deadline_loop(manager, seconds, clock):
+    """Multi-Ribbon's poll_loop(): poll_all() on every pass of the loop"""
+    end = ticks_add(clock(), int(seconds * 1_000_000))
+    while ticks_diff(end, clock()) > 0:
+        if manager.poll_all():
+            manager.report(None)
+        manager.telemetry.flush()
+
+def run_tasks(seconds, run_for, staggered):
+    """RibbonScheduler on the virtual clock; returns (scheduler, keyboard,
+    share of the time the core was asleep)"""
+    manager, keyboard, clock = simulated_manager(seconds)
+    scheduler = RibbonScheduler(manager, clock=clock)
+    if not staggered:
+        # As first written: every task due at once, spinning a whole period
+        scheduler.measure_spin = False
+        scheduler.stagger_us = None
+    loop, selector = virtual_loop(clock)
+    start = clock.now
+    try:
+        loop.run_until_complete(scheduler.main(run_for))
+    finally:
+        loop.close()
+    return scheduler, keyboard, selector.slept / (clock.now - start)
+
+def print_tasks(summary):
+    for name, task in summary.items():
+        print(f"  {name:9} {task['rate_hz']:5d} Hz: {task['runs']:5d} runs, "
+              f"jitter mean {task['jitter_mean_us']:5d} us max {task['jitter_max_us']:6d} us, "
+              f"run mean {task['run_mean_us']:5d} us, {task['misses']} deadline misses")
+
+def latency_line(label, latencies):
+    latencies = sorted(latencies)
+    mean = sum(latencies) // len(latencies)
+    p99 = latencies[len(latencies) * 99 // 100]
+    return (f"{label}: key press to detection mean {mean} us, 99th percentile {p99} us, "
+            f"max {latencies[-1]} us ({len(latencies)} presses)")
+
+def simulate(seconds=2):
+    """Keyboard latency, jitter and deadline misses for the ways of polling"""
+    manager, keyboard, clock = simulated_manager(seconds)
+    loop_stats = poll_every_loop(manager, seconds + 0.1, clock)
+    print(latency_line("single loop   ", keyboard.latencies))
+    summary = loop_stats.summary()
+    print(f"  every device each pass: {summary['runs']} passes, "
+          f"pass takes {summary['run_mean_us']} us, {summary['misses']} passes late")
+
+    manager, keyboard, clock = simulated_manager(seconds)
+    deadline_loop(manager, seconds + 0.1, clock)
+    print(latency_line("deadline loop ", keyboard.latencies))
+    print_tasks(manager.poller.summary())
+
+    for staggered, label in ((False, "tasks, aligned"), (True, "tasks, stagger")):
+        scheduler, keyboard, asleep = run_tasks(seconds, seconds + 0.1, staggered)
+        print(latency_line(label, keyboard.latencies))
+        print(f"  spin {scheduler.spin_us} us, core asleep {asleep * 100:.0f}% of the time")
+        print_tasks(scheduler.summary())
+
+if __name__ == "__main__":
+    simulate()
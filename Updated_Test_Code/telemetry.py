@@ -0,0 +1,516 @@
+"""
+Binary UART telemetry for the Multi-Ribbon interface
+Device changes are queued as small records and written in frames:
+
+  0xA5 | body length | records ... | CRC-16/CCITT of length + body (low byte first)
+
+Each record is type, connector index, payload length, payload. Many records
+share one frame. Trackpad and USB readings are coalesced, so only the newest
+reading per connector is sent. Key events wait in a bounded ring buffer.
+A frame is only written once the UART has had time to send the previous one
+at the baud rate, so writes never block the poll loop. If the ring fills,
+the events that do not fit are counted, that keyboard's events are held
+back and its full key state is sent once the ring has drained, so the host
+can resynchronise. Connector names go out once,
+as NAME records, and later records carry a one-byte index.
+
+TelemetryLink(mode='json') keeps the old one JSON line per batch as a debug
+mode. FrameDecoder is the host side. Run with CPython to simulate a busy
+session and compare the binary and JSON modes.
+"""
+
+from array import array
+import json
+from matrix_scan import ticks_us, ticks_diff, ticks_add, event_name, EVENT_PRESSED
+
+BINARY = 'binary'
+JSON = 'json'
+
+SYNC = 0xA5
+MAX_BODY = 120   # ~10 ms of UART time at 115200 baud
+
+# Record types
+REC_KEYS = 1       # 2 bytes per event: row | 0x80 when pressed, column
+REC_KEY_STATE = 2  # 4 bytes per row: pressed column bitmask, after dropped events
+REC_TRACKPAD = 3   # x (u16), y (u16), buttons (u8)
+REC_USB = 4        # connected (u8)
+REC_TEXT = 5       # UTF-8 JSON, e.g. statistics
+REC_NAME = 6       # connector name for the index in the record header
+REC_DROPPED = 7    # key events dropped since the last report (u16)
+REC_TEXT_MORE = 8  # a REC_TEXT chunk with more to follow
+REC_GESTURE = 9    # kind (u8), value (i8) - see gestures.py
+NO_CONNECTOR = 0xFF
+
+def make_crc_table():
+    table = array('H', [0] * 256)
+    for i in range(256):
+        crc = i << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else crc << 1
+        table[i] = crc & 0xFFFF
+    return table
+
+CRC_TABLE = make_crc_table()
+
+def crc16(data, start, end, crc=0xFFFF):
+    """CRC-16/CCITT-FALSE of data[start:end]"""
+    table = CRC_TABLE
+    for i in range(start, end):
+        crc = ((crc << 8) & 0xFFFF) ^ table[((crc >> 8) ^ data[i]) & 0xFF]
+    return crc
+
+class TelemetryLink:
+    """Queues device changes and writes them to the UART in rate-limited frames"""
+    def __init__(self, uart, baud=115200, mode=BINARY, ring_size=2048,
+                 max_body=MAX_BODY, clock=ticks_us):
+        if mode not in (BINARY, JSON):
+            raise ValueError(f"Unknown telemetry mode: {mode}")
+        self.uart = uart
+        self.mode = mode
+        self.clock = clock
+        self.us_per_byte = 10_000_000 // baud  # start bit, 8 data bits, stop bit
+        self.busy_until = clock()
+
+        # Key events and text, in order, as whole records
+        self.ring = bytearray(ring_size)
+        self.ring_head = 0
+        self.ring_used = 0
+        self.frame = bytearray(max_body + 4)
+        self.max_body = max_body
+
+        self.indexes = {}     # connector name -> index
+        self.names = []       # index -> name
+        self.unnamed = []     # indexes whose NAME record is not sent yet
+        self.states = []      # index -> bytearray of the newest reading, or None
+        self.state_types = bytearray(NO_CONNECTOR)
+        self.dirty = 0        # bit per index with an unsent reading
+        self.resync = {}      # index -> keyboard state array to send
+        self.dropped = 0
+        self.json_pending = {}
+
+        self.frames = 0
+        self.bytes_sent = 0
+        self.errors = 0
+        self.last_error = None
+
+    def connector(self, name):
+        """Return the index for a connector name, announcing new ones"""
+        index = self.indexes.get(name)
+        if index is None:
+            index = len(self.names)
+            if index == NO_CONNECTOR:
+                raise ValueError("too many connectors")
+            self.indexes[name] = index
+            self.names.append(name)
+            self.states.append(None)
+            self.unnamed.append(index)
+        return index
+
+    def announce(self):
+        """Send every connector name again (e.g. after the host reconnects)"""
+        self.unnamed = list(range(len(self.names)))
+
+    # --- Queueing ---
+
+    def ring_put(self, rtype, index, payload, length):
+        """Append a record to the ring; returns False if it does not fit"""
+        size = len(self.ring)
+        if self.ring_used + 3 + length > size:
+            return False
+        ring = self.ring
+        pos = (self.ring_head + self.ring_used) % size
+        for byte in (rtype, index, length):
+            ring[pos] = byte
+            pos = (pos + 1) % size
+        for i in range(length):
+            ring[pos] = payload[i]
+            pos = (pos + 1) % size
+        self.ring_used += 3 + length
+        return True
+
+    def key_events(self, name, events, state=None):
+        """Queue matrix events (see matrix_scan); state is the keyboard's row
+        bitmasks, sent instead if the events do not fit"""
+        if self.mode == JSON:
+            self.json_pending.setdefault(name, []).extend(event_name(e) for e in events)
+            return
+        index = self.connector(name)
+        if index in self.resync:
+            # The state sent once the ring drains will include these
+            self.dropped += len(events)
+            return
+        payload = self.frame  # scratch space, rebuilt in flush()
+        per_record = (self.max_body - 3) // 2
+        for start in range(0, len(events), per_record):
+            chunk = events[start:start + per_record]
+            n = 0
+            for event in chunk:
+                payload[n] = event_row_byte(event)
+                payload[n + 1] = event & 0xFF
+                n += 2
+            if not self.ring_put(REC_KEYS, index, payload, n):
+                self.dropped += len(events) - start
+                if state is not None:
+                    self.resync[index] = state
+                return
+
+    def gesture(self, name, event):
+        """Queue a gesture event (see gestures.py)"""
+        kind = event >> 8
+        value = event & 0xFF
+        if self.mode == JSON:
+            self.json_pending.setdefault(name + '/gestures', []).append(
+                [kind, value - 256 if value > 127 else value])
+            return
+        payload = self.frame  # scratch space, rebuilt in flush()
+        payload[0] = kind
+        payload[1] = value
+        if not self.ring_put(REC_GESTURE, self.connector(name), payload, 2):
+            self.error("gesture dropped, ring full")
+
+    def reading(self, name, rtype, length):
+        """Return the coalesced payload buffer for a connector and mark it dirty"""
+        index = self.connector(name)
+        buf = self.states[index]
+        if buf is None or len(buf) != length:
+            buf = self.states[index] = bytearray(length)
+        self.state_types[index] = rtype
+        self.dirty |= 1 << index
+        return buf
+
+    def trackpad(self, name, x, y, buttons):
+        if self.mode == JSON:
+            self.json_pending[name] = {'x': x, 'y': y, 'buttons': buttons}
+            return
+        buf = self.reading(name, REC_TRACKPAD, 5)
+        buf[0] = x & 0xFF
+        buf[1] = (x >> 8) & 0xFF
+        buf[2] = y & 0xFF
+        buf[3] = (y >> 8) & 0xFF
+        buf[4] = buttons & 0xFF
+
+    def usb(self, name, connected):
+        if self.mode == JSON:
+            self.json_pending[name] = {'connected': connected}
+            return
+        self.reading(name, REC_USB, 1)[0] = 1 if connected else 0
+
+    def text(self, obj, name=None):
+        """Queue any JSON-serialisable object (statistics, messages)"""
+        if self.mode == JSON:
+            self.json_pending[name or 'text'] = obj
+            return
+        data = json.dumps(obj).encode()
+        index = NO_CONNECTOR if name is None else self.connector(name)
+        chunk = self.max_body - 3
+        chunks = (len(data) + chunk - 1) // chunk
+        if self.ring_used + 3 * chunks + len(data) > len(self.ring):
+            self.error("text dropped, ring full")
+            return
+        for start in range(0, len(data), chunk):
+            part = data[start:start + chunk]
+            more = start + chunk < len(data)
+            self.ring_put(REC_TEXT_MORE if more else REC_TEXT, index, part, len(part))
+
+    def pending(self):
+        return bool(self.unnamed or self.dirty or self.ring_used or self.resync or
+                    self.dropped or self.json_pending)
+
+    # --- Sending ---
+
+    def ready(self):
+        """True once the previous frame has had time to leave the UART"""
+        return ticks_diff(self.clock(), self.busy_until) >= 0
+
+    def flush(self):
+        """Write one frame if the UART is free and anything is queued; returns bytes written"""
+        if not self.pending() or not self.ready():
+            return 0
+        if self.mode == JSON:
+            data = json.dumps(self.json_pending) + '\n'
+            self.json_pending = {}
+            return self.write(data, len(data))
+
+        frame = self.frame
+        n = 2
+        limit = 2 + self.max_body
+
+        # Names first, so every later record can be decoded
+        while self.unnamed:
+            index = self.unnamed[0]
+            name = self.names[index].encode()
+            if n + 3 + len(name) > limit:
+                break
+            n = self.put_record(n, REC_NAME, index, name, len(name))
+            self.unnamed.pop(0)
+
+        if self.dropped and n + 5 <= limit:
+            count = min(self.dropped, 0xFFFF)
+            frame[n:n + 5] = bytes((REC_DROPPED, NO_CONNECTOR, 2, count & 0xFF, count >> 8))
+            n += 5
+            self.dropped -= count
+
+        dirty = self.dirty
+        index = 0
+        while dirty:
+            if dirty & 1:
+                buf = self.states[index]
+                if n + 3 + len(buf) > limit:
+                    break
+                n = self.put_record(n, self.state_types[index], index, buf, len(buf))
+                self.dirty &= ~(1 << index)
+            dirty >>= 1
+            index += 1
+
+        # Queued events, oldest first, as many whole records as fit
+        ring = self.ring
+        size = len(ring)
+        while self.ring_used:
+            length = 3 + ring[(self.ring_head + 2) % size]
+            if n + length > limit:
+                break
+            for _ in range(length):
+                frame[n] = ring[self.ring_head]
+                self.ring_head = (self.ring_head + 1) % size
+                n += 1
+            self.ring_used -= length
+
+        # The key state goes after every event queued before it, so the host
+        # can apply it over what it already has
+        if not self.ring_used:
+            for index in list(self.resync):
+                state = self.resync[index]
+                if n + 3 + 4 * len(state) > limit:
+                    break
+                frame[n] = REC_KEY_STATE
+                frame[n + 1] = index
+                frame[n + 2] = 4 * len(state)
+                n += 3
+                for mask in state:
+                    frame[n] = mask & 0xFF
+                    frame[n + 1] = (mask >> 8) & 0xFF
+                    frame[n + 2] = (mask >> 16) & 0xFF
+                    frame[n + 3] = (mask >> 24) & 0xFF
+                    n += 4
+                del self.resync[index]
+
+        if n == 2:
+            return 0
+        frame[0] = SYNC
+        frame[1] = n - 2
+        crc = crc16(frame, 1, n)
+        frame[n] = crc & 0xFF
+        frame[n + 1] = crc >> 8
+        return self.write(memoryview(frame)[:n + 2], n + 2)
+
+    def put_record(self, n, rtype, index, payload, length):
+        frame = self.frame
+        frame[n] = rtype
+        frame[n + 1] = index
+        frame[n + 2] = length
+        frame[n + 3:n + 3 + length] = payload[:length]
+        return n + 3 + length
+
+    def write(self, data, length):
+        try:
+            self.uart.write(data)
+        except Exception as e:
+            self.error(e)
+            return 0
+        self.busy_until = ticks_add(self.clock(), length * self.us_per_byte)
+        self.frames += 1
+        self.bytes_sent += length
+        return length
+
+    def error(self, e):
+        # Counted and kept for 'stats'; printing on every failure would flood the console
+        if not self.errors:
+            print(f"Telemetry error: {e}")
+        self.errors += 1
+        self.last_error = str(e)
+
+    def stats(self):
+        return {'frames': self.frames, 'bytes': self.bytes_sent, 'errors': self.errors,
+                'last_error': self.last_error, 'queued': self.ring_used}
+
+def event_row_byte(event):
+    return ((event >> 8) & 0x7F) | (0x80 if event & EVENT_PRESSED else 0)
+
+# --- Host side ---
+
+class FrameDecoder:
+    """Turns the UART byte stream back into (kind, connector, value) records"""
+    KINDS = {REC_KEYS: 'keys', REC_KEY_STATE: 'key_state', REC_TRACKPAD: 'trackpad',
+             REC_USB: 'usb', REC_TEXT: 'text', REC_DROPPED: 'dropped',
+             REC_GESTURE: 'gesture'}
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.names = {}
+        self.text = {}  # connector index -> REC_TEXT_MORE chunks so far
+        self.frames = 0
+        self.crc_errors = 0
+        self.skipped = 0
+
+    def feed(self, data):
+        """Add received bytes; return the records of every complete frame"""
+        buffer = self.buffer
+        buffer += data
+        records = []
+        while True:
+            start = buffer.find(bytes((SYNC,)))
+            if start < 0:
+                self.skipped += len(buffer)
+                buffer.clear()
+                break
+            if start:
+                self.skipped += start
+                del buffer[:start]
+            if len(buffer) < 2:
+                break
+            n = buffer[1]
+            if len(buffer) < n + 4:
+                break
+            if crc16(buffer, 1, n + 2) != buffer[n + 2] | (buffer[n + 3] << 8):
+                # Not a frame start after all, or corrupted: resync on the next SYNC
+                self.crc_errors += 1
+                del buffer[:1]
+                continue
+            records.extend(self.parse(bytes(buffer[2:n + 2])))
+            self.frames += 1
+            del buffer[:n + 4]
+        return records
+
+    def parse(self, body):
+        records = []
+        i = 0
+        while i + 3 <= len(body):
+            rtype, index, length = body[i], body[i + 1], body[i + 2]
+            payload = body[i + 3:i + 3 + length]
+            i += 3 + length
+            if rtype == REC_NAME:
+                self.names[index] = payload.decode()
+                continue
+            if rtype == REC_TEXT_MORE:
+                self.text[index] = self.text.get(index, b'') + payload
+                continue
+            name = None if index == NO_CONNECTOR else self.names.get(index, f"#{index}")
+            if rtype == REC_KEYS:
+                value = [(payload[j] & 0x7F, payload[j + 1], bool(payload[j] & 0x80))
+                         for j in range(0, length, 2)]
+            elif rtype == REC_KEY_STATE:
+                value = [int.from_bytes(payload[j:j + 4], 'little') for j in range(0, length, 4)]
+            elif rtype == REC_TRACKPAD:
+                value = (payload[0] | (payload[1] << 8), payload[2] | (payload[3] << 8), payload[4])
+            elif rtype == REC_USB:
+                value = bool(payload[0])
+            elif rtype == REC_TEXT:
+                value = json.loads(self.text.pop(index, b'') + payload)
+            elif rtype == REC_GESTURE:
+                value = (payload[0], payload[1] - 256 if payload[1] > 127 else payload[1])
+            elif rtype == REC_DROPPED:
+                value = payload[0] | (payload[1] << 8)
+            else:
+                value = payload
+            records.append((self.KINDS.get(rtype, rtype), name, value))
+        return records
+
+# --- Simulation ---
+
+class SimulatedUART:
+    """Collects written bytes and the time they were written"""
+    def __init__(self):
+        self.data = bytearray()
+        self.writes = 0
+
+    def write(self, data):
+        self.data += data.encode() if isinstance(data, str) else data
+        self.writes += 1
+        return len(data)
+
+def session(mode, seconds=2, burst=0):
+    """Poll a keyboard, a 200 Hz trackpad and a USB port every millisecond"""
+    now = [0]
+    uart = SimulatedUART()
+    link = TelemetryLink(uart, mode=mode, clock=lambda: now[0])
+    sent_events = []
+    state = array('L', [0] * 8)
+    wanted = 0  # bytes the old code would have written
+    for ms in range(seconds * 1000):
+        now[0] = ms * 1000
+        polled = {}
+        if ms % 40 == 0 or (burst and ms == 500):
+            # A key press or release every 40 ms, and optionally a burst
+            count = burst if burst and ms == 500 else 1
+            events = []
+            for k in range(count):
+                row, col = (ms // 40 + k) % 8, (ms // 40 + 3 * k) % 16
+                pressed = not state[row] & (1 << col)
+                state[row] ^= 1 << col
+                events.append((row << 8) | col | (EVENT_PRESSED if pressed else 0))
+            link.key_events('CONN1', events, state)
+            sent_events.extend(events)
+            polled['CONN1'] = [event_name(e) for e in events]
+        if ms % 5 == 0:
+            x, y = 500 + ms % 300, 300 + ms % 200
+            link.trackpad('CONN2', x, y, 0)
+            polled['CONN2'] = {'x': x, 'y': y, 'buttons': 0,
+                               'left_click': False, 'right_click': False}
+        if ms % 500 == 0:
+            link.usb('CONN3', ms % 1000 == 0)
+            polled['CONN3'] = {'connected': ms % 1000 == 0}
+        if polled:
+            wanted += len(json.dumps(polled)) + 1
+        link.flush()
+    # Drain whatever is left
+    while link.pending():
+        now[0] += 1000
+        link.flush()
+    return link, uart, sent_events, state, wanted
+
+def simulate(seconds=2):
+    """Compare the JSON and binary modes and check the decoder"""
+    capacity = 11520 * seconds
+    for mode in (JSON, BINARY):
+        link, uart, sent, state, wanted = session(mode, seconds)
+        print(f"{mode:6}: {len(uart.data):6d} bytes in {link.frames:4d} writes "
+              f"({len(uart.data) * 100 // capacity}% of 115200 baud); "
+              f"one JSON line per poll would need {wanted * 100 // capacity}%")
+
+    decoder = FrameDecoder()
+    records = decoder.feed(uart.data)
+    keys = [r for r in records if r[0] == 'keys']
+    decoded = [(row << 8) | col | (EVENT_PRESSED if pressed else 0)
+               for _, _, events in keys for row, col, pressed in events]
+    last_pad = [r for r in records if r[0] == 'trackpad'][-1]
+    print(f"decoded {decoder.frames} frames: events match {decoded == sent}, "
+          f"last trackpad {last_pad[2]} on {last_pad[1]}, CRC errors {decoder.crc_errors}")
+
+    # Corrupt one byte: that frame is lost, the decoder resynchronises
+    damaged = bytearray(uart.data)
+    damaged[len(damaged) // 2 + 3] ^= 0x10
+    decoder = FrameDecoder()
+    records = decoder.feed(damaged)
+    print(f"one corrupted byte: {decoder.frames} frames decoded, "
+          f"{decoder.crc_errors} CRC rejections, {decoder.skipped} bytes skipped")
+
+    # A burst bigger than the ring: events are dropped, the key state is sent instead
+    link, uart, sent, state, wanted = session(BINARY, seconds, burst=1200)
+    records = FrameDecoder().feed(uart.data)
+    dropped = sum(r[2] for r in records if r[0] == 'dropped')
+    resync = [r[2] for r in records if r[0] == 'key_state']
+    replayed = array('L', [0] * 8)
+    for kind, name, value in records:
+        if kind == 'key_state':
+            replayed = array('L', value)
+        elif kind == 'keys':
+            for row, col, pressed in value:
+                if pressed:
+                    replayed[row] |= 1 << col
+                else:
+                    replayed[row] &= ~(1 << col)
+    print(f"1200-event burst: {dropped} events dropped, {len(resync)} key state records, "
+          f"host key state correct: {replayed == state}")
+
+if __name__ == "__main__":
+    simulate()